@@ -9,6 +9,7 @@ import scipy.signal as signal
 from scipy.stats import t
 import sys
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import time
 
 """
@@ -32,12 +33,7 @@ def np_calc_chisq(data, b, w, coef):
         chisq, the total chi squared summed over all points and all images
     """
 
-    chisq = 0
-    nim = data.shape[0]
-    for i in range(nim):
-        chisq += np.sum((data[i] - np.sum(coef[i] * b.T, axis=1)) ** 2 * w[i])
-
-    return chisq
+    return np.sum((data - np.dot(coef, b)) ** 2 * w)
 
 def set_pixel_weights(imflat, rflat, ivar=None, mode='standard', inner_sup=17, outer_sup=66):
     '''
@@ -102,7 +98,115 @@ def _random_orthonormal(nvec, nvar, seed=1):
         raise ValueError("random orthonormal is nan")
     return A
 
-def weighted_empca(data, weights=None, niter=25, nvec=5, randseed=1, maxcpus=1, silent=True):
+# upper bound (in bytes) on the (npix, nvec, nvec) normal-equation blocks built at once by weighted_empca
+_chunk_bytes = 2**27
+
+def _pixel_chunks(nvar, nvec, ncpus=1):
+    '''
+    Split the pixel axis into chunks so that the (chunk, nvec, nvec) normal equations stay below _chunk_bytes
+
+    Args:
+        nvar: number of pixels
+        nvec: rank of the model
+        ncpus: number of chunks that will be worked on at the same time
+
+    Returns:
+        list of slices covering range(nvar)
+    '''
+    chunksize = max(1, _chunk_bytes // (8 * nvec * nvec * max(1, ncpus)))
+    # don't leave cpus idle for small sectors
+    if ncpus > 1:
+        chunksize = min(chunksize, -(-nvar // ncpus))
+    return [slice(start, min(start + chunksize, nvar)) for start in range(0, nvar, chunksize)]
+
+def _solve_normal_equations(A, b):
+    '''
+    Solve a stack of small linear systems A[i] x[i] = b[i], falling back to the pseudo-inverse if any is singular
+
+    Args:
+        A: (n, nvec, nvec) array of normal matrices
+        b: (n, nvec) array of right hand sides
+
+    Returns:
+        x: (n, nvec) array of solutions
+        singular: 1 if the pseudo-inverse had to be used, 0 otherwise
+    '''
+    try:
+        return np.linalg.solve(A, b[..., None])[..., 0], 0
+    except np.linalg.LinAlgError:
+        return np.einsum('nmp,np->nm', np.linalg.pinv(A), b), 1
+
+def _map_chunks(func, chunks, pool):
+    '''
+    Apply func to every chunk, in the thread pool if there is one
+    '''
+    if pool is None:
+        return [func(chunk) for chunk in chunks]
+    return pool.map(func, chunks)
+
+def _fit_coefficients(datwgt, weights, P, chunks, pool=None):
+    '''
+    Weighted least-squares coefficients of every observation on the basis vectors P
+
+    Args:
+        datwgt: (nobs, nvar) data multiplied by the weights
+        weights: (nobs, nvar) weights
+        P: (nvec, nvar) basis vectors
+        chunks: list of pixel slices (see _pixel_chunks) to build the normal matrices with
+        pool: optional thread pool to build the chunks in parallel
+
+    Returns:
+        C: (nvec, nobs) coefficients
+        singular: 1 if the pseudo-inverse had to be used, 0 otherwise
+    '''
+    nvec = P.shape[0]
+
+    def _obs_normal_matrix(chunk):
+        outer = np.einsum('aj,bj->jab', P[:, chunk], P[:, chunk]).reshape(-1, nvec * nvec)
+        return np.dot(weights[:, chunk], outer)
+
+    A = np.sum(_map_chunks(_obs_normal_matrix, chunks, pool), axis=0).reshape(-1, nvec, nvec)
+    b = np.dot(datwgt, P.T)
+    C, singular = _solve_normal_equations(A, b)
+    return C.T, singular
+
+def weighted_projection(data, basis, weights=None, maxcpus=1):
+    '''
+    Weighted least-squares fit of each observation with a fixed set of basis vectors (e.g. from weighted_empca and
+    model_basis). All observations are solved together as a batch of small (nvec, nvec) systems.
+
+    Args:
+        data: (nobs, nvar) images to model
+        basis: (nvec, nvar) basis vectors
+        weights: (nobs, nvar) weights for every pixel. If None, all ones
+        maxcpus: maximum cpus to use to build the normal equations
+
+    Returns:
+        (nobs, nvar) model of each observation
+    '''
+    data = np.atleast_2d(np.asarray(data, dtype=float))
+    basis = np.atleast_2d(np.asarray(basis, dtype=float))
+    if weights is None:
+        weights = np.ones(data.shape, float)
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    if data.shape != weights.shape or data.shape[1] != basis.shape[1]:
+        raise ValueError("'data', 'weights' and 'basis' must have the same number of pixels.")
+
+    ncpus = 1 if maxcpus is None else maxcpus
+    chunks = _pixel_chunks(data.shape[1], basis.shape[0], ncpus)
+    if ncpus > 1 and len(chunks) > 1:
+        pool = ThreadPool(processes=min(ncpus, len(chunks)))
+        try:
+            C, singular = _fit_coefficients(data * weights, weights, basis, chunks, pool)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        C, singular = _fit_coefficients(data * weights, weights, basis, chunks)
+
+    return np.dot(C.T, basis)
+
+def weighted_empca(data, weights=None, niter=25, nvec=5, randseed=1, maxcpus=1, silent=True, init_vecs=None, tol=None):
     '''
     Perform iterative low-rank matrix approximation of data using weights.
 
@@ -116,8 +220,14 @@ def weighted_empca(data, weights=None, niter=25, nvec=5, randseed=1, maxcpus=1,
         niter: maximum number of iterations to perform
         nvec: number of vectors to solve (rank of the approximation)
         randseed: rand num generator seed; if None, don't re-initialize
-        maxcpus: maximum cpus to use for parallel programming
+        maxcpus: maximum cpus to use for parallel programming. The normal equations are built and solved in
+                 chunks of pixels, with up to maxcpus chunks handled at the same time by a thread pool.
         silent: bool, whether to show chi_squared for each iteration
+        init_vecs: optional (k, nvar) array of initial basis vectors, e.g. the basis of a lower rank solution
+                   (see model_basis). They are orthonormalized, and completed with random orthonormal vectors
+                   if k < nvec. If None, start from nvec random orthonormal vectors.
+        tol: if not None, stop iterating once the relative change in chi squared between two iterations is
+             smaller than tol, even if niter has not been reached
 
     Returns:
         returns the best low-rank approximation to the data in a weighted
@@ -127,35 +237,13 @@ def weighted_empca(data, weights=None, niter=25, nvec=5, randseed=1, maxcpus=1,
     if weights is None:
         weights = np.ones(data.shape, float)
 
-    ##################################################################
-    # The following code makes sure that there are two copies each 
-    # of data and weights, one in C format (last axis fast) and one 
-    # in Fortran format (first axis fast).  This costs a factor of
-    # two in memory usage but speeds up access later.
-    ##################################################################
-
     if not (isinstance(data, np.ndarray) and isinstance(weights, np.ndarray)):
         raise TypeError("'data' and 'weights' must be numpy ndarrays.")
     if not (data.shape == weights.shape and len(data.shape) == 2):
         raise ValueError("'data' and 'weights' must be 2D arrays of the same shape.")
-   
-    if data.flags['C']:
-        dataC = data.astype(float)
-        dataF = (dataC.T).copy(order='C')
-    elif data.flags['F']:
-        dataC = data.copy(order='C').astype(float)
-        dataF = data.T.astype(float)
-    else:
-        raise AttributeError("Attribute 'flags' missing from data.")
-    
-    if weights.flags['C']:
-        weightsC = weights.astype(float)
-        weightsF = (weightsC.T).copy(order='C')
-    elif weights.flags['F']:
-        weightsC = weights.copy(order='C').astype(float)
-        weightsF = weights.T.astype(float)
-    else:
-        raise AttributeError("Attribute 'flags' missing from weights.")
+
+    dataC = np.ascontiguousarray(data, dtype=float)
+    weightsC = np.ascontiguousarray(weights, dtype=float)
 
     ##################################################################
     # Random initial guess for the low-rank approximation, zero
@@ -164,6 +252,11 @@ def weighted_empca(data, weights=None, niter=25, nvec=5, randseed=1, maxcpus=1,
 
     nobs, nvar = data.shape
     P = _random_orthonormal(nvec, nvar, seed=randseed)
+    if init_vecs is not None:
+        init_vecs = np.atleast_2d(init_vecs)[:nvec]
+        if init_vecs.shape[1] != nvar:
+            raise ValueError("'init_vecs' must have the same number of pixels as 'data'.")
+        P = np.linalg.qr(np.concatenate([init_vecs, P[init_vecs.shape[0]:]], axis=0).T)[0].T
     C = np.zeros((nobs, nvec))
 
     if not silent:
@@ -172,69 +265,80 @@ def weighted_empca(data, weights=None, niter=25, nvec=5, randseed=1, maxcpus=1,
     ncpus = multiprocessing.cpu_count()
     if maxcpus is not None:
         ncpus = min(ncpus, maxcpus)
+    chunks = _pixel_chunks(nvar, nvec, ncpus)
+    pool = None
+    if ncpus > 1 and len(chunks) > 1:
+        pool = ThreadPool(processes=min(ncpus, len(chunks)))
 
     chisq_orig = np_calc_chisq(dataC, P*0, weightsC, C)
     chisq_last = chisq_orig
     datwgt = dataC*weightsC
 
+    ##################################################################
+    # Both steps solve one small weighted least-squares problem per
+    # row (observation) or per column (pixel). The normal matrices
+    #     A_obs[n] = sum_j w[n, j] P[:, j] P[:, j]^T
+    #     A_pix[j] = sum_n w[n, j] C[:, n] C[:, n]^T
+    # are matrix products of the weights with stacks of outer
+    # products, accumulated one chunk of pixels at a time so that
+    # at most a (chunk, nvec, nvec) block is in memory per thread.
+    ##################################################################
+
+    def _solve_pixels(chunk):
+        A = np.dot(weightsC[:, chunk].T, outer_C).reshape(-1, nvec, nvec)
+        b = np.dot(datwgt[:, chunk].T, C.T)
+        P_chunk, singular = _solve_normal_equations(A, b)
+        P[:, chunk] = P_chunk.T
+        return singular
+
     singular_matrix = 0
-    for itr in range(1, niter + 1):
-
-        tstart = time.time()
-        ##############################################################
-        # Solve for best-fit coefficients with the previous/first
-        # low-rank approximation.
-        ##############################################################
-
-        P3D = np.empty((P.shape[0], P.shape[0], P.shape[1]))
-        for i in range(P.shape[0]):
-            P3D[i] = P*P[i]
-        A = np.tensordot(weights, P3D.T, axes=1)
-        b = np.dot(datwgt, P.T)
-        
-        try:
-            C = np.linalg.solve(A, b).T
-        except:
-            singular_matrix += 1
-            Ainv = np.linalg.pinv(A)
-            C = np.einsum('nmp,np->nm', Ainv, b).T
-            
-        ##############################################################
-        # Compute the weighted residual (chi squared) value from the
-        # previous fit.
-        ##############################################################
-
-        if not silent:
-
-            chisq = np_calc_chisq(dataC, P, weightsC, C.T)
-            print('%3d  %9.3g  %12.6f %11.3f' % (itr, chisq - chisq_last, 1 - chisq / chisq_orig, time.time() - tstart))
-            chisq_last = chisq
-
-        if itr == niter:
-
-            ##########################################################
-            # Compute the low-rank approximation to the data.
-            ##########################################################
-
-            model = np.dot(C.T, P)
-
-        else:
-
-            ##########################################################
-            # Update the low-rank approximation.
-            ##########################################################
-            C3D = np.empty((C.shape[0], C.shape[0], C.shape[1]))
-            for i in range(C.shape[0]):
-                C3D[i] = C*C[i]
-            A = np.tensordot(weights.T, C3D.T, axes=1)
-            b = np.dot(datwgt.T, C.T)
-
-            try:
-                P = np.linalg.solve(A, b).T
-            except:
-                singular_matrix += 1
-                Ainv = np.linalg.pinv(A)
-                P = np.einsum('nmp,np->nm', Ainv, b).T
+    try:
+        for itr in range(1, niter + 1):
+
+            tstart = time.time()
+            ##############################################################
+            # Solve for best-fit coefficients with the previous/first
+            # low-rank approximation.
+            ##############################################################
+
+            C, singular = _fit_coefficients(datwgt, weightsC, P, chunks, pool)
+            singular_matrix += singular
+
+            ##############################################################
+            # Compute the weighted residual (chi squared) value from the
+            # previous fit.
+            ##############################################################
+
+            converged = False
+            if not silent or tol is not None:
+
+                chisq = np_calc_chisq(dataC, P, weightsC, C.T)
+                if not silent:
+                    print('%3d  %9.3g  %12.6f %11.3f' % (itr, chisq - chisq_last, 1 - chisq / chisq_orig, time.time() - tstart))
+                converged = tol is not None and np.abs(chisq_last - chisq) <= tol * chisq
+                chisq_last = chisq
+
+            if itr == niter or converged:
+
+                ##########################################################
+                # Compute the low-rank approximation to the data.
+                ##########################################################
+
+                model = np.dot(C.T, P)
+                break
+
+            else:
+
+                ##########################################################
+                # Update the low-rank approximation.
+                ##########################################################
+                outer_C = np.einsum('an,bn->nab', C, C).reshape(nobs, nvec * nvec)
+                P = np.empty((nvec, nvar))
+                singular_matrix += sum(_map_chunks(_solve_pixels, chunks, pool))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     ##################################################################
     # Normalize the low-rank approximation.
@@ -246,4 +350,17 @@ def weighted_empca(data, weights=None, niter=25, nvec=5, randseed=1, maxcpus=1,
     if singular_matrix > 0:
         print('number of singular matrices encountered:{}'.format(singular_matrix))
 
-    return model
\ No newline at end of file
+    return model
+
+def model_basis(model, nvec):
+    '''
+    Orthonormal basis spanning a low-rank model returned by weighted_empca, for use as init_vecs
+
+    Args:
+        model: (nobs, nvar) low-rank approximation of the data
+        nvec: number of basis vectors to return (at most the rank of the model)
+
+    Returns:
+        (nvec, nvar) array of orthonormal vectors, ordered by how much of the model they describe
+    '''
+    return np.linalg.svd(model, full_matrices=False)[2][:nvec]
@@ -1,6 +1,9 @@
 
 #KLIP Forward Modelling
 import os
+import glob
+import shutil
+import hashlib
 from sys import stdout
 import warnings
 from time import time
@@ -187,36 +190,61 @@ def perturb_specIncluded(evals, evecs, original_KL, refs, models_ref, return_per
         delta_KL_nospec: perturbed KL modes. Shape is (numKL, wv, pix)
     """
 
-    max_basis = original_KL.shape[0]
-    N_ref = refs.shape[0]
-    N_pix = original_KL.shape[1]
+    output = perturb_specIncluded_batch(evals, evecs, original_KL, refs, models_ref[None],
+                                        return_perturb_covar=return_perturb_covar)
+    if return_perturb_covar:
+        return output[0][0], output[1][0]
+    else:
+        return output[0]
+
+
+def perturb_specIncluded_batch(evals, evecs, original_KL, refs, models_ref, return_perturb_covar=False):
+    """
+    Same as perturb_specIncluded() for a stack of F sets of reference models that share the same reference images and
+    KL basis (e.g. several science frames or several models of the same frame). The terms that only depend on the
+    eigenvalues are computed once and the rest is done with a few batched matrix products.
+
+    Args:
+        evals: array of eigenvalues of the reference PSF covariance matrix (array of size numbasis)
+        evecs: corresponding eigenvectors (array of size [N, numbasis])
+        orignal_KL: unpertrubed KL modes (array of size [numbasis, p])
+        refs: N x p array of the N reference images that
+                  characterizes the extended source with p pixels
+        models_ref: F x N x p array of the models corresponding to reference images. Each model should contain
+                    spectral information. NaNs are set to 0 in place.
+        return_perturb_covar: if True, also return the perturbations of the covariance matrix
 
+    Returns:
+        delta_KL: perturbed KL modes. Shape is (F, numKL, pix)
+        C: if return_perturb_covar, the perturbations of the covariance matrix. Shape is (F, N, N)
+    """
     refs_mean_sub = refs - np.nanmean(refs, axis=1)[:, None]
     refs_mean_sub[np.where(np.isnan(refs_mean_sub))] = 0
 
     models_mean_sub = models_ref # - np.nanmean(models_ref, axis=1)[:,None] should this be the case?
     models_mean_sub[np.where(np.isnan(models_mean_sub))] = 0
 
-    #print(evals.shape,evecs.shape,original_KL.shape,refs.shape,models_ref.shape)
-
+    # the eigenvalue terms are shared by all the models
+    max_basis = original_KL.shape[0]
     evals_tiled = np.tile(evals,(max_basis,1))
     np.fill_diagonal(evals_tiled,np.nan)
     evals_sqrt = np.sqrt(evals)
     evalse_inv_sqrt = 1./evals_sqrt
     evals_ratio = (evalse_inv_sqrt[:,None]).dot(evals_sqrt[None,:])
     beta_tmp = 1./(evals_tiled.transpose()- evals_tiled)
-    #print(evals)
     beta_tmp[np.diag_indices(np.size(evals))] = -0.5/evals
     beta = evals_ratio*beta_tmp
 
-    C_partial = models_mean_sub.dot(refs_mean_sub.transpose())
-    C = C_partial+C_partial.transpose()
-    #C =  models_mean_sub.dot(refs_mean_sub.transpose())+refs_mean_sub.dot(models_mean_sub.transpose())
-    alpha = (evecs.transpose()).dot(C).dot(evecs)
+    # with C = M.R^T + R.M^T, alpha = V^T.C.V = X + X^T where X = (V^T.M).(R^T.V)
+    evecs_models = np.matmul(evecs.transpose(), models_mean_sub) # (F, numKL, p)
+    alpha_partial = np.matmul(evecs_models, refs_mean_sub.transpose().dot(evecs)) # (F, numKL, numKL)
+    alpha = alpha_partial + np.swapaxes(alpha_partial, 1, 2)
 
-    delta_KL = (beta*alpha).dot(original_KL)+(evalse_inv_sqrt[:,None]*evecs.transpose()).dot(models_mean_sub)
+    delta_KL = np.matmul(beta*alpha, original_KL) + evalse_inv_sqrt[:,None]*evecs_models
 
     if return_perturb_covar:
+        C_partial = np.matmul(models_mean_sub, refs_mean_sub.transpose())
+        C = C_partial + np.swapaxes(C_partial, 1, 2)
         return delta_KL, C
     else:
         return delta_KL
@@ -394,6 +422,18 @@ def calculate_fm(delta_KL_nospec, original_KL, numbasis, sci, model_sci, inputfl
     else:
         numbasis_index = np.clip(numbasis - 1, 0, max_basis-1)
 
+    # calculate perturbed KL modes based on spectrum
+    if inputflux is not None:
+        # delta_KL_nospec.shape = (max_basis,N_lambda,N_pix) or (max_basis,N_ref,N_pix)
+        delta_KL = np.dot(inputflux, delta_KL_nospec) # this will take the last dimension of input_spectrum (wv) and sum over the second to last dimension of delta_KL_nospec (wv)
+    else:
+        delta_KL = delta_KL_nospec
+
+    if np.size(delta_KL.shape) == 2:
+        fm_psf, klipped_oversub, klipped_selfsub = calculate_fm_batch(delta_KL[None], original_KL, numbasis, sci[None],
+                                                                      model_sci[None])
+        return fm_psf[0], klipped_oversub[0], klipped_selfsub[0]
+
     # remove means and nans from science image
     sci_mean_sub = np.copy(sci - np.nanmean(sci))
     sci_nanpix = np.where(np.isnan(sci_mean_sub))
@@ -411,13 +451,6 @@ def calculate_fm(delta_KL_nospec, original_KL, numbasis, sci, model_sci, inputfl
     # model_rows_selected = np.tile(sci_mean_sub, (np.size(numbasis),1)) # don't need this because of python behavior where I don't need to duplicate rows
 
 
-    # calculate perturbed KL modes based on spectrum
-    if inputflux is not None:
-        # delta_KL_nospec.shape = (max_basis,N_lambda,N_pix) or (max_basis,N_ref,N_pix)
-        delta_KL = np.dot(inputflux, delta_KL_nospec) # this will take the last dimension of input_spectrum (wv) and sum over the second to last dimension of delta_KL_nospec (wv)
-    else:
-        delta_KL = delta_KL_nospec
-
     # Forward model the PSF
     # 3 terms: 1 for oversubtracton (planet attenauted by speckle KL modes),
     # and 2 terms for self subtraction (planet signal leaks in KL modes which get projected onto speckles)
@@ -431,20 +464,16 @@ def calculate_fm(delta_KL_nospec, original_KL, numbasis, sci, model_sci, inputfl
     # sci_mean_sub_rows.shape = (max_basis,N_pix)  (tiled)
     # model_sci_mean_sub_rows.shape = (max_basis,N_pix) (tiled)
     # original_KL.shape = (max_basis,N_pix)
-    # delta_KL.shape = (max_basis,N_pix)
+    # delta_KL.shape = (max_basis,N_lambda or N_ref,N_pix)
     oversubtraction_inner_products = np.dot(model_sci_mean_sub_rows, original_KL.T)
-    if np.size(delta_KL.shape) == 2:
-        selfsubtraction_1_inner_products = np.dot(sci_mean_sub_rows, delta_KL.T)
-        # selfsubtraction_1_inner_products.shape = (max_basis,N_pix,max_basis)
-    else:
-        Nlambda = delta_KL.shape[1]
-        #Before delta_KL.shape = (max_basis,N_lambda or N_ref,N_pix)
-        delta_KL = np.rollaxis(delta_KL,1,0)
-        #Now delta_KL.shape = (N_lambda or N_ref,max_basis,N_pix)
-        # np.rollaxis(delta_KL,2,1).shape = (N_lambda or N_ref,N_pix,max_basis)
-        # np.dot() takes the last dimension of first array and sum over the second to last dimension of second array
-        selfsubtraction_1_inner_products = np.dot(sci_mean_sub_rows, np.rollaxis(delta_KL,2,1))
-        # selfsubtraction_1_inner_products.shape = (N_lambda or N_ref,max_basis,max_basis)
+    Nlambda = delta_KL.shape[1]
+    #Before delta_KL.shape = (max_basis,N_lambda or N_ref,N_pix)
+    delta_KL = np.rollaxis(delta_KL,1,0)
+    #Now delta_KL.shape = (N_lambda or N_ref,max_basis,N_pix)
+    # np.rollaxis(delta_KL,2,1).shape = (N_lambda or N_ref,N_pix,max_basis)
+    # np.dot() takes the last dimension of first array and sum over the second to last dimension of second array
+    selfsubtraction_1_inner_products = np.dot(sci_mean_sub_rows, np.rollaxis(delta_KL,2,1))
+    # selfsubtraction_1_inner_products.shape = (N_lambda or N_ref,max_basis,max_basis)
     selfsubtraction_2_inner_products = np.dot(sci_mean_sub_rows, original_KL.T)
 
     # lower_tri is a matrix with all the element below and one the diagonal equal to unity. The upper part of the matrix
@@ -454,31 +483,170 @@ def calculate_fm(delta_KL_nospec, original_KL, numbasis, sci, model_sci, inputfl
     lower_tri = np.tril(np.ones([max_basis,max_basis]))
     oversubtraction_inner_products = oversubtraction_inner_products * lower_tri
     klipped_oversub = np.dot(np.take(oversubtraction_inner_products, numbasis_index, axis=0), original_KL)
-    if np.size(delta_KL.shape) == 2:
-        # selfsubtraction_1_inner_products = (max_basis,max_basis)
-        # selfsubtraction_2_inner_products = (max_basis,max_basis)
-        selfsubtraction_1_inner_products = selfsubtraction_1_inner_products * lower_tri
-        selfsubtraction_2_inner_products = selfsubtraction_2_inner_products * lower_tri
-        klipped_selfsub = np.dot(np.take(selfsubtraction_1_inner_products, numbasis_index, axis=0), original_KL) + \
-                          np.dot(np.take(selfsubtraction_2_inner_products,numbasis_index, axis=0), delta_KL)
-
-        return model_sci - klipped_oversub - klipped_selfsub, klipped_oversub, klipped_selfsub
+    selfsubtraction_1_inner_products = np.array([selfsubtraction_1_inner_products[:,k,:] * lower_tri for k in range(Nlambda)])
+    selfsubtraction_2_inner_products = selfsubtraction_2_inner_products * lower_tri
+    # selfsubtraction_1_inner_products = (N_lambda or N_ref,max_basis,max_basis)
+    # selfsubtraction_2_inner_products = (N_ref=max_basis,max_basis)
+    # original_KL.shape = (max_basis,N_pix)
+    # delta_KL.shape = (N_lambda or N_ref,max_basis,N_pix)
+    klipped_selfsub1 = np.dot(np.take(selfsubtraction_1_inner_products, numbasis_index, axis=1), original_KL)
+    klipped_selfsub2 = np.dot(np.take(selfsubtraction_2_inner_products,numbasis_index, axis=0), delta_KL)
+    klipped_selfsub = np.rollaxis(klipped_selfsub1,1,0) + klipped_selfsub2
+
+    # klipped_oversub.shape = (size(numbasis),Npix)
+    # klipped_selfsub.shape = (size(numbasis),N_lambda or N_ref,N_pix)
+    # klipped_oversub = Sum(<S|KL>KL)
+    # klipped_selfsub = Sum(<N|DKL>KL) + Sum(<N|KL>DKL)
+    return klipped_oversub, klipped_selfsub
+
+
+def calculate_fm_batch(delta_KL, original_KL, numbasis, sci, model_sci):
+    r"""
+    Same as calculate_fm() with the spectrum already folded into delta_KL, for a stack of F science images (or models)
+    that share the same KL basis. Instead of tiling the science image and model for each KL mode, the inner products
+    are computed once and the KL mode cutoffs are applied with a mask.
+
+    Args:
+        delta_KL: perturbed KL modes for each science image. Shape is (F, numKL, pix)
+        orignal_KL: unpertrubed KL modes (array of size [numbasis, numpix])
+        numbasis: array of KL mode cutoffs
+                If numbasis is [None] the number of KL modes to be used is automatically picked based on the eigenvalues.
+        sci: array of shape (F, p) of the science data
+        model_sci: array of shape (F, p) of the PSF in each science frame. NaNs are set to 0 in place.
+
+    Returns:
+        fm_psf: array of shape (F, b, p) showing the forward modelled PSF
+        klipped_oversub: array of shape (F, b, p) showing the effect of oversubtraction as a function of KL modes
+        klipped_selfsub: array of shape (F, b, p) showing the effect of selfsubtraction as a function of KL modes
+    """
+    max_basis = original_KL.shape[0]
+    if numbasis[0] is None:
+        numbasis_index = np.array([max_basis-1])
     else:
-        selfsubtraction_1_inner_products = np.array([selfsubtraction_1_inner_products[:,k,:] * lower_tri for k in range(Nlambda)])
-        selfsubtraction_2_inner_products = selfsubtraction_2_inner_products * lower_tri
-        # selfsubtraction_1_inner_products = (N_lambda or N_ref,max_basis,max_basis)
-        # selfsubtraction_2_inner_products = (N_ref=max_basis,max_basis)
-        # original_KL.shape = (max_basis,N_pix)
-        # delta_KL.shape = (N_lambda or N_ref,max_basis,N_pix)
-        klipped_selfsub1 = np.dot(np.take(selfsubtraction_1_inner_products, numbasis_index, axis=1), original_KL)
-        klipped_selfsub2 = np.dot(np.take(selfsubtraction_2_inner_products,numbasis_index, axis=0), delta_KL)
-        klipped_selfsub = np.rollaxis(klipped_selfsub1,1,0) + klipped_selfsub2
+        numbasis_index = np.clip(np.atleast_1d(numbasis) - 1, 0, max_basis-1)
+    # which KL modes are used for each cutoff. Shape of (b, max_basis)
+    kl_mask = np.arange(max_basis)[None, :] <= numbasis_index[:, None]
 
-        # klipped_oversub.shape = (size(numbasis),Npix)
-        # klipped_selfsub.shape = (size(numbasis),N_lambda or N_ref,N_pix)
-        # klipped_oversub = Sum(<S|KL>KL)
-        # klipped_selfsub = Sum(<N|DKL>KL) + Sum(<N|KL>DKL)
-        return klipped_oversub, klipped_selfsub
+    # remove means and nans from science images
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        sci_mean_sub = sci - np.nanmean(sci, axis=1)[:, None]
+    sci_mean_sub[np.where(np.isnan(sci_mean_sub))] = 0
+
+    # science PSF models, ready for FM
+    model_sci_mean_sub = model_sci # should be subtracting off the mean?
+    model_sci_mean_sub[np.where(np.isnan(model_sci_mean_sub))] = 0
+
+    # Klipped = N-Sum(<N|KL>KL) + S-Sum(<S|KL>KL) - Sum(<N|DKL>KL) - Sum(<N|KL>DKL)
+    # inner products have shape (F, max_basis)
+    oversubtraction_inner_products = np.dot(model_sci_mean_sub, original_KL.T)
+    selfsubtraction_1_inner_products = np.einsum("fp,fkp->fk", sci_mean_sub, delta_KL)
+    selfsubtraction_2_inner_products = np.dot(sci_mean_sub, original_KL.T)
+
+    klipped_oversub = np.dot(oversubtraction_inner_products[:, None, :] * kl_mask, original_KL)
+    klipped_selfsub = np.dot(selfsubtraction_1_inner_products[:, None, :] * kl_mask, original_KL) + \
+                      np.matmul(selfsubtraction_2_inner_products[:, None, :] * kl_mask, delta_KL)
+
+    return model_sci[:, None, :] - klipped_oversub - klipped_selfsub, klipped_oversub, klipped_selfsub
+
+
+def linear_fm_operator(evals, evecs, original_KL, refs, numbasis, sci):
+    r"""
+    Precomputes the terms of perturb_specIncluded() and calculate_fm() that do not depend on the PSF models, for a
+    science image and its KL basis. The forward model is linear in the models of the science and reference images, so
+    it can then be computed for any models with apply_linear_fm_operator() with only a few matrix products.
+
+    With Z the KL modes, s the science image, E the eigenvectors and R the references, the models of the references M
+    only enter through C = E^T.M, and
+
+        FM_b = m - q_b^T.Z - (w_b * evals^-1/2)^T.C
+
+    with w_b = <s|Z> masked by the KL cutoff b, q_b = mask_b * (<m|Z> + B.<s|Z> + evals^-1/2 * C.s) + B^T.w_b and
+    B = beta * (C.R^T.E + (C.R^T.E)^T).
+
+    Args:
+        evals: array of eigenvalues of the reference PSF covariance matrix (array of size numbasis)
+        evecs: corresponding eigenvectors (array of size [N, numbasis])
+        orignal_KL: unpertrubed KL modes (array of size [numbasis, p])
+        refs: N x p array of the N reference images
+        numbasis: array of KL mode cutoffs
+                If numbasis is [None] the number of KL modes to be used is automatically picked based on the eigenvalues.
+        sci: array of size p of the science data
+
+    Returns:
+        operator: dict of the precomputed terms, to pass to apply_linear_fm_operator()
+    """
+    max_basis = original_KL.shape[0]
+    if numbasis[0] is None:
+        numbasis_index = np.array([max_basis-1])
+    else:
+        numbasis_index = np.clip(np.atleast_1d(numbasis) - 1, 0, max_basis-1)
+    # which KL modes are used for each cutoff. Shape of (b, max_basis)
+    kl_mask = np.arange(max_basis)[None, :] <= numbasis_index[:, None]
+
+    refs_mean_sub = refs - np.nanmean(refs, axis=1)[:, None]
+    refs_mean_sub[np.where(np.isnan(refs_mean_sub))] = 0
+
+    sci_mean_sub = sci - np.nanmean(sci)
+    sci_mean_sub[np.where(np.isnan(sci_mean_sub))] = 0
+
+    # same eigenvalue terms as perturb_specIncluded
+    evals_tiled = np.tile(evals,(max_basis,1))
+    np.fill_diagonal(evals_tiled,np.nan)
+    evals_sqrt = np.sqrt(evals)
+    evalse_inv_sqrt = 1./evals_sqrt
+    evals_ratio = (evalse_inv_sqrt[:,None]).dot(evals_sqrt[None,:])
+    beta_tmp = 1./(evals_tiled.transpose()- evals_tiled)
+    beta_tmp[np.diag_indices(np.size(evals))] = -0.5/evals
+    beta = evals_ratio*beta_tmp
+
+    sci_KL = np.dot(original_KL, sci_mean_sub)
+    masked_sci_KL = kl_mask * sci_KL[None, :]
+
+    return {"original_KL": original_KL, "kl_mask": kl_mask, "evecs_T": np.ascontiguousarray(evecs.T),
+            "refs_evecs": refs_mean_sub.T.dot(evecs), "beta": beta, "evalse_inv_sqrt": evalse_inv_sqrt,
+            "sci_mean_sub": sci_mean_sub, "sci_KL": sci_KL, "masked_sci_KL": masked_sci_KL,
+            "masked_sci_KL_scaled": masked_sci_KL * evalse_inv_sqrt[None, :]}
+
+
+def apply_linear_fm_operator(operator, model_sci, models_ref=None):
+    """
+    Forward models a stack of F models with an operator from linear_fm_operator(). Same as calculate_fm_batch() on
+    the output of perturb_specIncluded_batch() up to numerical precision.
+
+    Args:
+        operator: output of linear_fm_operator()
+        model_sci: array of shape (F, p) of the PSF model in the science frame. NaNs are set to 0 in place.
+        models_ref: array of shape (F, N, p) of the models in the reference images. NaNs are set to 0 in place. If
+                    None, the KL modes are not perturbed (only oversubtraction, e.g. in RDI).
+
+    Returns:
+        fm_psf: array of shape (F, b, p) showing the forward modelled PSF
+    """
+    original_KL = operator["original_KL"]
+    kl_mask = operator["kl_mask"]
+
+    model_sci[np.where(np.isnan(model_sci))] = 0
+    # oversubtraction
+    coeffs = kl_mask[None, :, :] * np.dot(model_sci, original_KL.T)[:, None, :] # (F, b, max_basis)
+
+    if models_ref is not None:
+        models_ref[np.where(np.isnan(models_ref))] = 0
+        evecs_models = np.matmul(operator["evecs_T"], models_ref) # (F, max_basis, p)
+        alpha_partial = np.matmul(evecs_models, operator["refs_evecs"]) # (F, max_basis, max_basis)
+        beta_alpha = operator["beta"] * (alpha_partial + np.swapaxes(alpha_partial, 1, 2))
+
+        # selfsubtraction: <s|DKL> KL + <s|KL> DKL
+        sci_delta_KL = np.matmul(beta_alpha, operator["sci_KL"]) + \
+                       operator["evalse_inv_sqrt"][None, :] * np.matmul(evecs_models, operator["sci_mean_sub"])
+        coeffs += kl_mask[None, :, :] * sci_delta_KL[:, None, :]
+        coeffs += np.matmul(operator["masked_sci_KL"][None, :, :], beta_alpha)
+        fm_psf = model_sci[:, None, :] - np.matmul(coeffs, original_KL) - \
+                 np.matmul(operator["masked_sci_KL_scaled"][None, :, :], evecs_models)
+    else:
+        fm_psf = model_sci[:, None, :] - np.matmul(coeffs, original_KL)
+
+    return fm_psf
 
 
 def calculate_fm_singleNumbasis(delta_KL_nospec, original_KL, numbasis, sci, model_sci, inputflux = None):
@@ -563,7 +731,7 @@ def calculate_fm_singleNumbasis(delta_KL_nospec, original_KL, numbasis, sci, mod
     # sci_mean_sub_rows.shape = (1,N_pix)
     # model_sci_mean_sub_rows.shape = (1,N_pix)
     # original_KL.shape = (max_basis,N_pix)
-    # delta_KL.shape = (max_basis,N_pix)
+    # delta_KL.shape = (max_basis,N_lambda or N_ref,N_pix)
     oversubtraction_inner_products = np.dot(model_sci_mean_sub_rows, original_KL.T)
     if np.size(delta_KL.shape) == 2:
         selfsubtraction_1_inner_products = np.dot(sci_mean_sub_rows, delta_KL.T)
@@ -697,7 +865,8 @@ def calculate_validity(covar_perturb, models_ref, numbasis, evals_orig, covar_or
 def _tpool_init(original_imgs, original_imgs_shape, aligned_imgs, aligned_imgs_shape, output_imgs, output_imgs_shape,
                 output_imgs_numstacked,
                 pa_imgs, wvs_imgs, centers_imgs, interm_imgs, interm_imgs_shape, fmout_imgs, fmout_imgs_shape,
-                perturbmag_imgs, perturbmag_imgs_shape, psf_library, psf_library_shape, centers_mask):
+                perturbmag_imgs, perturbmag_imgs_shape, psf_library, psf_library_shape, centers_mask, fm_class=None,
+                klbasis=None, klbasis_dir=None):
     """
     Initializer function for the thread pool that initializes various shared variables. Main things to note that all
     except the shapes are shared arrays (mp.Array) - output_imgs does not need to be mp.Array and can be anything
@@ -722,10 +891,14 @@ def _tpool_init(original_imgs, original_imgs_shape, aligned_imgs, aligned_imgs_s
         perturbmag_imgs: array for output of size of linear perturbation to assess validity
         perturbmag_imgs_shape: shape of perturbmag_imgs
         centers_mask: mask centers. same dimesion as center_imgs that specify star_centers
+        fm_class: the forward modelling class instance. It is shipped to each process once here so the tasks don't
+                  have to pickle it (and its model cubes, spectral libraries, etc.) every time
+        klbasis: KL basis of a previous run to reuse (see _pack_klbasis_shards), or None
+        klbasis_dir: directory where each task saves the KL basis of its images (see _save_klbasis_shard), or None
     """
     global original, original_shape, aligned, aligned_shape, outputs, outputs_shape, outputs_numstacked, img_pa, \
         img_wv, img_center, interm, interm_shape, fmout, fmout_shape, perturbmag, perturbmag_shape, \
-        psf_lib, psf_lib_shape, mask_centers
+        psf_lib, psf_lib_shape, mask_centers, fm_obj, fm_klbasis, fm_klbasis_dir
     # original images from files to read and align&scale. Shape of (N,y,x)
     original = original_imgs
     original_shape = original_imgs_shape
@@ -754,6 +927,13 @@ def _tpool_init(original_imgs, original_imgs_shape, aligned_imgs, aligned_imgs_s
     psf_lib = psf_library
     psf_lib_shape = psf_library_shape
 
+    # forward modelling class
+    fm_obj = fm_class
+
+    # KL basis to reuse or to save
+    fm_klbasis = klbasis
+    fm_klbasis_dir = klbasis_dir
+
 
 def _align_and_scale_subset(thread_index, aligned_center,numthreads = None,dtype=float):
     """
@@ -874,49 +1054,71 @@ def _get_section_indicies(input_shape, img_center, radstart, radend, phistart, p
 
 
 
-def _save_rotated_section(input_shape, sector, sector_ind, output_img, output_img_numstacked, angle, radstart, radend, phistart, phiend, padding,IOWA, img_center, flipx=True,
-                          new_center=None):
+# cache of the maps used to derotate sectors in _save_rotated_section, shared by all the calls of this process
+_rotation_maps = {}
+# maximum number of maps to keep in the cache before dropping the oldest ones
+_rotation_maps_size = 256
+
+
+def _cubic_spline_weights(t):
     """
-    Rotate and save sector in output image at desired ranges
+    Weights of the 4 cubic B-spline coefficients around a coordinate (the same ones scipy.ndimage uses)
 
     Args:
-        input_shape: shape of input_image
-        sector: data in the sector to save to output_img
-        sector_ind: index into input img (corresponding to input_shape) for the original sector
-        output_img: the array to save the data to
-        output_img_numstacked: array to increment region where we saved output to to bookkeep stacking. None for
-                               skipping bookkeeping
-        angle: angle that the sector needs to rotate (I forget the convention right now)
+        t: fractional part of the coordinates (array of size p)
 
-        The next 6 parameters define the sector geometry in input image coordinates
-        radstart: radius from img_center of start of sector
-        radend: radius from img_center of end of sector
-        phistart: azimuthal start of sector
-        phiend: azimuthal end of sector
-        padding: amount of padding around each sector
-        IOWA: tuple (IWA,OWA) where IWA = Inner working angle and OWA = Outer working angle both in pixels.
-                It defines the separation interva in which klip will be run.
-        img_center: center of image in input image coordinate
+    Returns:
+        weights: array of shape (4, p) for the coefficients at floor(x)-1, ..., floor(x)+2
+    """
+    return np.array([(1 - t)**3 / 6., (3 * t**3 - 6 * t**2 + 4) / 6., (-3 * t**3 + 3 * t**2 + 3 * t + 1) / 6.,
+                     t**3 / 6.])
 
-        flipx: if true, flip the x coordinate to switch coordinate handiness
-        new_center: if not none, center of output_img. If none, center stays the same
+
+def _spline_indices(coord, size):
     """
-    # convert angle to radians
-    angle_rad = np.radians(angle)
+    Indices and weights of the 4 cubic spline coefficients around each coordinate along one axis, as in
+    ndimage.map_coordinates (mode="constant"), which mirrors the spline coefficients at the edges
 
-    #wrap phi
-    phistart %= 2 * np.pi
-    phiend %= 2 * np.pi
+    Args:
+        coord: coordinates along the axis (array of size p)
+        size: size of the image along the axis
 
-    #incorporate padding
-    IWA,OWA = IOWA
-    radstart_padded = np.max([radstart-padding,IWA])
-    if OWA is not None:
-        radend_padded = np.min([radend+padding,OWA])
+    Returns:
+        indices: (4, p) int array of the indices of the coefficients at floor(x)-1, ..., floor(x)+2
+        weights: (4, p) array of the weights of those coefficients
+    """
+    start = np.floor(coord).astype(int) - 1
+    indices = np.abs(start[None, :] + np.arange(4)[:, None])
+    if size > 1:
+        indices %= 2 * (size - 1)
+        indices = np.where(indices >= size, 2 * (size - 1) - indices, indices)
     else:
-        radend_padded = radend+padding
-    phistart_padded = (phistart - padding/np.mean([radstart, radend])) % (2 * np.pi)
-    phiend_padded = (phiend + padding/np.mean([radstart, radend])) % (2 * np.pi)
+        indices[:] = 0
+    return indices.astype(np.int32), _cubic_spline_weights(coord - np.floor(coord))
+
+
+def _get_rotation_map(input_shape, angle, radstart, radend, phistart, phiend, padding, IOWA, img_center, flipx=True,
+                      new_center=None):
+    """
+    Gets the map to derotate a sector (see _save_rotated_section for the arguments). Maps only depend on the geometry,
+    so they are cached and reused for all the KL modes, FM outputs and frames with the same rotation angle.
+
+    Returns:
+        rotation_map: dict with
+            out_pix: flat indices of the pixels of the rotated sector in the output image (size p)
+            probe_pix: (4, p) flat indices of the input pixels around each rotated coordinate, for NaN detection
+            spline_y, spline_x: (4, p) indices of the cubic spline coefficients in y and x around each coordinate
+            weights_y, weights_x: (4, p) weights of those coefficients
+            outside: (p) boolean array of the coordinates that fall outside the input image
+    """
+    key = (tuple(input_shape), float(angle), float(radstart), float(radend), float(phistart), float(phiend),
+           float(padding), tuple(IOWA), float(img_center[0]), float(img_center[1]), flipx,
+           None if new_center is None else (float(new_center[0]), float(new_center[1])))
+    if key in _rotation_maps:
+        return _rotation_maps[key]
+
+    # convert angle to radians
+    angle_rad = np.radians(angle)
 
     # create the coordinate system of the image to manipulate for the transform
     dims = input_shape
@@ -942,53 +1144,134 @@ def _save_rotated_section(input_shape, sector, sector_ind, output_img, output_im
 
     rot_sector_pix = _get_section_indicies(input_shape, new_center, radstart, radend, phistart, phiend,
                                            padding, 0, IOWA, flatten=False, flipx=flipx)
+    xp = xp[rot_sector_pix]
+    yp = yp[rot_sector_pix]
+
+    # for NaN detection, any pixel in the new coordiante system (xp, yp) is a nan if any one of the neighboring
+    # pixels in the original image is a nan
+    # e.g. (xp, yp) = (120.1, 200.1) is nan if either (120, 200), (121, 200), (120, 201), (121, 201) is a nan
+    xp_floor = np.clip(np.floor(xp).astype(int), 0, dims[1]-1)
+    xp_ceil = np.clip(np.ceil(xp).astype(int), 0, dims[1]-1)
+    yp_floor = np.clip(np.floor(yp).astype(int), 0, dims[0]-1)
+    yp_ceil = np.clip(np.ceil(yp).astype(int), 0, dims[0]-1)
+    probe_pix = np.array([yp_floor * dims[1] + xp_floor, yp_floor * dims[1] + xp_ceil,
+                          yp_ceil * dims[1] + xp_floor, yp_ceil * dims[1] + xp_ceil])
+
+    # cubic spline interpolation as in ndimage.map_coordinates (mode="constant"), which gives NaNs outside of the
+    # image
+    spline_y, weights_y = _spline_indices(yp, dims[0])
+    spline_x, weights_x = _spline_indices(xp, dims[1])
+    outside = (yp < 0) | (yp > dims[0] - 1) | (xp < 0) | (xp > dims[1] - 1)
+
+    rotation_map = {"out_pix": np.ravel_multi_index(rot_sector_pix, (dims[0], dims[1])), "probe_pix": probe_pix,
+                    "spline_y": spline_y, "spline_x": spline_x, "weights_y": weights_y, "weights_x": weights_x,
+                    "outside": outside}
+
+    # drop the oldest maps if the cache is full
+    while len(_rotation_maps) >= _rotation_maps_size:
+        del _rotation_maps[next(iter(_rotation_maps))]
+    _rotation_maps[key] = rotation_map
+
+    return rotation_map
+
+
+def _rotate_sections(input_shape, sectors, sector_ind, angle, radstart, radend, phistart, phiend, padding, IOWA,
+                     img_center, flipx=True, new_center=None):
+    """
+    Rotate a stack of sectors that share the same geometry (e.g. the FM of several models or KL mode cutoffs). See
+    _save_rotated_section for the arguments.
+
+    Args:
+        sectors: array of shape (M, p) of the data in the sector
+        (others): same as _save_rotated_section
+
+    Returns:
+        out_pix: flat indices of the pixels of the rotated sector in the output image (size p')
+        rot_sectors: array of shape (M, p') of the rotated sectors. NaN where there is no valid data.
+    """
+    #wrap phi
+    phistart %= 2 * np.pi
+    phiend %= 2 * np.pi
 
+    # the rotated coordinates and interpolation weights only depend on the geometry
+    rotation_map = _get_rotation_map(input_shape, angle, radstart, radend, phistart, phiend, padding, IOWA,
+                                     img_center, flipx=flipx, new_center=new_center)
 
-    # do NaN detection by defining any pixel in the new coordiante system (xp, yp) as a nan
-    # if any one of the neighboring pixels in the original image is a nan
-    # e.g. (xp, yp) = (120.1, 200.1) is nan if either (120, 200), (121, 200), (120, 201), (121, 201)
-    # is a nan
     dims = input_shape
-    blank_input = np.zeros(dims[1] * dims[0])
-    blank_input[sector_ind] = sector
-    blank_input.shape = [dims[0], dims[1]]
-
-    xp_floor = np.clip(np.floor(xp).astype(int), 0, xp.shape[1]-1)[rot_sector_pix]
-    xp_ceil = np.clip(np.ceil(xp).astype(int), 0, xp.shape[1]-1)[rot_sector_pix]
-    yp_floor = np.clip(np.floor(yp).astype(int), 0, yp.shape[0]-1)[rot_sector_pix]
-    yp_ceil = np.clip(np.ceil(yp).astype(int), 0, yp.shape[0]-1)[rot_sector_pix]
-    rotnans = np.where(np.isnan(blank_input[yp_floor.ravel(), xp_floor.ravel()]) | 
-                       np.isnan(blank_input[yp_floor.ravel(), xp_ceil.ravel()]) |
-                       np.isnan(blank_input[yp_ceil.ravel(), xp_floor.ravel()]) |
-                       np.isnan(blank_input[yp_ceil.ravel(), xp_ceil.ravel()]))
+    blank_inputs = np.zeros((sectors.shape[0], dims[1] * dims[0]))
+    blank_inputs[:, np.ravel(sector_ind)] = sectors
+
+    # do NaN detection using the 4 neighboring pixels of each rotated coordinate
+    input_nans = np.isnan(blank_inputs)
+    rotnans = np.any(input_nans[:, rotation_map["probe_pix"]], axis=1)
 
     # resample image based on new coordinates, set nan values as median
-    nanpix = np.where(np.isnan(blank_input))
-    medval = np.median(blank_input[np.where(~np.isnan(blank_input))])
-    input_copy = np.copy(blank_input)
-    input_copy[nanpix] = medval
-    rot_sector = ndimage.map_coordinates(input_copy, [yp[rot_sector_pix], xp[rot_sector_pix]], cval=np.nan)
+    for blank_input, input_nan in zip(blank_inputs, input_nans):
+        if np.any(input_nan):
+            blank_input[input_nan] = np.median(blank_input[~input_nan])
+    blank_inputs.shape = [sectors.shape[0], dims[0], dims[1]]
+    # 2D spline filter of each image
+    spline_coeffs = ndimage.spline_filter1d(blank_inputs, order=3, axis=1, output=np.float64, mode="constant")
+    spline_coeffs = ndimage.spline_filter1d(spline_coeffs, order=3, axis=2, output=np.float64, mode="constant")
+    spline_y = rotation_map["spline_y"]
+    spline_x = rotation_map["spline_x"]
+    rot_sectors = np.einsum("in,jn,mijn->mn", rotation_map["weights_y"], rotation_map["weights_x"],
+                            spline_coeffs[:, spline_y[:, None, :], spline_x[None, :, :]])
 
     # mask nans
-    rot_sector[rotnans] = np.nan
-    sector_validpix = np.where(~np.isnan(rot_sector))
+    rot_sectors[rotnans | rotation_map["outside"][None, :]] = np.nan
 
-    # need to define only where the non nan pixels are, so we can store those in the output image
-    blank_output = np.zeros([dims[0], dims[1]]) * np.nan
-    blank_output[rot_sector_pix] = rot_sector
-    blank_output.shape = (dims[0], dims[1])
-    rot_sector_validpix_2d = np.where(~np.isnan(blank_output))
+    return rotation_map["out_pix"], rot_sectors
 
-    # save output sector. We need to reshape the array into 2d arrays to save it
-    output_img.shape = [outputs_shape[1], outputs_shape[2]]
-    output_img[rot_sector_validpix_2d] = np.nansum([output_img[rot_sector_pix][sector_validpix], rot_sector[sector_validpix]], axis=0)
-    output_img.shape = [outputs_shape[1] * outputs_shape[2]]
+
+def _save_rotated_section(input_shape, sector, sector_ind, output_img, output_img_numstacked, angle, radstart, radend, phistart, phiend, padding,IOWA, img_center, flipx=True,
+                          new_center=None):
+    """
+    Rotate and save sector in output image at desired ranges
+
+    Args:
+        input_shape: shape of input_image
+        sector: data in the sector to save to output_img
+        sector_ind: index into input img (corresponding to input_shape) for the original sector
+        output_img: the array to save the data to
+        output_img_numstacked: array to increment region where we saved output to to bookkeep stacking. None for
+                               skipping bookkeeping
+        angle: angle that the sector needs to rotate (I forget the convention right now)
+
+        The next 6 parameters define the sector geometry in input image coordinates
+        radstart: radius from img_center of start of sector
+        radend: radius from img_center of end of sector
+        phistart: azimuthal start of sector
+        phiend: azimuthal end of sector
+        padding: amount of padding around each sector
+        IOWA: tuple (IWA,OWA) where IWA = Inner working angle and OWA = Outer working angle both in pixels.
+                It defines the separation interva in which klip will be run.
+        img_center: center of image in input image coordinate
+
+        flipx: if true, flip the x coordinate to switch coordinate handiness
+        new_center: if not none, center of output_img. If none, center stays the same
+    """
+    dims = input_shape
+    out_pix, rot_sector = _rotate_sections(input_shape, np.reshape(sector, (1, -1)), sector_ind, angle, radstart,
+                                           radend, phistart, phiend, padding, IOWA, img_center, flipx=flipx,
+                                           new_center=new_center)
+    rot_sector = rot_sector[0]
+
+    sector_validpix = np.where(~np.isnan(rot_sector))
+    rot_sector_validpix = out_pix[sector_validpix]
+
+    # save output sector. We need to flatten the output array (in place) to save it
+    output_img_shape = output_img.shape
+    output_img.shape = [dims[0] * dims[1]]
+    output_img[rot_sector_validpix] = np.nansum([output_img[rot_sector_validpix], rot_sector[sector_validpix]], axis=0)
+    output_img.shape = output_img_shape
 
     # Increment the numstack counter if it is not None
     if output_img_numstacked is not None:
-        output_img_numstacked.shape = [outputs_shape[1], outputs_shape[2]]
-        output_img_numstacked[rot_sector_validpix_2d] += 1
-        output_img_numstacked.shape = [outputs_shape[1] *  outputs_shape[2]]
+        numstacked_shape = output_img_numstacked.shape
+        output_img_numstacked.shape = [dims[0] * dims[1]]
+        output_img_numstacked[rot_sector_validpix] += 1
+        output_img_numstacked.shape = numstacked_shape
 
 
 def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers, OWA=None, mode='ADI+SDI', annuli=5, 
@@ -997,7 +1280,7 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
                       spectrum=None, psf_library=None, psf_library_good=None, psf_library_corr=None,
                       padding=0, save_klipped=True, flipx=True,
                       N_pix_sector = None,mute_progression = False, annuli_spacing="constant", 
-                      compute_noise_cube=False):
+                      compute_noise_cube=False, batch_size=None, save_klbasis=None, klbasis=None):
     """
     multithreaded KLIP PSF Subtraction
 
@@ -1056,6 +1339,15 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
         annuli_spacing: how to distribute the annuli radially. Currently three options. Constant (equally spaced), 
                         log (logarithmical expansion with r), and linear (linearly expansion with r)
         compute_noise_cube:  if True, compute the noise in each pixel assuming azimuthally uniform noise
+        batch_size: number of science images of the same wavelength processed together by one task in each sector.
+                    Images in a batch share the reference models and (when they have the same PA) the covariance
+                    matrix. If None, picks it so that there are about 4 tasks per process for each sector.
+        save_klbasis: if not None, name of a directory where to save the KL basis of each science image in each sector
+                    (KL modes, eigenvalues, eigenvectors, selected references and klipped image) in the packed
+                    .klbasis format, so that the FM of other FM classes on the same dataset can reuse it.
+        klbasis: if not None, name of a directory where a KL basis was saved with save_klbasis. It is reused instead of
+                    computing the covariance matrices and their eigendecomposition, so it needs to have been computed
+                    on the same dataset with the same KLIP parameters.
 
     Returns:
         sub_imgs: array of [array of 2D images (PSF subtracted)] using different number of KL basis vectors as
@@ -1097,6 +1389,9 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
     if numthreads is None:
         numthreads = mp.cpu_count()
 
+    if batch_size is None:
+        batch_size = np.max([totalimgs // (4 * numthreads), 1])
+
     # default aligned_center if none:
     if aligned_center is None:
         aligned_center = [np.mean(centers[:,0]), np.mean(centers[:,1])]
@@ -1180,8 +1475,41 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
             dphi = phi1_mod+2*np.pi-phi0_mod
         sectors_area.append((dphi/2.)*(r1**2-r0**2))
     sectors_area = np.array(sectors_area)
+
+    # only queue the sectors that the FM class needs. This is decided before any sector is processed.
+    regions = fm_class.regions_of_interest()
+    sectors_queued = np.array([_sector_in_regions(radstart, radend, phistart, phiend, padding, regions, flipx) and
+                               not fm_class.skip_section(radstart, radend, phistart, phiend, flipx=flipx)
+                               for (radstart, radend), (phistart, phiend) in iterator_sectors], dtype=bool)
+    if not np.all(sectors_queued):
+        print("Skipping {0} of the {1} sectors that the FM class does not need".format(np.sum(~sectors_queued),
+                                                                                        tot_sectors))
+    # skipped sectors don't take any time
+    sectors_area[~sectors_queued] = 0
     tot_area = np.sum(sectors_area)
 
+    # parameters that define the KL basis of each image, to check that a saved KL basis can be reused
+    if save_klbasis is not None or klbasis is not None:
+        if save_klbasis is not None and klbasis is not None:
+            raise ValueError("Cannot reuse a KL basis and save it at the same time")
+        klbasis_params = _klbasis_params(imgs, parangs, wvs, IWA, OWA, mode, iterator_sectors, movement, flux_overlap,
+                                         PSF_FWHM, numbasis, maxnumbasis, corr_smooth, aligned_center, minrot, maxrot,
+                                         spectrum, padding, psf_library, psf_library_good, psf_library_corr)
+    if klbasis is not None:
+        klbasis_dict = _load_packed_kl_basis(klbasis)
+        _check_klbasis_params(klbasis_dict["klparam_dict"], klbasis_params, klbasis)
+    else:
+        klbasis_dict = None
+    if save_klbasis is not None:
+        # each task writes the KL basis of its images in this directory, they are packed together at the end
+        klbasis_shard_dir = os.path.join(save_klbasis, "shards")
+        if os.path.isdir(klbasis_shard_dir):
+            shutil.rmtree(klbasis_shard_dir)
+        os.makedirs(klbasis_shard_dir)
+    else:
+        klbasis_shard_dir = None
+    sectors_run = np.zeros(tot_sectors, dtype=bool)
+
     ########################### Create Shared Memory ###################################
 
     # implement the thread pool
@@ -1243,14 +1571,16 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
     tpool = mp.Pool(processes=numthreads, initializer=_tpool_init,
                     initargs=(original_imgs, original_imgs_shape, recentered_imgs, recentered_imgs_shape, output_imgs,
                               output_imgs_shape, output_imgs_numstacked, pa_imgs, wvs_imgs, centers_imgs, None, None,
-                              fmout_data, fmout_shape,perturbmag,perturbmag_shape, psf_lib, psf_lib_shape, centers_mask), 
+                              fmout_data, fmout_shape,perturbmag,perturbmag_shape, psf_lib, psf_lib_shape, centers_mask,
+                              fm_class, klbasis_dict, klbasis_shard_dir),
                     maxtasksperchild=50)
 
     # # SINGLE THREAD DEBUG PURPOSES ONLY
     if debug :
         _tpool_init(original_imgs, original_imgs_shape, recentered_imgs, recentered_imgs_shape, output_imgs,
                     output_imgs_shape, output_imgs_numstacked, pa_imgs, wvs_imgs, centers_imgs, None, None,
-                    fmout_data, fmout_shape,perturbmag,perturbmag_shape, psf_lib, psf_lib_shape, centers_mask)
+                    fmout_data, fmout_shape,perturbmag,perturbmag_shape, psf_lib, psf_lib_shape, centers_mask, fm_class,
+                    klbasis_dict, klbasis_shard_dir)
 
 
 
@@ -1275,10 +1605,13 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
 
     # as each is finishing, queue up the aligned data to be processed with KLIP
     N_it = 0
-    N_tot_it = totalimgs*tot_sectors
+    N_tot_it = totalimgs*np.sum(sectors_queued)
     time_spent_per_sector_list = []
     time_spent_last_sector=0
+    last_sector_area = 0
     for sector_index, ((radstart, radend),(phistart,phiend)) in enumerate(iterator_sectors):
+        if not sectors_queued[sector_index]:
+            continue
         t_start_sector = time()
         print("Starting KLIP for sector {0}/{1} with an area of {2} pix^2".format(sector_index+1,tot_sectors,sectors_area[sector_index]))
         if len(time_spent_per_sector_list)==0:
@@ -1291,7 +1624,7 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
             print("Estimated remaining time: {0:.0f}s".format((tot_area-np.sum(sectors_area[0:sector_index]))*\
                                       (np.sum(time_spent_per_sector_list)/np.sum(sectors_area[0:sector_index]))))
             print("Average time per pixel: {0} during last sector, {1} since begining"\
-                  .format(time_spent_last_sector/sectors_area[sector_index-1],
+                  .format(time_spent_last_sector/last_sector_area,
                           (np.sum(time_spent_per_sector_list)/np.sum(sectors_area[0:sector_index]))))
         # calculate sector size
         section_ind = _get_section_indicies(original_imgs_shape[1:], aligned_center, radstart, radend, phistart, phiend,
@@ -1299,9 +1632,10 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
         #print(np.shape(section_ind))
         #print(radstart, radend, phistart, phiend)
 
-        if fm_class.skip_section(radstart, radend, phistart, phiend,flipx=flipx):
-            print("SKIPPING")
-            continue
+        if klbasis_dict is not None and not klbasis_dict["klparam_dict"]["sectors_run"][sector_index]:
+            raise ValueError("Sector {0} was skipped when the KL basis in {1} was computed".format(sector_index,
+                                                                                                  klbasis))
+        sectors_run[sector_index] = True
 
         sector_size = np.size(section_ind) #+ 2 * (radend- radstart) # some sectors are bigger than others due to boundary
         interm_data, interm_shape = fm_class.alloc_interm(sector_size, original_imgs_shape[0])
@@ -1311,25 +1645,27 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
             # pick out the science images that need PSF subtraction for this wavelength
             scidata_indicies = np.where(wvs == wv_value)[0]
 
-            # perform KLIP asynchronously for each group of files of a specific wavelength and section of the image
+            # perform KLIP asynchronously for each batch of files of a specific wavelength and section of the image
             sector_job_queued[sector_index] += scidata_indicies.shape[0]
+            batches = np.array_split(scidata_indicies, int(np.ceil(scidata_indicies.shape[0] / float(batch_size))))
             if not debug: 
-                tpool_outputs += [tpool.apply_async(_klip_section_multifile_perfile,
-                                                    args=(file_index, sector_index, radstart, radend, phistart, phiend,
-                                                          parang, wv_value, wv_index, (radstart + radend) / 2., padding,(IWA,OWA),
-                                                          numbasis,maxnumbasis,
-                                                          movement,flux_overlap,PSF_FWHM, aligned_center, minrot, maxrot, mode, spectrum,
-                                                          flipx, corr_smooth, fm_class, psf_library_good, psf_library_corr, mute_progression))
-                                  for file_index,parang in zip(scidata_indicies, pa_imgs_np[scidata_indicies])]
+                tpool_outputs += [(tpool.apply_async(_klip_section_multifile_batch,
+                                                     args=(batch, sector_index, radstart, radend, phistart, phiend,
+                                                           pa_imgs_np[batch], wv_value, wv_index, (radstart + radend) / 2., padding,(IWA,OWA),
+                                                           numbasis,maxnumbasis,
+                                                           movement,flux_overlap,PSF_FWHM, aligned_center, minrot, maxrot, mode, spectrum,
+                                                           flipx, corr_smooth, None, psf_library_good, psf_library_corr, mute_progression)),
+                                   np.size(batch))
+                                  for batch in batches]
 
             # # SINGLE THREAD DEBUG PURPOSES ONLY
             if debug:
-                tpool_outputs += [_klip_section_multifile_perfile(file_index, sector_index, radstart, radend, phistart, phiend,
-                                                                  parang, wv_value, wv_index, (radstart + radend) / 2., padding,(IWA,OWA),
-                                                                  numbasis,maxnumbasis,
-                                                                  movement,flux_overlap,PSF_FWHM, aligned_center, minrot, maxrot, mode, spectrum,
-                                                                  flipx, corr_smooth, fm_class,psflib_good=psf_library_good, psflib_corr=psf_library_corr, mute=mute_progression)
-                                  for file_index,parang in zip(scidata_indicies, pa_imgs_np[scidata_indicies])]
+                tpool_outputs += [_klip_section_multifile_batch(batch, sector_index, radstart, radend, phistart, phiend,
+                                                                pa_imgs_np[batch], wv_value, wv_index, (radstart + radend) / 2., padding,(IWA,OWA),
+                                                                numbasis,maxnumbasis,
+                                                                movement,flux_overlap,PSF_FWHM, aligned_center, minrot, maxrot, mode, spectrum,
+                                                                flipx, corr_smooth, fm_class,psflib_good=psf_library_good, psflib_corr=psf_library_corr, mute=mute_progression)
+                                  for batch in batches]
 
         # Run post processing on this sector here
         # Can be multithreaded code using the threadpool defined above
@@ -1337,9 +1673,10 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
         N_it_perSector = 0
         if not debug:
             while len(tpool_outputs) > 0:
-                tpool_outputs.pop(0).wait()
-                N_it = N_it+1
-                N_it_perSector = N_it_perSector+1
+                tpool_output, batch_numimgs = tpool_outputs.pop(0)
+                tpool_output.wait()
+                N_it = N_it+batch_numimgs
+                N_it_perSector = N_it_perSector+batch_numimgs
                 if not mute_progression:
                     stdout.write("\r {0:.2f}% of sector, {1:.2f}% of total completed".format(100*float(N_it_perSector)/float(totalimgs),100*float(N_it)/float(N_tot_it)))
                     stdout.flush()
@@ -1362,6 +1699,7 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
         # Add time spent on last sector to the list
         time_spent_last_sector = time() - t_start_sector
         time_spent_per_sector_list.append(time_spent_last_sector)
+        last_sector_area = sectors_area[sector_index]
 
 
 
@@ -1370,6 +1708,10 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
     tpool.close()
     tpool.join()
 
+    if save_klbasis is not None:
+        klbasis_params["sectors_run"] = sectors_run
+        _pack_klbasis_shards(klbasis_shard_dir, klbasis_params, save_klbasis)
+
     # finished!
     # Mean the output images if save_klipped is True
     if save_klipped:
@@ -1419,11 +1761,52 @@ def klip_parallelized(imgs, centers, parangs, wvs, IWA, fm_class, mask_centers,
 
 
 
+def _sector_in_regions(radstart, radend, phistart, phiend, padding, regions, flipx=True):
+    """
+    Checks if a sector intersects one of the regions of interest of an FM class (see NoFM.regions_of_interest())
+
+    Args:
+        radstart: minimum radial distance of sector [pixels]
+        radend: maximum radial distance of sector [pixels]
+        phistart: minimum azimuthal coordinate of sector [radians]
+        phiend: maximum azimuthal coordinate of sector [radians]
+        padding: number of pixels the sector is padded by [pixels]
+        regions: list of (sep, pa, radius) regions [pixels, degrees, pixels], or None for the whole image
+        flipx: if True, flip x coordinate in final image
+
+    Returns:
+        True if the sector (with its padding) intersects one of the regions, or if regions is None
+    """
+    if regions is None:
+        return True
+
+    dphi_sector = (phiend - phistart) % (2 * np.pi)
+    for sep, pa, radius in regions:
+        # azimuthal coordinate of the region center in the sector coordinate system
+        if flipx:
+            phi = np.pi / 2. - np.radians(pa)
+        else:
+            phi = np.pi / 2. + np.radians(pa)
+        # distance between the region center and the sector
+        if dphi_sector == 0 or (phi - phistart) % (2 * np.pi) <= dphi_sector:
+            dist = np.max([radstart - sep, sep - radend, 0])
+        else:
+            # closest point on the radial edges of the sector
+            dist = np.inf
+            for phi_edge in [phistart, phiend]:
+                r_edge = np.clip(sep * np.cos(phi - phi_edge), radstart, radend)
+                dist = np.min([dist, np.sqrt(sep**2 + r_edge**2 - 2 * sep * r_edge * np.cos(phi - phi_edge))])
+        if dist <= radius + padding:
+            return True
+
+    return False
+
+
 def _klip_section_multifile_perfile(img_num, sector_index, radstart, radend, phistart, phiend, parang, wavelength,
                                     wv_index, avg_rad, padding,IOWA,
                                     numbasis,maxnumbasis, minmove,flux_overlap,PSF_FWHM, ref_center, minrot, maxrot,
                                     mode, spectrum, flipx, corr_smooth,
-                                    fm_class,
+                                    fm_class=None,
                                     psflib_good=None, psflib_corr=None, mute=False):
     """
     Imitates the rest of _klip_section for the multifile code. Does the rest of the PSF reference selection
@@ -1463,6 +1846,8 @@ def _klip_section_multifile_perfile(img_num, sector_index, radstart, radend, phi
         flipx: if True, flips x axis after rotation to get North up East left
         corr_smooth (float): size of sigma of Gaussian smoothing kernel (in pixels) when computing most correlated PSFs.
                             If 0, no smoothing
+        fm_class: class that implements the the forward modelling functionality. If None, uses the one set up for
+                  this process by _tpool_init()
         mute: If True, prevent prints about the section size being too small, section being full of nans or number of
             reference psfs available.
             _klip_section_multifile_perfile is therefore returning False silently in these cases.
@@ -1472,8 +1857,101 @@ def _klip_section_multifile_perfile(img_num, sector_index, radstart, radend, phi
         Saves image to output array defined in _tpool_init()
     """
 
+    return _klip_section_multifile_batch(np.array([img_num]), sector_index, radstart, radend, phistart, phiend,
+                                         np.array([parang]), wavelength, wv_index, avg_rad, padding, IOWA, numbasis,
+                                         maxnumbasis, minmove, flux_overlap, PSF_FWHM, ref_center, minrot, maxrot, mode,
+                                         spectrum, flipx, corr_smooth, fm_class=fm_class, psflib_good=psflib_good,
+                                         psflib_corr=psflib_corr, mute=mute)
+
+
+def _klip_section_multifile_batch(img_nums, sector_index, radstart, radend, phistart, phiend, parangs, wavelength,
+                                  wv_index, avg_rad, padding, IOWA, numbasis, maxnumbasis, minmove, flux_overlap,
+                                  PSF_FWHM, ref_center, minrot, maxrot, mode, spectrum, flipx, corr_smooth,
+                                  fm_class=None, psflib_good=None, psflib_corr=None, mute=False):
+    """
+    Runs KLIP-FM on a batch of science images of the same wavelength in one sector. Images with the same PA have the
+    same (rotated) sector, so they share the sector indices, the reference PSFs, and their covariance and correlation
+    matrices. All the images of the batch share a model cache that FM classes can use to generate the model of each
+    reference image only once (passed to fm_from_eigen() as model_cache).
+
+    Args:
+        img_nums: array of file indices of the science images to process
+        sector_index: index for the section of the image. Used for return purposes only
+        radstart: radial distance of inner edge of annulus
+        radend: radial distance of outer edge of annulus
+        phistart: start of azimuthal sector (in radians)
+        phiend: end of azimuthal sector (in radians)
+        parangs: array of PAs of the science images
+        wavelength: wavelength of the science images
+        wv_index: array index of the wavelength of the science images
+        The other arguments are the same as for _klip_section_multifile_perfile()
+
+    Returns:
+        sector_index: used for tracking jobs. False if none of the images could be processed
+        Saves images to output array defined in _tpool_init()
+    """
+    if fm_class is None:
+        fm_class = fm_obj
+
+    model_cache = {}
+    # KL basis of the images of this task, to save
+    if fm_klbasis_dir is not None:
+        klbasis_shard = {}
+    else:
+        klbasis_shard = None
+    processed = False
+    for parang in np.unique(parangs):
+        sector_refs = _fm_sector_references(radstart, radend, phistart, phiend, parang, wv_index, padding, IOWA,
+                                            ref_center, corr_smooth, fm_class.data_type, mute=mute,
+                                            compute_covar=fm_klbasis is None)
+        if sector_refs is None:
+            continue
+
+        for img_num in img_nums[parangs == parang]:
+            if _klip_fm_frame(img_num, sector_index, radstart, radend, phistart, phiend, parang, wavelength, wv_index,
+                              avg_rad, padding, IOWA, numbasis, maxnumbasis, minmove, flux_overlap, PSF_FWHM,
+                              ref_center, minrot, maxrot, mode, spectrum, flipx, sector_refs, fm_class,
+                              psflib_good=psflib_good, psflib_corr=psflib_corr, mute=mute,
+                              model_cache=model_cache, klbasis_shard=klbasis_shard) is not False:
+                processed = True
+
+    if klbasis_shard:
+        _save_klbasis_shard(klbasis_shard, os.path.join(fm_klbasis_dir,
+                                                        _klbasis_key(wv_index, sector_index, img_nums[0]) + ".npz"))
+
+    if not processed:
+        return False
+    return sector_index
+
+
+def _fm_sector_references(radstart, radend, phistart, phiend, parang, wv_index, padding, IOWA, ref_center,
+                          corr_smooth, dtype, mute=False, compute_covar=True):
+    """
+    Grabs the sector of the aligned images at a given PA, and computes the covariance and correlation matrices of
+    all the images in that sector.
+
+    Args:
+        radstart: radial distance of inner edge of annulus
+        radend: radial distance of outer edge of annulus
+        phistart: start of azimuthal sector (in radians)
+        phiend: end of azimuthal sector (in radians)
+        parang: PA of the science images (the sector is rotated by it)
+        wv_index: array index of the wavelength of the science images
+        padding: number of pixels to pad the sector by
+        IOWA: tuple (IWA,OWA) where IWA = Inner working angle and OWA = Outer working angle both in pixels.
+        ref_center: center of the aligned images
+        corr_smooth (float): size of sigma of Gaussian smoothing kernel (in pixels) when computing most correlated PSFs.
+                            If 0, no smoothing
+        dtype: ctypes type of the shared arrays
+        mute: If True, don't print that the sector is too small
+        compute_covar: if False, the covariance and correlation matrices are not computed and are None (when the KL
+                       basis of a previous run is reused)
+
+    Returns:
+        (section_ind, section_ind_nopadding, aligned_imgs, ref_psfs, covar_psfs, corr_psfs), or None if the sector is
+        too small. aligned_imgs is (N, y*x) and ref_psfs is (N, p)
+    """
     # get the indicies in the aligned data that correspond to the section and the section without padding
-    #print(img_num)
     IWA,OWA = IOWA
     section_ind = _get_section_indicies(original_shape[1:], ref_center, radstart, radend, phistart, phiend,
                                         padding, parang,IOWA)
@@ -1483,17 +1961,15 @@ def _klip_section_multifile_perfile(img_num, sector_index, radstart, radend, phi
     if np.size(section_ind) <= 1:
         if not mute:
             print("section is too small ({0} pixels), skipping...".format(np.size(section_ind)))
-        return False
+        return None
     #print(np.size(section_ind), np.min(phi_rotate), np.max(phi_rotate), phistart, phiend)
 
     #load aligned images for this wavelength
-    aligned_imgs = _arraytonumpy(aligned, (aligned_shape[0], aligned_shape[1], aligned_shape[2] * aligned_shape[3]),dtype=fm_class.data_type)[wv_index]
+    aligned_imgs = _arraytonumpy(aligned, (aligned_shape[0], aligned_shape[1], aligned_shape[2] * aligned_shape[3]),dtype=dtype)[wv_index]
     ref_psfs = aligned_imgs[:,  section_ind[0]]
 
-    if np.sum(np.isfinite(aligned_imgs[img_num, section_ind[0]])) == 0:
-        if not mute:
-            print("section is full of NaNs ({0} pixels), skipping...".format(np.size(section_ind)))
-        return False
+    if not compute_covar:
+        return section_ind, section_ind_nopadding, aligned_imgs, ref_psfs, None, None
 
     #do the same for the reference PSFs
     #playing some tricks to vectorize the subtraction of the mean for each row
@@ -1553,6 +2029,52 @@ def _klip_section_multifile_perfile(img_num, sector_index, radstart, radend, phi
         covar_diag = np.diagflat(covar_diag_sqrt_inverse)
         corr_psfs = np.dot( np.dot(covar_diag, covar_psfs ), covar_diag)
 
+    return section_ind, section_ind_nopadding, aligned_imgs, ref_psfs, covar_psfs, corr_psfs
+
+
+def _klip_fm_frame(img_num, sector_index, radstart, radend, phistart, phiend, parang, wavelength, wv_index, avg_rad,
+                   padding, IOWA, numbasis, maxnumbasis, minmove, flux_overlap, PSF_FWHM, ref_center, minrot, maxrot,
+                   mode, spectrum, flipx, sector_refs, fm_class, psflib_good=None, psflib_corr=None, mute=False,
+                   model_cache=None, klbasis_shard=None):
+    """
+    Selects the reference PSFs for one science image, runs KLIP on it and hands the results to the FM class
+
+    Args:
+        img_num: file index for the science image to process
+        sector_refs: output of _fm_sector_references() for the sector of this science image
+        model_cache: dict shared by the images of a batch, passed to fm_class.fm_from_eigen()
+        klbasis_shard: if not None, dict of the task where the KL basis of this image is kept to be saved
+        The other arguments are the same as for _klip_section_multifile_perfile()
+
+    Returns:
+        sector_index: used for tracking jobs. False if the image was skipped
+    """
+    section_ind, section_ind_nopadding, aligned_imgs, ref_psfs, covar_psfs, corr_psfs = sector_refs
+
+    if np.sum(np.isfinite(aligned_imgs[img_num, section_ind[0]])) == 0:
+        if not mute:
+            print("section is full of NaNs ({0} pixels), skipping...".format(np.size(section_ind)))
+        return False
+
+    # reuse the KL basis of a previous run instead of selecting the reference PSFs and running KLIP again
+    if fm_klbasis is not None:
+        klbasis_key = _klbasis_key(wv_index, sector_index, img_num)
+        if klbasis_key not in fm_klbasis["klmodes_dict"]:
+            # this image was skipped when the KL basis was computed
+            return False
+        # copies, because the KL basis is memory-mapped read only
+        rdi_psfs_selected = np.array(fm_klbasis["rdi_psfs_dict"][klbasis_key])
+        if rdi_psfs_selected.shape[0] == 0:
+            rdi_psfs_selected = None
+        return _fm_frame_outputs(img_num, sector_index, radstart, radend, phistart, phiend, parang, wavelength,
+                                 wv_index, padding, IOWA, numbasis, maxnumbasis, ref_center, mode, flipx, section_ind,
+                                 section_ind_nopadding, np.array(fm_klbasis["ref_psfs_indicies_dict"][klbasis_key]),
+                                 np.array(fm_klbasis["klipped_dict"][klbasis_key]),
+                                 np.array(fm_klbasis["klmodes_dict"][klbasis_key]),
+                                 np.array(fm_klbasis["evals_dict"][klbasis_key]),
+                                 np.array(fm_klbasis["evecs_dict"][klbasis_key]),
+                                 np.array(fm_klbasis["covar_files_dict"][klbasis_key]), rdi_psfs_selected, fm_class,
+                                 model_cache=model_cache)
 
     # grab the files suitable for reference PSF
     # load shared arrays for wavelengths and PAs
@@ -1690,10 +2212,6 @@ def _klip_section_multifile_perfile(img_num, sector_index, radstart, radend, phi
             rdi_psfs_selected = psf_library[psflib_good][:, section_ind[0]]
     
 
-    # grab PAs and wvs of reference images for forward modeling
-    pa_refimgs = pa_imgs[ref_psfs_indicies]
-    wvs_refimgs = wvs_imgs[ref_psfs_indicies]
-
     # create a list that tracks with reference PSFs are RDI psfs. 1 if RDI PSF, 0 if not. 
     # here, the list is created with just ADI/RDI PSFs first before we merge in the RDI files
     ref_rdi_indices = np.zeros(ref_psfs_selected.shape[0])
@@ -1731,8 +2249,53 @@ def _klip_section_multifile_perfile(img_num, sector_index, radstart, radend, phi
         # add RDI psfs to RDI PSF tracking array
         ref_rdi_indices = np.append(ref_rdi_indices, np.ones(rdi_psfs_selected.shape[0]))
 
-    # restore NaNs
-    ref_psfs_mean_sub[ref_nanpix] = np.nan
+    # run regular KLIP and get the klipped img along with KL modes and eigenvalues/vectors of covariance matrix
+    klip_math_return = klip_math(aligned_imgs[img_num, section_ind[0]], ref_psfs_selected, numbasis,
+                                 covar_psfs=covar_files,)
+    klipped, original_KL, evals, evecs = klip_math_return
+
+    # keep the KL basis of this image so that other FM classes can reuse it
+    if klbasis_shard is not None:
+        if rdi_psfs_selected is None:
+            rdi_psfs_saved = np.zeros((0, numpix))
+        else:
+            rdi_psfs_saved = rdi_psfs_selected
+        klbasis_shard[_klbasis_key(wv_index, sector_index, img_num)] = {
+            "klmodes": original_KL, "evals": evals, "evecs": evecs, "klipped": klipped,
+            "ref_psfs_indicies": ref_psfs_indicies, "covar_files": covar_files, "rdi_psfs": rdi_psfs_saved}
+
+    return _fm_frame_outputs(img_num, sector_index, radstart, radend, phistart, phiend, parang, wavelength, wv_index,
+                             padding, IOWA, numbasis, maxnumbasis, ref_center, mode, flipx, section_ind,
+                             section_ind_nopadding, ref_psfs_indicies, klipped, original_KL, evals, evecs, covar_files,
+                             rdi_psfs_selected, fm_class, model_cache=model_cache)
+
+
+def _fm_frame_outputs(img_num, sector_index, radstart, radend, phistart, phiend, parang, wavelength, wv_index, padding,
+                      IOWA, numbasis, maxnumbasis, ref_center, mode, flipx, section_ind, section_ind_nopadding,
+                      ref_psfs_indicies, klipped, original_KL, evals, evecs, covar_files, rdi_psfs_selected, fm_class,
+                      model_cache=None):
+    """
+    Saves the klipped image of one science image and hands its KL basis to the FM class
+
+    Args:
+        ref_psfs_indicies: indices of the reference images selected for this science image
+        klipped: PSF subtracted sector (output of klip_math). Shape of (p, b)
+        original_KL: KL modes (output of klip_math)
+        evals: eigenvalues of the covariance matrix (output of klip_math)
+        evecs: eigenvectors of the covariance matrix (output of klip_math)
+        covar_files: covariance matrix of the selected reference images
+        rdi_psfs_selected: the RDI reference images in this sector, or None
+        model_cache: dict shared by the images of a batch, passed to fm_class.fm_from_eigen()
+        The other arguments are the same as for _klip_fm_frame()
+
+    Returns:
+        sector_index: used for tracking jobs
+    """
+    # grab PAs and wvs of reference images for forward modeling
+    wvs_imgs = _arraytonumpy(img_wv,dtype=fm_class.data_type)
+    pa_imgs = _arraytonumpy(img_pa,dtype=fm_class.data_type)
+    pa_refimgs = pa_imgs[ref_psfs_indicies]
+    wvs_refimgs = wvs_imgs[ref_psfs_indicies]
 
     aligned_imgs = _arraytonumpy(aligned, (aligned_shape[0], aligned_shape[1], aligned_shape[2] * aligned_shape[3]),dtype=fm_class.data_type)[wv_index]
 
@@ -1744,10 +2307,6 @@ def _klip_section_multifile_perfile(img_num, sector_index, radstart, radend, phi
     fmout_np = _arraytonumpy(fmout, fmout_shape,dtype=fm_class.data_type)
     # convert to numpy array if pertrubmag is defined
     perturbmag_np = _arraytonumpy(perturbmag, perturbmag_shape,dtype=fm_class.data_type)
-    # run regular KLIP and get the klipped img along with KL modes and eigenvalues/vectors of covariance matrix
-    klip_math_return = klip_math(aligned_imgs[img_num, section_ind[0]], ref_psfs_selected, numbasis,
-                                 covar_psfs=covar_files,)
-    klipped, original_KL, evals, evecs = klip_math_return
 
     # write standard klipped image to output if we are saving outputs
     if output_imgs is not None:
@@ -1779,16 +2338,322 @@ def _klip_section_multifile_perfile(img_num, sector_index, radstart, radend, phi
                            radend=radend, phistart=phistart, phiend=phiend, padding=padding, IOWA = IOWA, 
                            ref_center=ref_center, parang=parang, ref_wv=wavelength, numbasis=numbasis,
                            maxnumbasis=maxnumbasis, fmout=fmout_np, output_img_shape = outputs_shape, perturbmag = perturbmag_np,klipped=klipped, 
-                           covar_files=covar_files, flipx=flipx, mode=mode, rdi_psfs=rdi_psfs_selected, mask_centers=centers_mask)
+                           covar_files=covar_files, flipx=flipx, mode=mode, rdi_psfs=rdi_psfs_selected, mask_centers=centers_mask,
+                           model_cache=model_cache)
 
     return sector_index
 
 
+def _klbasis_key(wv_index, sector_index, img_num):
+    """
+    Key of the KL basis of a science image in a sector in the saved KL basis
+
+    Args:
+        wv_index: array index of the wavelength of the science image
+        sector_index: index of the sector
+        img_num: index of the science image
+
+    Returns:
+        key: string
+    """
+    return "wv{0}_sec{1}_img{2}".format(wv_index, sector_index, img_num)
+
+
+def _klbasis_params(imgs, parangs, wvs, IWA, OWA, mode, sectors, movement, flux_overlap, PSF_FWHM, numbasis,
+                    maxnumbasis, corr_smooth, aligned_center, minrot, maxrot, spectrum, padding, psf_library=None,
+                    psf_library_good=None, psf_library_corr=None):
+    """
+    Parameters of klip_parallelized() that the KL basis of each image depends on. They are saved with the KL basis to
+    check that it is reused on the same dataset with the same KLIP parameters. The science images, the RDI library,
+    the good PSFs and their correlations are identified by a digest of their content.
+
+    Args:
+        sectors: list of ((radstart, radend), (phistart, phiend)) of the sectors
+        The other arguments are the same as for klip_parallelized()
+
+    Returns:
+        klbasis_params: dict of numpy arrays (None is saved as NaN)
+    """
+    def to_array(value):
+        if value is None:
+            return np.array(np.nan)
+        return np.array(value, dtype=float)
+
+    def to_digest(value):
+        if value is None:
+            return np.array(np.nan)
+        return np.array(_array_digest(value))
+
+    return {"input_shape": to_array(imgs.shape), "imgs": to_digest(imgs), "PAs": to_array(parangs),
+            "wvs": to_array(wvs), "IWA": to_array(IWA), "OWA": to_array(OWA), "mode": np.array(mode),
+            "sectors": to_array([[r0, r1, phi0, phi1] for (r0, r1), (phi0, phi1) in sectors]),
+            "movement": to_array(movement), "flux_overlap": to_array(flux_overlap), "PSF_FWHM": to_array(PSF_FWHM),
+            "numbasis": to_array(list(numbasis)), "maxnumbasis": to_array(maxnumbasis),
+            "corr_smooth": to_array(corr_smooth), "aligned_center": to_array(aligned_center),
+            "minrot": to_array(minrot), "maxrot": to_array(maxrot), "spectrum": to_array(spectrum),
+            "padding": to_array(padding), "psf_library": to_digest(psf_library),
+            "psf_library_good": to_digest(psf_library_good), "psf_library_corr": to_digest(psf_library_corr)}
+
+
+def _array_digest(array):
+    """
+    Digest of the shape, data type and content of an array, read one row at a time so that a memory-mapped array is
+    not pulled in memory
+
+    Args:
+        array: numpy array (or memmap)
+
+    Returns:
+        hexadecimal string
+    """
+    array = np.asanyarray(array)
+    digest = hashlib.sha1("{0}{1}".format(array.shape, array.dtype.str).encode())
+    rows = array if array.ndim > 1 else [array]
+    for row in rows:
+        digest.update(np.ascontiguousarray(row).tobytes())
+    return digest.hexdigest()
+
+
+def _check_klbasis_params(saved_params, klbasis_params, dirname):
+    """
+    Checks that a saved KL basis was computed with the parameters of this run
+
+    Args:
+        saved_params: the klparam_dict of the saved KL basis
+        klbasis_params: the parameters of this run (see _klbasis_params)
+        dirname: name of the directory of the saved KL basis
+
+    Returns:
+        None. Raises a ValueError if some parameters are different
+    """
+    different_params = []
+    for name, value in klbasis_params.items():
+        if name not in saved_params or not np.array_equal(value, saved_params[name],
+                                                            equal_nan=value.dtype.kind == "f"):
+            different_params.append(name)
+    if len(different_params) > 0:
+        raise ValueError("The KL basis in {0} was computed with a different {1}".format(dirname,
+                                                                                     ", ".join(different_params)))
+
+
+def _save_klbasis_shard(frames_klbasis, filename):
+    """
+    Saves the KL basis of the science images of one task of klip_parallelized(), to be packed with the other tasks by
+    _pack_klbasis_shards(). For each quantity, the raveled arrays of the images are concatenated, with their shapes.
+
+    Args:
+        frames_klbasis: dict of the KL basis of each image in each sector (the keys are from _klbasis_key), each a dict
+                        with the klmodes, evals, evecs, klipped, ref_psfs_indicies, covar_files and rdi_psfs
+        filename: name of the .npz file
+
+    Returns:
+        None
+    """
+    keys = sorted(frames_klbasis.keys())
+    shard = {"keys": np.array(keys)}
+    for name in _klbasis_names:
+        arrays = [np.asarray(frames_klbasis[key][name]) for key in keys]
+        shard[name] = np.concatenate([np.ravel(array) for array in arrays])
+        shard[name + "_shapes"] = np.array([array.shape for array in arrays], dtype=np.int64)
+    np.savez(filename, **shard)
+
+
+def _pack_klbasis_shards(shard_dir, klbasis_params, dirname):
+    """
+    Packs the KL basis saved by the tasks of a klip_parallelized() run in shard_dir into the packed .klbasis format
+    (see _save_packed_kl_basis) and removes shard_dir. The concatenated arrays are written into memory-mapped .npy
+    files one shard at a time, so only one shard is in memory at once.
+
+    Args:
+        shard_dir: directory of the .npz files saved by _save_klbasis_shard()
+        klbasis_params: the parameters of the run (see _klbasis_params)
+        dirname: the name of the directory where it will be saved
+
+    Returns:
+        None
+    """
+    shard_files = sorted(glob.glob(os.path.join(shard_dir, "*.npz")))
+
+    # read the keys and shapes of every shard to lay out the packed arrays
+    keys, shard_starts = [], []
+    shapes = {name: [] for name in _klbasis_names}
+    dtypes = {name: [] for name in _klbasis_names}
+    for shard_file in shard_files:
+        with np.load(shard_file) as shard:
+            shard_starts.append(len(keys))
+            keys += [str(key) for key in shard["keys"]]
+            for name in _klbasis_names:
+                shapes[name] += list(shard[name + "_shapes"])
+                # only reads the header of the array
+                dtypes[name].append(_npz_dtype(shard, name))
+
+    order = np.argsort(keys, kind="stable")
+    index = {"keys": np.array(keys)[order] if len(keys) > 0 else np.array([], dtype=str)}
+    for param, value in klbasis_params.items():
+        index['klparam_' + param] = np.asarray(value)
+
+    # position of each image in the packed arrays
+    packed = {}
+    offsets = {}
+    for name in _klbasis_names:
+        name_shapes = [tuple(shape) for shape in shapes[name]]
+        sizes = np.array([int(np.prod(shape)) for shape in name_shapes], dtype=np.int64)[order]
+        offsets[name] = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        index[name + '_dict_offsets'] = offsets[name]
+        index[name + '_dict_shapes'] = np.array([name_shapes[i] for i in order], dtype=np.int64)
+        dtype = np.result_type(*dtypes[name]) if len(dtypes[name]) > 0 else float
+        packed[name] = np.lib.format.open_memmap(os.path.join(dirname, name + "_dict.npy"), mode='w+', dtype=dtype,
+                                                 shape=(int(offsets[name][-1]),))
+
+    # copy the shards in
+    packed_position = np.empty(len(keys), dtype=np.int64)
+    packed_position[order] = np.arange(len(keys))
+    shard_ends = shard_starts[1:] + [len(keys)]
+    for shard_file, shard_start, shard_end in zip(shard_files, shard_starts, shard_ends):
+        with np.load(shard_file) as shard:
+            for name in _klbasis_names:
+                values = shard[name]
+                start = 0
+                for position in packed_position[shard_start:shard_end]:
+                    packed_start, packed_end = offsets[name][position], offsets[name][position + 1]
+                    packed[name][packed_start:packed_end] = values[start:start + packed_end - packed_start]
+                    start += packed_end - packed_start
+                del values
+
+    for name in _klbasis_names:
+        packed[name].flush()
+    del packed
+    np.savez(os.path.join(dirname, "index.npz"), **index)
+    shutil.rmtree(shard_dir)
+
+
+def _npz_dtype(npz_file, name):
+    """
+    Data type of an array in an .npz file, without reading the array
+
+    Args:
+        npz_file: opened np.load() of the .npz file
+        name: name of the array
+
+    Returns:
+        numpy dtype
+    """
+    with npz_file.zip.open(name + ".npy") as array_file:
+        version = np.lib.format.read_magic(array_file)
+        if version == (1, 0):
+            _, _, dtype = np.lib.format.read_array_header_1_0(array_file)
+        else:
+            _, _, dtype = np.lib.format.read_array_header_2_0(array_file)
+    return dtype
+
+
+# quantities saved for each science image in each sector
+_klbasis_names = ["klmodes", "evals", "evecs", "klipped", "ref_psfs_indicies", "covar_files", "rdi_psfs"]
+
+
+def _save_packed_kl_basis(dic, dirname):
+    """
+    Saving the KL basis dictionnary (same structure as the one saved in h5) in a
+    directory of a few contiguous arrays that can be memory-mapped:
+        * for each dictionnary of arrays per section/image (klmodes, evecs, ...),
+          the raveled arrays are concatenated in <name>.npy
+        * each set of aligned images is saved in aligned_images_<wl key>.npy
+        * index.npz contains the keys, the offsets and shapes of the arrays in the
+          concatenated arrays, the scalar parameters per section/image and the
+          klparam_dict
+
+    Args:
+        dic: the dictionnary of the KL basis (see DiskFM.save_kl_basis)
+        dirname: the name of the directory where it will be saved
+
+    Returns:
+        None
+
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    index = {}
+    keys = sorted(dic['klmodes_dict'].keys())
+    index['keys'] = np.array(keys)
+
+    for name, values in dic.items():
+        if name == 'aligned_images_dict':
+            wl_keys = sorted(values.keys())
+            index['aligned_images_keys'] = np.array(wl_keys)
+            for wl_key in wl_keys:
+                np.save(os.path.join(dirname, "aligned_images_{0}.npy".format(wl_key)),
+                        np.asarray(values[wl_key]))
+        elif name == 'klparam_dict':
+            for param, value in values.items():
+                index['klparam_' + param] = np.asarray(value)
+        elif all(np.ndim(values[key]) == 0 for key in keys):
+            # one scalar per section/image
+            index[name] = np.array([values[key] for key in keys])
+        else:
+            arrays = [np.asarray(values[key]) for key in keys]
+            sizes = np.array([array.size for array in arrays], dtype=np.int64)
+            index[name + '_offsets'] = np.concatenate([[0], np.cumsum(sizes)])
+            index[name + '_shapes'] = np.array([array.shape for array in arrays],
+                                               dtype=np.int64)
+            np.save(os.path.join(dirname, name + ".npy"),
+                    np.concatenate([np.ravel(array) for array in arrays]))
+
+    np.savez(os.path.join(dirname, "index.npz"), **index)
+
+
+def _load_packed_kl_basis(dirname):
+    """
+    Load the KL basis dictionnary saved with _save_packed_kl_basis. The arrays are
+    memory-mapped (read only) and the arrays of each section/image are views into
+    them, so nothing is read before it is used and forked processes share the same
+    copy of the KL basis.
+
+    Args:
+        dirname: the name of the directory of the KL basis
+
+    Returns:
+        the dictionnary of the KL basis (same structure as the one that was saved)
+
+    """
+    with np.load(os.path.join(dirname, "index.npz")) as index_file:
+        index = dict(index_file)
+
+    keys = [str(key) for key in index.pop('keys')]
+    dic = {'aligned_images_dict': {}, 'klparam_dict': {}}
+
+    for wl_key in index.pop('aligned_images_keys', []):
+        wl_key = str(wl_key)
+        dic['aligned_images_dict'][wl_key] = np.load(
+            os.path.join(dirname, "aligned_images_{0}.npy".format(wl_key)),
+            mmap_mode='r')
+
+    for name in list(index.keys()):
+        if name.startswith('klparam_'):
+            value = index.pop(name)
+            dic['klparam_dict'][name[len('klparam_'):]] = value[()] if value.ndim == 0 else value
+
+    for name in sorted(index.keys()):
+        if name.endswith('_offsets'):
+            name = name[:-len('_offsets')]
+            offsets = index[name + '_offsets']
+            shapes = index[name + '_shapes']
+            packed = np.load(os.path.join(dirname, name + ".npy"), mmap_mode='r')
+            dic[name] = {
+                key: packed[offsets[i]:offsets[i + 1]].reshape(shapes[i])
+                for i, key in enumerate(keys)
+            }
+        elif not name.endswith('_shapes'):
+            dic[name] = {key: index[name][i] for i, key in enumerate(keys)}
+
+    return dic
+
+
 def klip_dataset(dataset, fm_class, mode="ADI+SDI", outputdir=".", fileprefix="pyklipfm", annuli=5, subsections=4,
                  OWA=None, N_pix_sector=None, movement=None, flux_overlap=0.1, PSF_FWHM=3.5, minrot=0, padding=0,
                  numbasis=None, maxnumbasis=None, numthreads=None, corr_smooth=1, calibrate_flux=False, aligned_center=None, 
                  psf_library=None, spectrum=None, highpass=False, annuli_spacing="constant", save_klipped=True, 
-                 mute_progression=False, time_collapse="mean"):
+                 mute_progression=False, time_collapse="mean", batch_size=None, save_klbasis=None, klbasis=None):
     """
     Run KLIP-FM on a dataset object
 
@@ -1845,6 +2710,13 @@ def klip_dataset(dataset, fm_class, mode="ADI+SDI", outputdir=".", fileprefix="p
                         doesn't work and one ends up with thousands of printed lines. Therefore muting it can be a good
                         idea.
         time_collapse:  how to collapse the data in time. Currently support: "mean", "weighted-mean"
+        batch_size:     number of science images of the same wavelength processed together by one task in each
+                        sector (see klip_parallelized). If None, picks it based on numthreads.
+        save_klbasis:   if not None, name of a directory where to save the KL basis of each image in each sector, so
+                        that running other FM classes on this dataset with the same KLIP parameters can reuse it
+                        (see klip_parallelized)
+        klbasis:        if not None, name of a directory where a KL basis was saved with save_klbasis by a previous run
+                        on this dataset with the same KLIP parameters. Only the forward modelling is then computed.
 
     """
 
@@ -1966,7 +2838,8 @@ def klip_dataset(dataset, fm_class, mode="ADI+SDI", outputdir=".", fileprefix="p
                                      minrot=minrot, spectrum=spectra_template, padding=padding, save_klipped=True,
                                      flipx=dataset.flipx, annuli_spacing=annuli_spacing,
                                      psf_library=master_library, psf_library_good=rdi_good_psfs, psf_library_corr=rdi_corr_matrix,
-                                     N_pix_sector=N_pix_sector, mute_progression=mute_progression, compute_noise_cube=weighted)
+                                     N_pix_sector=N_pix_sector, mute_progression=mute_progression, compute_noise_cube=weighted,
+                                     batch_size=batch_size, save_klbasis=save_klbasis, klbasis=klbasis)
 
     klipped, fmout, perturbmag, klipped_center, stddev_frames = klip_outputs # images are already rotated North up East left
 
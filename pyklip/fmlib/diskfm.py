@@ -1,19 +1,20 @@
 # pylint: disable=C0103
 from sys import version_info
-from os import path
+from os import path, makedirs
 import multiprocessing as mp
-from copy import deepcopy
 import ctypes
+import copy
+import weakref
 
 import pickle
 import h5py
 
 import numpy as np
 import scipy.ndimage as ndimage
+import scipy.sparse as sparse
 
 from pyklip.fmlib.nofm import NoFM
 import pyklip.fm as fm
-from pyklip.klip import rotate
 
 # define the global variables for that code
 class DiskFM(NoFM):
@@ -33,10 +34,15 @@ class DiskFM(NoFM):
                      parameters to "prepare" first inital model.
             model_disk: a model of the disk of size (wvs, x, y) or (x, y)
             basis_filename: filename to save and load the KL basis. Filenames can haves
-                            2 recognizable extensions: .h5 or .pkl. We strongly
-                            recommand .h5 as pickle have problem of compatibility
-                            between python 2 and 3 and sometimes between computer
-                            (e.g. KL modes not readable on another computer)
+                            3 recognizable extensions: .h5, .pkl or .klbasis. We strongly
+                            recommand .h5 or .klbasis as pickle have problem of
+                            compatibility between python 2 and 3 and sometimes between
+                            computer (e.g. KL modes not readable on another computer).
+                            .klbasis is a directory of a few contiguous arrays that are
+                            memory-mapped when loaded, which is much faster to load for
+                            large KL basis. A basis loaded from any format can be
+                            converted by changing basis_filename and calling
+                            save_kl_basis().
             load_from_basis: if True, load the KL basis at basis_filename. It only need
                              to be done once, after which you can measure FM with
                              only update_model()
@@ -59,6 +65,17 @@ class DiskFM(NoFM):
             subsections: deprecated parameter, ignored here and defined
                          in fm.klip_dataset
             numthreads: deprecated parameter. All centering are done in fm.klip_dataset 
+            cache_rotation_operators: if True, the operators that rotate the models to
+                            the PAs of the images are saved next to basis_filename
+                            (as *_rotation_operators.npz) and loaded from there in
+                            the next runs with the same PAs and aligned_center.
+            precompute_fm_operators: if True (in "Load Basis mode"), the linear operators
+                            that map the rotated models of each section to its FM
+                            (see fm.linear_fm_operator) are computed once when the
+                            KL basis is loaded. fm_parallelized() and fm_batch() then
+                            only do a few matrix products per section, which is
+                            faster when evaluating many models (e.g. in an MCMC), at
+                            the cost of about twice the memory of the KL modes.
 
         Returns:
             A DiskFM Object
@@ -78,7 +95,9 @@ class DiskFM(NoFM):
                  mode=None,
                  annuli=None,
                  subsections=None,
-                 numthreads=None):
+                 numthreads=None,
+                 cache_rotation_operators=False,
+                 precompute_fm_operators=False):
         """
 
             Initilaizes the DiskFM class
@@ -132,6 +151,13 @@ class DiskFM(NoFM):
 
         self.data_type = ctypes.c_double
 
+        # persistent pool of processes for fm_parallelized (see _get_fm_pool)
+        self._fm_pool = None
+        self._fm_pool_finalizer = None
+        self._fm_pool_numthreads = None
+        self._model_disks_shared = None
+        self._fmout_shared = None
+
         self.basis_filename = basis_filename
         self.save_basis = save_basis
         self.load_from_basis = load_from_basis
@@ -197,9 +223,38 @@ class DiskFM(NoFM):
             # define the center
             self.aligned_center = aligned_center
 
+        # sparse operators to rotate the models to each PA (see _get_rotation_operators)
+        self._rotation_operators = None
+        if cache_rotation_operators and self.basis_filename:
+            self.rotation_operators_filename = path.splitext(
+                self.basis_filename)[0] + "_rotation_operators.npz"
+        else:
+            self.rotation_operators_filename = None
+
+        # linear FM operators of each section (see _build_fm_operators)
+        self._fm_operators = None
+        if precompute_fm_operators and self.load_from_basis:
+            self._build_fm_operators()
+
         # Prepare the first disk for FM
         self.update_disk(model_disk)
 
+    def __getstate__(self):
+        """
+        The worker pool and its shared arrays cannot be pickled with the object (e.g.
+        when it is sent to the processes of fm.klip_parallelized), so we drop them.
+        The rotation operators are also dropped as they are only needed to update the
+        disk and are rebuilt if necessary.
+        """
+        state = self.__dict__.copy()
+        state['_rotation_operators'] = None
+        state['_fm_pool'] = None
+        state['_fm_pool_finalizer'] = None
+        state['_fm_pool_numthreads'] = None
+        state['_model_disks_shared'] = None
+        state['_fmout_shared'] = None
+        return state
+
     def update_disk(self, model_disk):
         """
         Takes model disk and rotates it to the PAs of the input images for use as
@@ -216,8 +271,6 @@ class DiskFM(NoFM):
             None
         """
 
-        self.model_disks = np.zeros(self.inputs_shape)
-
         # Extract the # of WL per files
         n_wv_per_file = self.nwvs  # Number of wavelenths per file.
 
@@ -228,7 +281,6 @@ class DiskFM(NoFM):
             # in that case we repeat this model at each WL
             self.model_disk = np.broadcast_to(model_disk, (n_wv_per_file, ) +
                                               model_disk.shape)
-            model_disk_shape = np.shape(model_disk)
         else:
             # This is either a multi WL 3D model in a multi-wl 3D data
             # or a single WL 3D model in a single-wl 2D data, we do nothing
@@ -244,34 +296,13 @@ class DiskFM(NoFM):
                     """Number of wls in disk model ({0}) don't match number of wls in
                     the data ({1})""".format(n_model_wvs, n_wv_per_file))
 
-            for k in np.arange(self.nfiles):
-                for j, _ in enumerate(range(n_model_wvs)):
-                    model_copy = deepcopy(model_disk[j, :, :])
-                    model_copy = rotate(
-                        model_copy,
-                        self.PAs[k * n_wv_per_file + j],
-                        self.aligned_center,
-                        flipx=True,
-                    )
-                    model_copy[np.where(np.isnan(model_copy))] = 0.0
-                    self.model_disks[k * n_wv_per_file + j, :, :] = model_copy
-
-        else:  # This is a 2D disk model and a wl = 1 case
-
-            for i, pa_here in enumerate(self.PAs):
-                model_copy = deepcopy(model_disk)
-                model_copy = rotate(model_copy,
-                                    pa_here,
-                                    self.aligned_center,
-                                    flipx=True)
-                model_copy[np.where(np.isnan(model_copy))] = 0.0
-                self.model_disks[i] = model_copy
-
-        self.model_disks = np.reshape(
-            self.model_disks,
-            (self.inputs_shape[0],
-             self.inputs_shape[1] * self.inputs_shape[2]),
-        )
+            models = np.asarray(model_disk, dtype=float)[None, :, :, :]
+
+        else:  # This is a 2D disk model, used for all the wls
+            models = np.asarray(model_disk, dtype=float)[None, None, :, :]
+
+        # rotated models of shape (N, y*x)
+        self.model_disks = self._rotate_models(models)[0]
 
     def alloc_fmout(self, output_img_shape):
         """Allocates shared memory for the output of the shared memory
@@ -452,7 +483,7 @@ class DiskFM(NoFM):
             self.klparam_dict['OWA'] = float(OWA)
 
             self.klparam_dict['input_img_shape'] = np.array(input_img_shape, dtype=float)
-            self.klparam_dict['numbasis'] = float(numbasis)
+            self.klparam_dict['numbasis'] = np.array(numbasis, dtype=float)
             self.klparam_dict['output_imgs_shape'] = np.array(output_img_shape, dtype=float)
 
             # To have a single identifier for each set of aligned images,
@@ -645,9 +676,9 @@ class DiskFM(NoFM):
 
             pickle.dump(dict(klparam_dict), pkl_file, protocol=2)
 
-        elif file_extension == ".h5":
+        elif file_extension in (".h5", ".klbasis"):
             # transform mp dicts to normal dicts
-            # make a single dictionnary and save in h5
+            # make a single dictionnary and save in h5 (or in packed arrays)
 
             saving_in_h5_dict = {
                 'aligned_images_dict': dict(self.aligned_images_dict),
@@ -664,14 +695,17 @@ class DiskFM(NoFM):
                 'klparam_dict': dict(self.klparam_dict),
             }
 
-            _save_dict_to_hdf5(saving_in_h5_dict, self.basis_filename)
+            if file_extension == ".h5":
+                _save_dict_to_hdf5(saving_in_h5_dict, self.basis_filename)
+            else:
+                fm._save_packed_kl_basis(saving_in_h5_dict, self.basis_filename)
 
             del saving_in_h5_dict
 
         else:
             raise ValueError(file_extension +
                              """ is not a possible extension. Filenames can
-                haves 2 recognizable extension2: .h5 and .pkl""")
+                haves 3 recognizable extension2: .h5, .pkl and .klbasis""")
 
     def load_basis_files(self, psf_library=None, kl_basis_file=None):
         """
@@ -686,11 +720,17 @@ class DiskFM(NoFM):
         Returns:
             None
         """
+        # the processes of fm_parallelized hold the previous KL basis
+        self.close_pool()
+
         if kl_basis_file is not None:
             file_extension = ""
         else:
             _, file_extension = path.splitext(self.basis_filename)
-        manager = mp.Manager()
+
+        # The loaded KL basis is only read, so we keep it in plain dictionnaries
+        # rather than multiprocessing manager dicts: every access to a manager dict
+        # goes through a proxy that sends a copy of the array between processes.
 
         # Load in file
         if file_extension == ".pkl":
@@ -698,48 +738,48 @@ class DiskFM(NoFM):
             if version_info.major == 3:
                 # Using encoding='latin1' is required for unpickling NumPy arrays
                 # and instances of datetime, date and time pickled by Python 2.
-                self.aligned_images_dict = manager.dict(
+                self.aligned_images_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
 
-                self.klmodes_dict = manager.dict(
+                self.klmodes_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
-                self.evecs_dict = manager.dict(
+                self.evecs_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
-                self.evals_dict = manager.dict(
+                self.evals_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
-                self.ref_psfs_indicies_dict = manager.dict(
+                self.ref_psfs_indicies_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
-                self.section_ind_dict = manager.dict(
+                self.section_ind_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
 
-                self.radstart_dict = manager.dict(
+                self.radstart_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
-                self.radend_dict = manager.dict(
+                self.radend_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
-                self.phistart_dict = manager.dict(
+                self.phistart_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
-                self.phiend_dict = manager.dict(
+                self.phiend_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
-                self.input_img_num_dict = manager.dict(
+                self.input_img_num_dict = dict(
                     pickle.load(pkl_file, encoding="latin1"))
 
                 self.klparam_dict = pickle.load(pkl_file, encoding="latin1")
 
             else:
-                self.aligned_images_dict = manager.dict(pickle.load(pkl_file))
+                self.aligned_images_dict = dict(pickle.load(pkl_file))
 
-                self.klmodes_dict = manager.dict(pickle.load(pkl_file))
-                self.evecs_dict = manager.dict(pickle.load(pkl_file))
-                self.evals_dict = manager.dict(pickle.load(pkl_file))
-                self.ref_psfs_indicies_dict = manager.dict(
+                self.klmodes_dict = dict(pickle.load(pkl_file))
+                self.evecs_dict = dict(pickle.load(pkl_file))
+                self.evals_dict = dict(pickle.load(pkl_file))
+                self.ref_psfs_indicies_dict = dict(
                     pickle.load(pkl_file))
-                self.section_ind_dict = manager.dict(pickle.load(pkl_file))
+                self.section_ind_dict = dict(pickle.load(pkl_file))
 
-                self.radstart_dict = manager.dict(pickle.load(pkl_file))
-                self.radend_dict = manager.dict(pickle.load(pkl_file))
-                self.phistart_dict = manager.dict(pickle.load(pkl_file))
-                self.phiend_dict = manager.dict(pickle.load(pkl_file))
-                self.input_img_num_dict = manager.dict(pickle.load(pkl_file))
+                self.radstart_dict = dict(pickle.load(pkl_file))
+                self.radend_dict = dict(pickle.load(pkl_file))
+                self.phistart_dict = dict(pickle.load(pkl_file))
+                self.phiend_dict = dict(pickle.load(pkl_file))
+                self.input_img_num_dict = dict(pickle.load(pkl_file))
 
                 self.klparam_dict = pickle.load(pkl_file)
 
@@ -747,22 +787,24 @@ class DiskFM(NoFM):
 
             if file_extension == ".h5":
                 kl_basis_file = _load_dict_from_hdf5(self.basis_filename)
+            elif file_extension == ".klbasis":
+                kl_basis_file = fm._load_packed_kl_basis(self.basis_filename)
 
-        self.aligned_images_dict = manager.dict(
+        self.aligned_images_dict = dict(
             kl_basis_file['aligned_images_dict'])
 
-        self.klmodes_dict = manager.dict(kl_basis_file['klmodes_dict'])
-        self.evecs_dict = manager.dict(kl_basis_file['evecs_dict'])
-        self.evals_dict = manager.dict(kl_basis_file['evals_dict'])
-        self.ref_psfs_indicies_dict = manager.dict(
+        self.klmodes_dict = dict(kl_basis_file['klmodes_dict'])
+        self.evecs_dict = dict(kl_basis_file['evecs_dict'])
+        self.evals_dict = dict(kl_basis_file['evals_dict'])
+        self.ref_psfs_indicies_dict = dict(
             kl_basis_file['ref_psfs_indicies_dict'])
-        self.section_ind_dict = manager.dict(kl_basis_file['section_ind_dict'])
+        self.section_ind_dict = dict(kl_basis_file['section_ind_dict'])
 
-        self.radstart_dict = manager.dict(kl_basis_file['radstart_dict'])
-        self.radend_dict = manager.dict(kl_basis_file['radend_dict'])
-        self.phistart_dict = manager.dict(kl_basis_file['phistart_dict'])
-        self.phiend_dict = manager.dict(kl_basis_file['phiend_dict'])
-        self.input_img_num_dict = manager.dict(
+        self.radstart_dict = dict(kl_basis_file['radstart_dict'])
+        self.radend_dict = dict(kl_basis_file['radend_dict'])
+        self.phistart_dict = dict(kl_basis_file['phistart_dict'])
+        self.phiend_dict = dict(kl_basis_file['phiend_dict'])
+        self.input_img_num_dict = dict(
             kl_basis_file['input_img_num_dict'])
 
         self.klparam_dict = kl_basis_file['klparam_dict']
@@ -813,14 +855,22 @@ class DiskFM(NoFM):
         # we run self.fm_parallelize.
         self.save_basis = False
 
-    def fm_parallelized(self):
+    def fm_parallelized(self, numthreads=None):
         """
         Functions like fm.klip_dataset, but it uses previously measured KL modes,
         section positions, and klip parameter to return the forward modelling.
         Do not save fits.
 
+        If numthreads > 1, the sections are spread over a pool of processes. The pool
+        is created at the first call and kept alive for the next ones, with the loaded
+        KL basis already in each process, so that each new model (after
+        update_disk()) only costs the copy of the rotated models in shared memory.
+        Use close_pool() to terminate the processes. Otherwise, they are terminated
+        when the object is garbage collected, when a new KL basis is loaded, or at exit.
+
         Args:
-            None
+            numthreads: number of processes used to forward model the sections. If
+                        None or 1, the sections are forward modelled in this process.
 
         Returns:
             fmout_np, a numpy array, output of forward modelling
@@ -829,16 +879,6 @@ class DiskFM(NoFM):
 
         """
 
-        fmout_data, fmout_shape = self.alloc_fmout(self.output_imgs_shape)
-        fmout_np = fm._arraytonumpy(fmout_data,
-                                    fmout_shape,
-                                    dtype=self.data_type)
-        # this line is added to be able to use fm._save_rotated_section
-        # which uses global var outputs_shape
-        fm.outputs_shape = self.output_imgs_shape
-
-        wvs = self.wvs
-
         if self.isRDI:
             mode = 'RDI'
         else:
@@ -847,43 +887,22 @@ class DiskFM(NoFM):
             # if not we don't care since it does not have an
             # impact at this point
 
-        for key in self.dict_keys:  # loop pver the sections/images
+        if numthreads is None or numthreads <= 1:
+            fmout_data, fmout_shape = self.alloc_fmout(self.output_imgs_shape)
+            fmout_np = fm._arraytonumpy(fmout_data,
+                                        fmout_shape,
+                                        dtype=self.data_type)
+            # this line is added to be able to use fm._save_rotated_section
+            # which uses global var outputs_shape
+            fm.outputs_shape = self.output_imgs_shape
 
-            img_num = self.input_img_num_dict[key]
+            for key in self.dict_keys:  # loop pver the sections/images
+                self._fm_from_basis(key, fmout_np, mode)
 
-            # To have a single identifier for each set of aligned images,
-            # we save the wavelenght in nm
-            wl_here = wvs[img_num]
-            wlstr = 'wl' + str(int(wl_here * 1000)).zfill(4)
-
-            # in load mode, we do not pass aligned_images_dict
-            # because it is already in the class to
-            # save memory
-            self.fm_from_eigen(
-                klmodes=self.klmodes_dict[key],
-                evals=self.evals_dict[key],
-                evecs=self.evecs_dict[key],
-                input_img_shape=[self.inputs_shape[1], self.inputs_shape[2]],
-                output_img_shape=self.output_imgs_shape,
-                input_img_num=img_num,
-                ref_psfs_indicies=self.ref_psfs_indicies_dict[key],
-                section_ind=self.section_ind_dict[key],
-                radstart=self.radstart_dict[key],
-                radend=self.radend_dict[key],
-                phistart=self.phistart_dict[key],
-                phiend=self.phiend_dict[key],
-                padding=0.0,
-                IOWA=(self.IWA, self.OWA),
-                ref_center=self.aligned_center,
-                parang=self.PAs[img_num],
-                numbasis=self.numbasis,
-                fmout=fmout_np,
-                mode=mode)
+        else:
+            fmout_np = self._fm_parallelized_pool(numthreads, mode)
 
         # put any finishing touches on the FM Output
-        fmout_np = fm._arraytonumpy(fmout_data,
-                                    fmout_shape,
-                                    dtype=self.data_type)
         fmout_np = self.cleanup_fmout(fmout_np)
 
         # Check if we have a disk model at multiple wavelengths.
@@ -913,6 +932,594 @@ class DiskFM(NoFM):
 
         return fmout_return
 
+    def fm_batch(self, models):
+        """
+        Forward models a stack of K disk models at once with the loaded KL basis (e.g.
+        the models of all the walkers of an MCMC step). Gives the same results as
+        calling update_disk() and fm_parallelized() for each model, but the models are
+        rotated to each PA in one interpolation, and the perturbation of the KL modes
+        and the projections are computed with K right-hand sides for each section.
+        update_disk() is not needed and the disk model of the object is not changed.
+
+        Args:
+            models: stack of K disk models, of shape (K, y, x) or (K, wvs, y, x).
+                    Like in update_disk, a 2D model is used for all wavelengths.
+
+        Returns:
+            fmout_np, a numpy array, output of forward modelling of each model
+                    * if N_wl = 1, size is [K,n_KL,x,y]
+                    * if N_wl > 1, size is  [K,n_KL,N_wl,x,y]
+
+        """
+        models = np.asarray(models, dtype=float)
+        n_wv_per_file = self.nwvs  # Number of wavelenths per file.
+
+        # as in update_disk and fm_parallelized, the output is kept per wavelength
+        # if either the models or the data are multiWL
+        collapse_wvs = (models.ndim > 3) or (n_wv_per_file > 1)
+
+        if models.ndim == 3:
+            models = models[:, None, :, :]
+        elif models.shape[1] != n_wv_per_file:
+            # Both models and data are multiWL, but not the same number of WLs !
+            raise ValueError(
+                """Number of wls in disk model ({0}) don't match number of wls in
+                the data ({1})""".format(models.shape[1], n_wv_per_file))
+
+        nmodels = models.shape[0]
+        model_disks = self._rotate_models(models)  # (K, N, y*x)
+
+        input_img_shape = [self.inputs_shape[1], self.inputs_shape[2]]
+        nchannels = n_wv_per_file if collapse_wvs else 1
+        fmout_sum = np.zeros((nmodels, nchannels, np.size(self.numbasis),
+                              self.inputs_shape[1] * self.inputs_shape[2]))
+
+        for key in self.dict_keys:  # loop over the sections/images
+            img_num = self.input_img_num_dict[key]
+            section_ind = self.section_ind_dict[key]
+            ref_psfs_indicies = self.ref_psfs_indicies_dict[key]
+            klmodes = self.klmodes_dict[key]
+
+            wlstrkey = 'wl' + str(int(self.wvs[img_num] * 1000)).zfill(4)
+            aligned_imgs = self.aligned_images_dict[wlstrkey]
+            sci = aligned_imgs[img_num, section_ind[0]]
+
+            model_sci = model_disks[:, img_num, section_ind[0]]
+            model_ref = model_disks[:, ref_psfs_indicies[:, None],
+                                    section_ind[0][None, :]]
+
+            if self._fm_operators is not None:
+                postklip_psf = fm.apply_linear_fm_operator(
+                    self._fm_operators[key], model_sci,
+                    None if self.isRDI else model_ref)
+            else:
+                if self.isRDI:
+                    # only over-subtraction in RDI
+                    delta_KL = np.zeros((nmodels, ) + klmodes.shape)
+                else:
+                    refs = aligned_imgs[ref_psfs_indicies, :][:, section_ind[0]]
+                    delta_KL = fm.perturb_specIncluded_batch(self.evals_dict[key],
+                                                             self.evecs_dict[key],
+                                                             klmodes, refs, model_ref)
+
+                postklip_psf, _, _ = fm.calculate_fm_batch(
+                    delta_KL, klmodes, self.numbasis,
+                    np.broadcast_to(sci, model_sci.shape), model_sci)
+
+            # derotate the FM of all the models and KL cutoffs together
+            out_pix, rot_sectors = fm._rotate_sections(
+                input_img_shape,
+                np.reshape(postklip_psf, (-1, postklip_psf.shape[-1])),
+                section_ind,
+                self.PAs[img_num],
+                self.radstart_dict[key],
+                self.radend_dict[key],
+                self.phistart_dict[key],
+                self.phiend_dict[key],
+                0.0,
+                (self.IWA, self.OWA),
+                self.aligned_center,
+                flipx=True)
+            rot_sectors[np.isnan(rot_sectors)] = 0
+            channel = img_num % n_wv_per_file if collapse_wvs else 0
+            fmout_sum[:, channel][:, :, out_pix] += np.reshape(
+                rot_sectors, (nmodels, -1, out_pix.size))
+
+        fmout_sum = np.reshape(fmout_sum, (
+            nmodels,
+            nchannels,
+            np.size(self.numbasis),
+            self.inputs_shape[1],
+            self.inputs_shape[2],
+        ))
+        if collapse_wvs:
+            # mean over the files, keeping the wavelengths intact
+            return np.swapaxes(fmout_sum, 1, 2) / float(self.nfiles)
+        else:
+            # mean over all the images
+            return fmout_sum[:, 0] / float(self.inputs_shape[0])
+
+    def _rotate_models(self, models):
+        """
+        Rotates a stack of disk models to the PAs of the input images, as
+        klip.rotate(flipx=True) about the aligned_center. The cubic spline coefficients
+        of each model are computed once, and are then interpolated at the rotated
+        coordinates of each PA by a precomputed sparse operator.
+
+        Args:
+            models: stack of disk models of shape (K, wvs, y, x), with wvs either 1 or
+                    the number of wavelengths per file.
+
+        Returns:
+            model_disks: rotated models, array of shape (K, N, y*x). Pixels that are
+                        NaN after the rotation (outside of the image or next to a NaN)
+                        are set to 0.
+        """
+        nmodels, n_model_wvs, ny, nx = models.shape
+        operators = self._get_rotation_operators()
+
+        # NaN are set to the median of each model to compute the spline coefficients
+        # (as in klip.nan_map_coordinates_2d), and to 0 after the rotation
+        nan_models = np.isnan(models)
+        has_nans = np.any(nan_models)
+        if has_nans:
+            models = np.copy(models)
+            for model, nan_model in zip(models.reshape((-1, ny, nx)),
+                                        nan_models.reshape((-1, ny, nx))):
+                if np.any(nan_model) and not np.all(nan_model):
+                    model[nan_model] = np.nanmedian(model)
+            nan_models = nan_models.reshape((nmodels, n_model_wvs, ny * nx))
+
+        spline_coeffs = ndimage.spline_filter1d(models, order=3, axis=2,
+                                                output=np.float64, mode="constant")
+        spline_coeffs = ndimage.spline_filter1d(spline_coeffs, order=3, axis=3,
+                                                output=np.float64, mode="constant")
+        spline_coeffs = spline_coeffs.reshape((nmodels, n_model_wvs, ny * nx))
+
+        model_disks = np.zeros((nmodels, self.inputs_shape[0], ny * nx))
+        for i, pa_here in enumerate(self.PAs):
+            channel = i % n_model_wvs
+            model_disks[:, i] = (operators[float(pa_here)] @
+                                 spline_coeffs[:, channel].T).T
+
+            if has_nans:
+                # the model is NaN (so 0) next to a NaN pixel
+                probe_pix = _rotation_probe_pix((ny, nx), pa_here,
+                                                self.aligned_center)
+                rotnans = np.any(nan_models[:, channel][:, probe_pix], axis=1)
+                model_disks[:, i][rotnans] = 0
+
+        # only happens if a model is all NaNs
+        model_disks[np.isnan(model_disks)] = 0
+
+        return model_disks
+
+    def _get_rotation_operators(self):
+        """
+        Gets the sparse operators that rotate the spline coefficients of a model to
+        each unique PA of the images. They only depend on the PAs, the aligned_center
+        and the image shape, so they are computed once for the object (or loaded from
+        rotation_operators_filename if it matches).
+
+        Args:
+            None
+
+        Returns:
+            dict of the CSR operators of shape (y*x, y*x), with the PAs as keys
+        """
+        if self._rotation_operators is not None:
+            return self._rotation_operators
+
+        shape = (int(self.inputs_shape[1]), int(self.inputs_shape[2]))
+        pas = np.unique(np.asarray(self.PAs, dtype=float))
+
+        operators = None
+        if self.rotation_operators_filename is not None and path.exists(
+                self.rotation_operators_filename):
+            operators = _load_rotation_operators(self.rotation_operators_filename,
+                                                 shape, pas, self.aligned_center)
+        if operators is None:
+            operators = {}
+            for pa_here in pas:
+                operators[float(pa_here)] = _rotation_operator(
+                    shape, pa_here, self.aligned_center)
+            if self.rotation_operators_filename is not None:
+                _save_rotation_operators(self.rotation_operators_filename,
+                                         operators, shape, self.aligned_center)
+
+        self._rotation_operators = operators
+        return operators
+
+    def _build_fm_operators(self):
+        """
+        Precomputes the linear FM operator of each section/image of the loaded KL
+        basis (see fm.linear_fm_operator)
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self._fm_operators = {}
+        for key in self.dict_keys:
+            img_num = self.input_img_num_dict[key]
+            section_ind = self.section_ind_dict[key]
+            wlstrkey = 'wl' + str(int(self.wvs[img_num] * 1000)).zfill(4)
+            aligned_imgs = self.aligned_images_dict[wlstrkey]
+
+            self._fm_operators[key] = fm.linear_fm_operator(
+                self.evals_dict[key],
+                self.evecs_dict[key],
+                self.klmodes_dict[key],
+                aligned_imgs[self.ref_psfs_indicies_dict[key], :][:, section_ind[0]],
+                self.numbasis,
+                aligned_imgs[img_num, section_ind[0]],
+            )
+
+    def _fm_from_basis(self, key, fmout_np, mode):
+        """
+        Forward models the disk for one section/image of the loaded KL basis
+
+        Args:
+            key: key of the section/image in the KL basis dictionnaries
+            fmout_np: numpy output array for FM output. Shape is (N, y, x, b)
+            mode: 'RDI' if the KL basis was measured in RDI only, None otherwise
+
+        Returns:
+            None
+        """
+        img_num = self.input_img_num_dict[key]
+
+        if self._fm_operators is not None:
+            section_ind = self.section_ind_dict[key]
+            model_sci = self.model_disks[img_num, section_ind[0]][None, :]
+            if mode == 'RDI':
+                # only over-subtraction in RDI
+                model_ref = None
+            else:
+                model_ref = self.model_disks[self.ref_psfs_indicies_dict[key], :]
+                model_ref = model_ref[:, section_ind[0]][None, :, :]
+            postklip_psf = fm.apply_linear_fm_operator(self._fm_operators[key],
+                                                       model_sci, model_ref)[0]
+
+            for thisnumbasisindex in range(np.size(self.numbasis)):
+                fm._save_rotated_section(
+                    [self.inputs_shape[1], self.inputs_shape[2]],
+                    postklip_psf[thisnumbasisindex],
+                    section_ind,
+                    fmout_np[img_num, :, :, thisnumbasisindex],
+                    None,
+                    self.PAs[img_num],
+                    self.radstart_dict[key],
+                    self.radend_dict[key],
+                    self.phistart_dict[key],
+                    self.phiend_dict[key],
+                    0.0,
+                    (self.IWA, self.OWA),
+                    self.aligned_center,
+                    flipx=True)
+            return
+
+        # in load mode, we do not pass aligned_images_dict
+        # because it is already in the class to
+        # save memory
+        self.fm_from_eigen(
+            klmodes=self.klmodes_dict[key],
+            evals=self.evals_dict[key],
+            evecs=self.evecs_dict[key],
+            input_img_shape=[self.inputs_shape[1], self.inputs_shape[2]],
+            output_img_shape=self.output_imgs_shape,
+            input_img_num=img_num,
+            ref_psfs_indicies=self.ref_psfs_indicies_dict[key],
+            section_ind=self.section_ind_dict[key],
+            radstart=self.radstart_dict[key],
+            radend=self.radend_dict[key],
+            phistart=self.phistart_dict[key],
+            phiend=self.phiend_dict[key],
+            padding=0.0,
+            IOWA=(self.IWA, self.OWA),
+            ref_center=self.aligned_center,
+            parang=self.PAs[img_num],
+            numbasis=self.numbasis,
+            fmout=fmout_np,
+            mode=mode)
+
+    def _get_fm_pool(self, numthreads):
+        """
+        Starts the pool of processes used by fm_parallelized, unless one with the same
+        number of processes is already running. The processes get this object (and so
+        the loaded KL basis) once, when they start, and share with this process the
+        arrays of the rotated disk models and of the FM output.
+
+        Args:
+            numthreads: number of processes
+
+        Returns:
+            None
+        """
+        if self._fm_pool is not None and self._fm_pool_numthreads == numthreads:
+            return
+
+        self.close_pool()
+
+        model_disks_shape = self.model_disks.shape
+
+        model_disks_shared = mp.Array(self.data_type,
+                                      int(np.prod(model_disks_shape)))
+        fmout_shared, fmout_shape = self.alloc_fmout(self.output_imgs_shape)
+
+        # the pool keeps its initargs: give it a copy (sharing the KL basis) so that it
+        # does not keep this object alive and the finalizer below can run
+        self._fm_pool = mp.Pool(processes=numthreads,
+                                initializer=_tpool_init,
+                                initargs=(copy.copy(self), model_disks_shared,
+                                          model_disks_shape, fmout_shared,
+                                          fmout_shape),
+                                maxtasksperchild=None)
+        # terminate the processes if the object goes away without close_pool()
+        self._fm_pool_finalizer = weakref.finalize(self, _close_fm_pool,
+                                                   self._fm_pool)
+        self._fm_pool_numthreads = numthreads
+        self._model_disks_shared = model_disks_shared
+        self._fmout_shared = fmout_shared
+
+    def _fm_parallelized_pool(self, numthreads, mode):
+        """
+        Forward models all the sections/images of the loaded KL basis with the pool of
+        processes. All the sections of one image are done by the same process.
+
+        Args:
+            numthreads: number of processes
+            mode: 'RDI' if the KL basis was measured in RDI only, None otherwise
+
+        Returns:
+            fmout_np, numpy array of FM output. Shape is (N, y, x, b)
+        """
+        self._get_fm_pool(numthreads)
+
+        # send the current models to the processes
+        model_disks_np = fm._arraytonumpy(self._model_disks_shared,
+                                          self.model_disks.shape,
+                                          dtype=self.data_type)
+        model_disks_np[:] = self.model_disks
+
+        fmout_np = fm._arraytonumpy(self._fmout_shared,
+                                    self.output_imgs_shape,
+                                    dtype=self.data_type)
+        fmout_np[:] = 0
+
+        keys_per_img = {}
+        for key in self.dict_keys:
+            keys_per_img.setdefault(self.input_img_num_dict[key], []).append(key)
+        keys_per_img = list(keys_per_img.values())
+
+        # a few tasks per process to balance the load
+        numtasks = min(len(keys_per_img), 4 * numthreads)
+        tasks = []
+        for img_indices in np.array_split(np.arange(len(keys_per_img)), numtasks):
+            task_keys = [key for i in img_indices for key in keys_per_img[i]]
+            tasks.append(
+                self._fm_pool.apply_async(_fm_from_basis_keys,
+                                          args=(task_keys, mode)))
+        for task in tasks:
+            task.get()
+
+        return np.copy(fmout_np)
+
+    def close_pool(self):
+        """
+        Terminates the pool of processes started by fm_parallelized, if any.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        if self._fm_pool_finalizer is not None:
+            # closes the pool and unregisters the finalizer
+            self._fm_pool_finalizer()
+        self._fm_pool = None
+        self._fm_pool_finalizer = None
+        self._fm_pool_numthreads = None
+        self._model_disks_shared = None
+        self._fmout_shared = None
+
+
+def _close_fm_pool(pool):
+    """
+    Closes the pool of processes of DiskFM.fm_parallelized. Registered with
+    weakref.finalize, so it should not hold a reference to the DiskFM object.
+
+    Args:
+        pool: multiprocessing pool
+
+    Returns:
+        None
+    """
+    pool.close()
+    pool.join()
+
+
+def _tpool_init(diskfm_obj, model_disks, model_disks_shape, fmout, fmout_shape):
+    """
+    Initializer function for the processes of DiskFM.fm_parallelized. Sets the DiskFM
+    object (with its loaded KL basis) and the shared arrays as global variables.
+
+    Args:
+        diskfm_obj: DiskFM object in load basis mode
+        model_disks: shared memory array of the rotated disk models
+        model_disks_shape: shape of model_disks, (N, y*x)
+        fmout: shared memory array of the FM output
+        fmout_shape: shape of fmout, (N, y, x, b)
+
+    Returns:
+        None
+    """
+    global diskfm_worker, fmout_worker
+    diskfm_worker = diskfm_obj
+    diskfm_worker.model_disks = fm._arraytonumpy(model_disks,
+                                                 model_disks_shape,
+                                                 dtype=diskfm_obj.data_type)
+    fmout_worker = fm._arraytonumpy(fmout, fmout_shape, dtype=diskfm_obj.data_type)
+    # fm._save_rotated_section uses the global var outputs_shape
+    fm.outputs_shape = fmout_shape
+
+
+def _fm_from_basis_keys(keys, mode):
+    """
+    Forward models a list of sections/images in a process of DiskFM.fm_parallelized
+
+    Args:
+        keys: keys of the sections/images in the KL basis dictionnaries
+        mode: 'RDI' if the KL basis was measured in RDI only, None otherwise
+
+    Returns:
+        None
+    """
+    for key in keys:
+        diskfm_worker._fm_from_basis(key, fmout_worker, mode)
+
+
+##############################################################################
+###### routines for the rotation operators of the models
+##############################################################################
+
+
+def _rotated_coordinates(shape, angle, center):
+    """
+    Coordinates in the original image of each pixel of the image rotated by
+    klip.rotate(flipx=True)
+
+    Args:
+        shape: shape of the image (y, x)
+        angle: angle CCW to rotate by (degrees)
+        center: 2 element list [x,y] of the center of rotation
+
+    Returns:
+        yp, xp: flattened coordinates (arrays of size y*x)
+    """
+    angle_rad = np.radians(angle)
+    x, y = np.meshgrid(np.arange(shape[1], dtype=float),
+                       np.arange(shape[0], dtype=float))
+    x = np.ravel(center[0] - (x - center[0]))  # flipx
+    y = np.ravel(y)
+
+    xp = (x - center[0]) * np.cos(angle_rad) + (y - center[1]) * np.sin(angle_rad) + center[0]
+    yp = -(x - center[0]) * np.sin(angle_rad) + (y - center[1]) * np.cos(angle_rad) + center[1]
+    return yp, xp
+
+
+def _rotation_operator(shape, angle, center):
+    """
+    Sparse operator that interpolates the cubic spline coefficients of an image at the
+    coordinates of the rotated image (see _rotated_coordinates). Rows of pixels that
+    fall outside of the image are empty.
+
+    Args:
+        shape: shape of the image (y, x)
+        angle: angle CCW to rotate by (degrees)
+        center: 2 element list [x,y] of the center of rotation
+
+    Returns:
+        CSR matrix of shape (y*x, y*x)
+    """
+    ny, nx = shape
+    yp, xp = _rotated_coordinates(shape, angle, center)
+    spline_y, weights_y = fm._spline_indices(yp, ny)
+    spline_x, weights_x = fm._spline_indices(xp, nx)
+
+    inside = np.where((yp >= 0) & (yp <= ny - 1) & (xp >= 0) & (xp <= nx - 1))[0]
+    rows = np.broadcast_to(inside, (4, 4, inside.size))
+    cols = spline_y[:, None, inside] * nx + spline_x[None, :, inside]
+    weights = weights_y[:, None, inside] * weights_x[None, :, inside]
+
+    return sparse.csr_matrix((np.ravel(weights), (np.ravel(rows), np.ravel(cols))),
+                             shape=(ny * nx, ny * nx))
+
+
+def _rotation_probe_pix(shape, angle, center):
+    """
+    Flat indices of the 4 pixels of the original image around the coordinates of each
+    pixel of the rotated image, for NaN detection as in klip.nan_map_coordinates_2d
+
+    Args:
+        shape: shape of the image (y, x)
+        angle: angle CCW to rotate by (degrees)
+        center: 2 element list [x,y] of the center of rotation
+
+    Returns:
+        array of shape (4, y*x)
+    """
+    ny, nx = shape
+    yp, xp = _rotated_coordinates(shape, angle, center)
+    xp_floor = np.clip(np.floor(xp).astype(int), 0, nx - 1)
+    xp_ceil = np.clip(np.ceil(xp).astype(int), 0, nx - 1)
+    yp_floor = np.clip(np.floor(yp).astype(int), 0, ny - 1)
+    yp_ceil = np.clip(np.ceil(yp).astype(int), 0, ny - 1)
+    return np.array([yp_floor * nx + xp_floor, yp_floor * nx + xp_ceil,
+                     yp_ceil * nx + xp_floor, yp_ceil * nx + xp_ceil])
+
+
+def _save_rotation_operators(filename, operators, shape, center):
+    """
+    Saves the rotation operators in a npz file
+
+    Args:
+        filename: the filename of the npz
+        operators: dict of the CSR operators, with the PAs as keys
+        shape: shape of the image (y, x)
+        center: 2 element list [x,y] of the center of rotation
+
+    Returns:
+        None
+    """
+    pas = sorted(operators.keys())
+    matrices = [operators[pa_here] for pa_here in pas]
+    np.savez(filename,
+             pas=np.array(pas, dtype=float),
+             shape=np.array(shape),
+             center=np.array(center, dtype=float),
+             nnz=np.array([matrix.nnz for matrix in matrices]),
+             data=np.concatenate([matrix.data for matrix in matrices]),
+             indices=np.concatenate([matrix.indices for matrix in matrices]),
+             indptr=np.array([matrix.indptr for matrix in matrices]))
+
+
+def _load_rotation_operators(filename, shape, pas, center):
+    """
+    Loads the rotation operators from a npz file if they were computed for the same
+    image shape, PAs and center
+
+    Args:
+        filename: the filename of the npz
+        shape: shape of the image (y, x)
+        pas: sorted array of the unique PAs
+        center: 2 element list [x,y] of the center of rotation
+
+    Returns:
+        dict of the CSR operators with the PAs as keys, or None if the file does not
+        match
+    """
+    with np.load(filename) as npz_file:
+        if not (np.array_equal(npz_file['shape'], shape) and
+                np.array_equal(npz_file['pas'], pas) and
+                np.array_equal(npz_file['center'], np.array(center, dtype=float))):
+            return None
+
+        offsets = np.concatenate([[0], np.cumsum(npz_file['nnz'])])
+        data = npz_file['data']
+        indices = npz_file['indices']
+        indptr = npz_file['indptr']
+
+        operators = {}
+        for i, pa_here in enumerate(pas):
+            operators[float(pa_here)] = sparse.csr_matrix(
+                (data[offsets[i]:offsets[i + 1]], indices[offsets[i]:offsets[i + 1]],
+                 indptr[i]), shape=(shape[0] * shape[1], shape[0] * shape[1]))
+    return operators
+
 
 ##############################################################################
 ###### 4 routines to save and load h5 in dictionnaries
@@ -5,12 +5,13 @@ import ctypes
 import numpy as np
 import pyklip.spectra_management as spec
 import os
+import warnings
 
 from pyklip.fmlib.nofm import NoFM
 import pyklip.fm as fm
 import pyklip.fakes as fakes
 
-from scipy import interpolate, linalg
+from scipy import interpolate
 from copy import copy
 
 #import matplotlib.pyplot as plt
@@ -28,15 +29,18 @@ class ExtractSpec(NoFM):
                  input_psfs_wvs,
                  input_psfs_pas=None,
                  datatype="float",
-                 stamp_size = None):
+                 stamp_size = None,
+                 coadd_spectra=False,
+                 planet_sectors_only=False):
         """
         Defining the planet to characterizae
 
         Args:
             inputs_shape: shape of the inputs numpy array. Typically (N, y, x)
             numbasis: 1d numpy array consisting of the number of basis vectors to use
-            sep: separation of the planet
-            pa: position angle of the planet
+            sep: separation of the planet, or a list of separations to extract the spectra of several planets at once
+                 from the same KL modes
+            pa: position angle of the planet, or a list of position angles (same length as sep)
             input_psfs: the psf of the image. A numpy array with shape (wv, y, x) 
                         shape of (N_cubes, wvs, y, x) also acceptable to have PSFs change in time.
             input_psfs_wvs: the wavelegnths that correspond to the input psfs
@@ -46,6 +50,13 @@ class ExtractSpec(NoFM):
             spectrallib: if not None, a list of spectra
             star_spt: star spectral type, if None default to some random one
             refine_fit: refine the separation and pa supplied
+            coadd_spectra: if True, the forward models of the reference frames are summed by wavelength while they are
+                           computed, so fmout has shape (numbasis, N_frames, nwav+1, npix) instead of
+                           (numbasis, N_frames, N_frames+1, npix). This is all invert_spect_fmodel() needs and is
+                           N_cubes times smaller. Frame i is assumed to be at wavelength i % nwav.
+            planet_sectors_only: if True, KLIP-FM is only run on the sectors that contain the stamps of the planets
+                                 (see regions_of_interest()). fmout is the same, but the klipped images are then only
+                                 computed around the planets.
         """
         # allocate super class
         super(ExtractSpec, self).__init__(inputs_shape, np.array(numbasis))
@@ -69,6 +80,13 @@ class ExtractSpec(NoFM):
         self.numbasis = numbasis
         self.sep = sep
         self.pa = pa
+        # several planets are forward modelled with the same KL modes, each with its own fmout
+        self.multi_planet = np.ndim(sep) > 0
+        self.seps = np.atleast_1d(np.array(sep, dtype=float))
+        self.pas = np.atleast_1d(np.array(pa, dtype=float))
+        if np.size(self.seps) != np.size(self.pas):
+            raise ValueError("sep and pa should have the same number of planets")
+        self.N_planets = np.size(self.seps)
 
 
         # 2018-04-10 AG: Generalizing so everything is in units of input PSF
@@ -110,6 +128,17 @@ class ExtractSpec(NoFM):
             
         self.psfs_func_list = psfs_func_list
 
+        self.coadd_spectra = coadd_spectra
+        if self.coadd_spectra and self.N_frames % self.nl != 0:
+            raise ValueError("coadd_spectra needs the same number of frames at each of the {0} wavelengths".format(self.nl))
+        self.planet_sectors_only = planet_sectors_only
+
+        # size of the spectral dimension of fmout
+        if self.coadd_spectra:
+            self.N_spec = self.nl
+        else:
+            self.N_spec = self.N_frames
+
 
     def alloc_fmout(self, output_img_shape):
         """
@@ -126,7 +155,7 @@ class ExtractSpec(NoFM):
 
         # The 3rd dimension (self.N_frames corresponds to the spectrum)
         # The +1 in (self.N_frames+1) is for the klipped image
-        fmout_size = self.N_numbasis*self.N_frames*(self.N_frames+1)*self.stamp_size*self.stamp_size
+        fmout_size = self.N_planets*self.N_numbasis*self.N_frames*(self.N_spec+1)*self.stamp_size*self.stamp_size
         # 2018-04-10 AG: force fmout to be type int
         fmout = mp.Array(self.data_type, int(fmout_size))
         # fmout shape is defined as:
@@ -141,11 +170,30 @@ class ExtractSpec(NoFM):
         #           Multiply a vector of fluxes to this dimension of fmout[:,:, 0:self.N_frames,:] and you should get
         #           forward model for that given spectrum.
         # 4th dim: pixels value. It has the size of the number of pixels in the stamp self.stamp_size*self.stamp_size.
-        fmout_shape = (self.N_numbasis,self.N_frames,(self.N_frames+1),self.stamp_size*self.stamp_size )
+        # If a list of planets was given, there is an extra first dimension for the planets.
+        # If coadd_spectra, the spectral dimension is summed by wavelength and the 3rd dim has a size of nl+1.
+        fmout_shape = (self.N_numbasis,self.N_frames,(self.N_spec+1),self.stamp_size*self.stamp_size )
+        if self.multi_planet:
+            fmout_shape = (self.N_planets,) + fmout_shape
 
         return fmout, fmout_shape
 
 
+    def regions_of_interest(self):
+        """
+        Region of the image where the forward model is needed: the whole image, or only the stamps of the planets if
+        planet_sectors_only
+
+        Returns:
+            None, or a list of (sep, pa, radius) with the radius enclosing the stamp of each planet
+        """
+        if not self.planet_sectors_only:
+            return None
+        # half diagonal of the stamp, plus one pixel for the rounding of its position
+        radius = np.sqrt(2) * self.stamp_size / 2. + 1
+        return [(sep, pa, radius) for sep, pa in zip(self.seps, self.pas)]
+
+
     # def alloc_perturbmag(self, output_img_shape, numbasis):
     #     """
     #     Allocates shared memory to store the fractional magnitude of the linear KLIP perturbation
@@ -166,7 +214,7 @@ class ExtractSpec(NoFM):
     #     return perturbmag, perturbmag_shape
 
 
-    def generate_models(self, input_img_shape, section_ind, pas, wvs, radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, stamp_size = None):
+    def generate_models(self, input_img_shape, section_ind, pas, wvs, radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, stamp_size = None, model_cache=None, planet_index=0):
         """
         Generate model PSFs at the correct location of this segment for each image denoated by its wv and parallactic angle
 
@@ -183,6 +231,9 @@ class ExtractSpec(NoFM):
             ref_wv: wavelength of science image
             stamp_size: size of the stamp for spectral extraction
             flipx: if True, flip x coordinate in final image
+            model_cache: if not None, a dict to keep the PSF stamps in so that they are only generated once for
+                         science images that share reference images (e.g. a batch of images in fm.klip_parallelized)
+            planet_index: index of the planet to model in self.seps and self.pas
 
         Return:
             models: array of size (N, p) where p is the number of pixels in the segment
@@ -215,47 +266,57 @@ class ExtractSpec(NoFM):
         if debug:
             canvases = []
         models = []
+        planet_sep, planet_pa = self.seps[planet_index], self.pas[planet_index]
         #print(self.input_psfs.shape)
         for pa, wv in zip(pas, wvs):
-            #print(self.pa,self.sep)
-            #print(pa,wv)
-            # grab PSF given wavelength
-            wv_index = spec.find_nearest(self.input_psfs_wvs,wv)[1]
-            #model_psf = self.input_psfs[wv_index[0], :, :] #* self.flux_conversion * self.spectrallib[0][wv_index] * self.dflux
-
-            # find center of psf
-            # to reduce calculation of sin and cos, see if it has already been calculated before
-            if pa not in self.psf_centx_notscaled:
-                # flipx requires the opposite rotation
-                sign = -1.
-                if flipx:
-                    sign = 1.
-                self.psf_centx_notscaled[pa] = self.sep * np.cos(np.radians(90. - sign*self.pa - pa))
-                self.psf_centy_notscaled[pa] = self.sep * np.sin(np.radians(90. - sign*self.pa - pa))
-            psf_centx = (ref_wv/wv) * self.psf_centx_notscaled[pa]
-            psf_centy = (ref_wv/wv) * self.psf_centy_notscaled[pa]
-
-            # create a coordinate system for the image that is with respect to the model PSF
-            # round to nearest pixel and add offset for center
-            l = round(psf_centx + ref_center[0])
-            k = round(psf_centy + ref_center[1])
-            # recenter coordinate system about the location of the planet
-            x_vec_stamp_centered = x_grid[0, int(l-col_m):int(l+col_p)]-psf_centx
-            y_vec_stamp_centered = y_grid[int(k-row_m):int(k+row_p), 0]-psf_centy
-            # rescale to account for the align and scaling of the refernce PSFs
-            # e.g. for longer wvs, the PSF has shrunk, so we need to shrink the coordinate system
-            x_vec_stamp_centered /= (ref_wv/wv)
-            y_vec_stamp_centered /= (ref_wv/wv)
-
-            # use intepolation spline to generate a model PSF and write to temp img
-            if not self.psfs_in_time:
-                # just grab the right wavelength
-                psf_func = self.psfs_func_list[int(wv_index)]
+            # the stamp only depends on this image and the science wavelength, so reuse it if we already made it
+            cache_key = (pa, wv, ref_wv, flipx, ref_center[0], ref_center[1], planet_sep, planet_pa)
+            if model_cache is not None and cache_key in model_cache:
+                k, l, stamp = model_cache[cache_key]
+                whiteboard[int(k-row_m):int(k+row_p), int(l-col_m):int(l+col_p)] = stamp
             else:
-                pa_index = spec.find_nearest(self.input_psfs_pas, pa)[1]
-                psf_func = self.psfs_func_list[int(pa_index)][int(wv_index)]
-            whiteboard[int(k-row_m):int(k+row_p), int(l-col_m):int(l+col_p)] = \
-                    psf_func(x_vec_stamp_centered,y_vec_stamp_centered).transpose()
+                #print(self.pa,self.sep)
+                #print(pa,wv)
+                # grab PSF given wavelength
+                wv_index = spec.find_nearest(self.input_psfs_wvs,wv)[1]
+                #model_psf = self.input_psfs[wv_index[0], :, :] #* self.flux_conversion * self.spectrallib[0][wv_index] * self.dflux
+
+                # find center of psf
+                # to reduce calculation of sin and cos, see if it has already been calculated before
+                trig_key = (planet_index, pa)
+                if trig_key not in self.psf_centx_notscaled:
+                    # flipx requires the opposite rotation
+                    sign = -1.
+                    if flipx:
+                        sign = 1.
+                    self.psf_centx_notscaled[trig_key] = planet_sep * np.cos(np.radians(90. - sign*planet_pa - pa))
+                    self.psf_centy_notscaled[trig_key] = planet_sep * np.sin(np.radians(90. - sign*planet_pa - pa))
+                psf_centx = (ref_wv/wv) * self.psf_centx_notscaled[trig_key]
+                psf_centy = (ref_wv/wv) * self.psf_centy_notscaled[trig_key]
+
+                # create a coordinate system for the image that is with respect to the model PSF
+                # round to nearest pixel and add offset for center
+                l = round(psf_centx + ref_center[0])
+                k = round(psf_centy + ref_center[1])
+                # recenter coordinate system about the location of the planet
+                x_vec_stamp_centered = x_grid[0, int(l-col_m):int(l+col_p)]-psf_centx
+                y_vec_stamp_centered = y_grid[int(k-row_m):int(k+row_p), 0]-psf_centy
+                # rescale to account for the align and scaling of the refernce PSFs
+                # e.g. for longer wvs, the PSF has shrunk, so we need to shrink the coordinate system
+                x_vec_stamp_centered /= (ref_wv/wv)
+                y_vec_stamp_centered /= (ref_wv/wv)
+
+                # use intepolation spline to generate a model PSF and write to temp img
+                if not self.psfs_in_time:
+                    # just grab the right wavelength
+                    psf_func = self.psfs_func_list[int(wv_index)]
+                else:
+                    pa_index = spec.find_nearest(self.input_psfs_pas, pa)[1]
+                    psf_func = self.psfs_func_list[int(pa_index)][int(wv_index)]
+                whiteboard[int(k-row_m):int(k+row_p), int(l-col_m):int(l+col_p)] = \
+                        psf_func(x_vec_stamp_centered,y_vec_stamp_centered).transpose()
+                if model_cache is not None:
+                    model_cache[cache_key] = (k, l, np.copy(whiteboard[int(k-row_m):int(k+row_p), int(l-col_m):int(l+col_p)]))
 
             # write model img to output (segment is collapsed in x/y so need to reshape)
             whiteboard.shape = [input_img_shape[0] * input_img_shape[1]]
@@ -281,7 +342,8 @@ class ExtractSpec(NoFM):
 
     def fm_from_eigen(self, klmodes=None, evals=None, evecs=None, input_img_shape=None, input_img_num=None, ref_psfs_indicies=None, section_ind=None,section_ind_nopadding=None, aligned_imgs=None, pas=None,
                      wvs=None, radstart=None, radend=None, phistart=None, phiend=None, padding=None,IOWA = None, ref_center=None,
-                     parang=None, ref_wv=None, numbasis=None, fmout=None, perturbmag=None, klipped=None, flipx=True, **kwargs):
+                     parang=None, ref_wv=None, numbasis=None, fmout=None, perturbmag=None, klipped=None, flipx=True,
+                     model_cache=None, **kwargs):
         """
         Generate forward models using the KL modes, eigenvectors, and eigenvectors from KLIP. Calls fm.py functions to
         perform the forward modelling
@@ -312,6 +374,8 @@ class ExtractSpec(NoFM):
             fmout: numpy output array for FM output. Shape is (N, y, x, b)
             perturbmag: numpy output for size of linear perturbation. Shape is (N, b)
             klipped: PSF subtracted image. Shape of ( size(section), b)
+            model_cache: dict shared by the science images of a batch to reuse the reference models (see
+                         generate_models)
             kwargs: any other variables that we don't use but are part of the input
         """
         sci = aligned_imgs[input_img_num, section_ind[0]]
@@ -319,52 +383,73 @@ class ExtractSpec(NoFM):
         refs = refs[:, section_ind[0]]
 
 
-        # generate models for the PSF of the science image
-        model_sci, stamp_indices = self.generate_models(input_img_shape, section_ind, [parang], [ref_wv], radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, stamp_size=self.stamp_size)
-        model_sci = model_sci[0]
-        stamp_indices = stamp_indices[0]
-
-        # generate models of the PSF for each reference segments. Output is of shape (N, pix_in_segment)
-        models_ref = self.generate_models(input_img_shape, section_ind, pas, wvs, radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx)
-
-        # using original Kl modes and reference models, compute the perturbed KL modes (spectra is already in models)
-        #delta_KL = fm.perturb_specIncluded(evals, evecs, klmodes, refs, models_ref)
-        delta_KL_nospec = fm.pertrurb_nospec(evals, evecs, klmodes, refs, models_ref)
-
-        # calculate postklip_psf using delta_KL
-        oversubtraction, selfsubtraction = fm.calculate_fm(delta_KL_nospec, klmodes, numbasis, sci, model_sci, inputflux=None)
-        # klipped_oversub.shape = (size(numbasis),Npix)
-        # klipped_selfsub.shape = (size(numbasis),N_lambda or N_ref,N_pix)
-        # klipped_oversub = Sum(<S|KL>KL)
-        # klipped_selfsub = Sum(<N|DKL>KL) + Sum(<N|KL>DKL)
-
-
-        # Note: The following could be used if we want to derotate the image but JB doesn't think we have to.
-        # # write forward modelled PSF to fmout (as output)
-        # # need to derotate the image in this step
-        # for thisnumbasisindex in range(np.size(numbasis)):
-        #         fm._save_rotated_section(input_img_shape, postklip_psf[thisnumbasisindex], section_ind,
-        #                          fmout[input_img_num, :, :,thisnumbasisindex], None, parang,
-        #                          radstart, radend, phistart, phiend, padding,IOWA, ref_center, flipx=True)
-
-
-        # fmout shape is defined as:
-        #   (self.N_numbasis,self.N_frames,(self.N_frames+1),self.stamp_size*self.stamp_size)
-        # 1st dim: The size of the numbasis input. numasis gives the list of the number of KL modes we want to try out
-        #           e.g. numbasis = [10,20,50].
-        # 2nd dim: It is the Forward model dimension. It contains the forard model for each frame in the dataset.
-        #           N_frames = N_cubes*(Number of spectral channel=37)
-        # 3nd dim: It contains both the "spectral dimension" and the klipped image.
-        #           The regular klipped data is fmout[:,:, -1,:]
-        #           The regular forward model is fmout[:,:, 0:self.N_frames,:]
-        #           Multiply a vector of fluxes to this dimension of fmout[:,:, 0:self.N_frames,:] and you should get
-        #           forward model for that given spectrum.
-        # 4th dim: pixels value. It has the size of the number of pixels in the stamp self.stamp_size*self.stamp_size.
-        for k in range(self.N_numbasis):
-            fmout[k,input_img_num, input_img_num,:] = fmout[k,input_img_num, input_img_num,:]+model_sci[stamp_indices]
-        fmout[:,input_img_num, input_img_num,:] = fmout[:,input_img_num, input_img_num,:]-oversubtraction[:,stamp_indices]
-        fmout[:,input_img_num, ref_psfs_indicies,:] = fmout[:,input_img_num, ref_psfs_indicies,:]-selfsubtraction[:,:,stamp_indices]
-        fmout[:,input_img_num, -1,:] = klipped.T[:,stamp_indices]
+        # Forward model each planet with the same KL modes and eigenvectors
+        for planet_index in range(self.N_planets):
+            if self.multi_planet:
+                planet_fmout = fmout[planet_index]
+            else:
+                planet_fmout = fmout
+
+            # generate models for the PSF of the science image
+            model_sci, stamp_indices = self.generate_models(input_img_shape, section_ind, [parang], [ref_wv], radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, stamp_size=self.stamp_size, model_cache=model_cache, planet_index=planet_index)
+            model_sci = model_sci[0]
+            stamp_indices = stamp_indices[0]
+            # the stamp of this planet is not (entirely) in this sector. cleanup_fmout() warns about the frames where
+            # the stamp never fit in a sector
+            if self.multi_planet and np.size(stamp_indices) != self.stamp_size*self.stamp_size:
+                continue
+
+            # generate models of the PSF for each reference segments. Output is of shape (N, pix_in_segment)
+            models_ref = self.generate_models(input_img_shape, section_ind, pas, wvs, radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, model_cache=model_cache, planet_index=planet_index)
+
+            # using original Kl modes and reference models, compute the perturbed KL modes (spectra is already in models)
+            #delta_KL = fm.perturb_specIncluded(evals, evecs, klmodes, refs, models_ref)
+            delta_KL_nospec = fm.pertrurb_nospec(evals, evecs, klmodes, refs, models_ref)
+
+            # calculate postklip_psf using delta_KL
+            oversubtraction, selfsubtraction = fm.calculate_fm(delta_KL_nospec, klmodes, numbasis, sci, model_sci, inputflux=None)
+            # klipped_oversub.shape = (size(numbasis),Npix)
+            # klipped_selfsub.shape = (size(numbasis),N_lambda or N_ref,N_pix)
+            # klipped_oversub = Sum(<S|KL>KL)
+            # klipped_selfsub = Sum(<N|DKL>KL) + Sum(<N|KL>DKL)
+
+
+            # Note: The following could be used if we want to derotate the image but JB doesn't think we have to.
+            # # write forward modelled PSF to fmout (as output)
+            # # need to derotate the image in this step
+            # for thisnumbasisindex in range(np.size(numbasis)):
+            #         fm._save_rotated_section(input_img_shape, postklip_psf[thisnumbasisindex], section_ind,
+            #                          fmout[input_img_num, :, :,thisnumbasisindex], None, parang,
+            #                          radstart, radend, phistart, phiend, padding,IOWA, ref_center, flipx=True)
+
+
+            # fmout shape is defined as:
+            #   (self.N_numbasis,self.N_frames,(self.N_frames+1),self.stamp_size*self.stamp_size)
+            # 1st dim: The size of the numbasis input. numasis gives the list of the number of KL modes we want to try out
+            #           e.g. numbasis = [10,20,50].
+            # 2nd dim: It is the Forward model dimension. It contains the forard model for each frame in the dataset.
+            #           N_frames = N_cubes*(Number of spectral channel=37)
+            # 3nd dim: It contains both the "spectral dimension" and the klipped image.
+            #           The regular klipped data is fmout[:,:, -1,:]
+            #           The regular forward model is fmout[:,:, 0:self.N_frames,:]
+            #           Multiply a vector of fluxes to this dimension of fmout[:,:, 0:self.N_frames,:] and you should get
+            #           forward model for that given spectrum.
+            # 4th dim: pixels value. It has the size of the number of pixels in the stamp self.stamp_size*self.stamp_size.
+            if self.coadd_spectra:
+                # sum the spectral dimension by wavelength as we go: only this frame writes to its row of fmout
+                sci_spec_index = input_img_num % self.nl
+                ref_selec = np.identity(self.nl)[np.asarray(ref_psfs_indicies) % self.nl]
+                selfsubtraction_coadd = np.einsum("krp,rl->klp", selfsubtraction[:,:,stamp_indices], ref_selec)
+            else:
+                sci_spec_index = input_img_num
+            for k in range(self.N_numbasis):
+                planet_fmout[k,input_img_num, sci_spec_index,:] = planet_fmout[k,input_img_num, sci_spec_index,:]+model_sci[stamp_indices]
+            planet_fmout[:,input_img_num, sci_spec_index,:] = planet_fmout[:,input_img_num, sci_spec_index,:]-oversubtraction[:,stamp_indices]
+            if self.coadd_spectra:
+                planet_fmout[:,input_img_num, :self.nl,:] = planet_fmout[:,input_img_num, :self.nl,:]-selfsubtraction_coadd
+            else:
+                planet_fmout[:,input_img_num, ref_psfs_indicies,:] = planet_fmout[:,input_img_num, ref_psfs_indicies,:]-selfsubtraction[:,:,stamp_indices]
+            planet_fmout[:,input_img_num, -1,:] = klipped.T[:,stamp_indices]
 
 
 
@@ -381,6 +466,19 @@ class ExtractSpec(NoFM):
         """
         # Here we actually extract the spectrum
 
+        # a planet whose stamp straddles the boundary of two sectors is not forward modelled in that frame
+        if self.multi_planet:
+            for planet_index, (sep, pa) in enumerate(zip(self.seps, self.pas)):
+                missing_frames = np.all(fmout[planet_index, :, :, -1, :] == 0, axis=(0, 2))
+                if np.all(missing_frames):
+                    warnings.warn("The stamp of planet {0} (sep={1}, pa={2}) is never inside a single sector, its fmout "
+                                  "is zero. Choose annuli/subsections that contain the whole stamp of each planet."
+                                  .format(planet_index, sep, pa), RuntimeWarning)
+                elif np.any(missing_frames):
+                    warnings.warn("The stamp of planet {0} (sep={1}, pa={2}) is not inside a single sector in {3} of the "
+                                  "{4} frames, its fmout is zero for these frames. Choose annuli/subsections that "
+                                  "contain the whole stamp of each planet."
+                                  .format(planet_index, sep, pa, np.sum(missing_frames), self.N_frames), RuntimeWarning)
 
         return fmout
 
@@ -388,10 +486,14 @@ def invert_spect_fmodel(fmout, dataset, method = "JB", units = "natural",
                         scaling_factor=1.0):
     """
     A. Greenbaum Nov 2016
-    
+
+    The inversions of all the KL mode cutoffs (and of all the planets) are solved together as a stack of matrices.
+
     Args:
         fmout: the forward model matrix which has structure:
                [numbasis, n_frames, n_frames+1, npix]
+               or [numbasis, n_frames, nwav+1, npix] if ExtractSpec was run with coadd_spectra=True
+               or with an extra first dimension [n_planets, ...] if several planets were given to ExtractSpec
         dataset: from GPI.GPIData(filelist) -- typically set highpass=True also
         method: "JB" or "LP" to try the 2 different inversion methods (JB's or Laurent's)
         units: "natural" means the answer is scaled to the input PSF (default)
@@ -404,94 +506,60 @@ def invert_spect_fmodel(fmout, dataset, method = "JB", units = "natural",
         A tuple containing the spectrum and the forward model
         (spectrum, forwardmodel)
         spectrum shape:(len(numbasis), nwav)
+        If fmout has a planet dimension, the spectra of all the planets are returned with shape
+        (n_planets, len(numbasis), nwav), and the forward models with an extra first dimension too.
         
     """
-    N_frames = fmout.shape[2] - 1 # The last element in this axis contains klipped image
+    fmout = np.asarray(fmout)
+    # numbasis, or planets and numbasis
+    batch_shape = fmout.shape[:-3]
+    N_frames = fmout.shape[-3]
+    N_spec = fmout.shape[-2] - 1 # The last element in this axis contains klipped image
     N_cubes = np.size(np.unique(dataset.filenums)) # 
     nl = N_frames // N_cubes
     stamp_N_pix = fmout.shape[-1]
+    fmout = fmout.reshape((-1,) + fmout.shape[-3:])
+    N_batch = fmout.shape[0]
+
+    # klipped_coadd will be coadded over N_cubes, frame i being at wavelength i % nl
+    # [batch, nwav, npix]
+    klipped_coadd = fmout[:, :, -1, :].reshape((N_batch, N_cubes, nl, stamp_N_pix)).sum(axis=1)
+
+    # This is the 'raw' forward model, need to rearrange to solve FM*spec = klipped
+    # S^T . FM[nframes, nframes, npix] . S with the selection matrix S = tile(identity(nwav))
+    # essentially coadds the frames and the spectral dimension over N_cubes. The spectral dimension is already
+    # coadded if ExtractSpec was run with coadd_spectra=True.
+    # [batch, nwav, nwav, npix] -> [batch, nwav, npix, nwav]
+    fm_noSpec_coadd = fmout[:, :, :N_spec, :].reshape((N_batch, N_cubes, nl, N_spec // nl, nl, stamp_N_pix))
+    fm_noSpec_coadd = np.moveaxis(fm_noSpec_coadd.sum(axis=(1, 3)), 2, 3)
+    # Flatten over first 2 dims for the FM matrix to solve FM*spect = klipped
+    fm_coadd_mat = fm_noSpec_coadd.reshape((N_batch, nl*stamp_N_pix, nl))
+
+    estim_spec = np.zeros((N_batch, nl))
+    if method == "JB" or method == "leastsq":
+        #
+        #JBR's matrix inversion adds up over all exposures, then inverts
+        # (MF's leastsq gives the same least squares solution of FM*spect = klipped)
+        #
+        # Invert the FM matrices
+        pinv_fm_coadd_mat = np.linalg.pinv(fm_coadd_mat)
+        # solve via FM^-1 . klipped_PSF (flattened) << both are coadded over N_cubes
+        estim_spec = np.einsum("bij,bj->bi", pinv_fm_coadd_mat, klipped_coadd.reshape((N_batch, nl*stamp_N_pix)))
+    elif method == "LP":
+        #
+        #LP's matrix inversion adds over frames and one wavelength axis, then inverts
+        #
+        # A[q,c] = sum_p FM[q,p,q] FM[c,p,q] and b[q] = sum_p FM[q,p,q] klipped[q,p]
+        A = np.einsum("bqpq,bcpq->bqc", fm_noSpec_coadd, fm_noSpec_coadd)
+        b = np.einsum("bqpq,bqp->bq", fm_noSpec_coadd, klipped_coadd)
+        estim_spec = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    else:
+        print("method not understood. Choose either JB, LP or leastsq.")
 
-    # Selection matrix (N_cubes, 1) shape
-    spec_identity = np.identity(nl)
-    selec = np.tile(spec_identity,(N_frames//nl, 1))
-
-    # set up array for klipped image for each numbasis, n_frames x npix
-    klipped = np.zeros((fmout.shape[0], fmout.shape[1], fmout.shape[3]))
-    estim_spec = np.zeros((fmout.shape[0], nl))
-
-    # The first dimension in fmout is numbasis, and there can be multiple of these,
-    # Especially if you want to see how the spectrum behaves when you change parameters.
-    # We'll also set aside an array to store the forward model matrix
-    fm_coadd_mat = np.zeros((len(fmout), nl*stamp_N_pix, nl))
-    for ii in range(len(fmout)):
-        klipped[ii, ...] = fmout[ii,:, -1,:]
-        # klipped_coadd will be coadded over N_cubes
-        klipped_coadd = np.zeros((int(nl),int(stamp_N_pix)))
-        for k in range(N_cubes):
-            klipped_coadd = klipped_coadd + klipped[ii, k*nl:(k+1)*nl,:]
-        print(klipped_coadd.shape)
-        #klipped_coadd.shape = [int(nl),int(stamp_size),int(stamp_size)]
-        # This is the 'raw' forward model, need to rearrange to solve FM*spec = klipped
-        FM_noSpec = fmout[ii, :,:N_frames, :]
-
-        # Move spectral dimension to the end (Effectively move pixel dimension to the middle)
-        # [nframes, nframes, npix] -> [nframes, npix, nframes]
-        FM_noSpec = np.rollaxis(FM_noSpec, 2, 1)
-
-        # S^T . FM[npix, nframes, nframes] . S
-        # essentially coadds over N_cubes via selection matrix
-        # reduces to [nwav, npix, nwav]
-        fm_noSpec_coadd = np.dot(selec.T,np.dot(np.rollaxis(FM_noSpec,1,0),selec))
-        if method == "JB":
-            #
-            #JBR's matrix inversion adds up over all exposures, then inverts
-            #
-            #Back to a 2D array pixel array in the middle
-            fm_noSpec_coadd.shape = [int(nl),stamp_N_pix, int(nl)]
-            # Flatten over first 3 dims for the FM matrix to solve FM*spect = klipped
-            fm_noSpec_coadd_mat = np.reshape(fm_noSpec_coadd,(int(nl*stamp_N_pix),int(nl)))
-            # Invert the FM matrix
-            pinv_fm_coadd_mat = np.linalg.pinv(fm_noSpec_coadd_mat)
-            # solve via FM^-1 . klipped_PSF (flattened) << both are coadded over N_cubes
-            estim_spec[ii,:]=np.dot(pinv_fm_coadd_mat, klipped_coadd.ravel())
-            fm_coadd_mat[ii,:, :] = fm_noSpec_coadd_mat
-        elif method == "LP":
-            #
-            #LP's matrix inversion adds over frames and one wavelength axis, then inverts
-            #
-            A = np.zeros((nl, nl))
-            b = np.zeros(nl)
-            fm = fm_noSpec_coadd.reshape(int(nl), stamp_N_pix, int(nl))
-            fm_coadd_mat[ii,:, :] = \
-                fm_noSpec_coadd.reshape(int(nl*stamp_N_pix), int(nl))
-            fm = np.rollaxis(fm, 2,0)
-            fm = np.rollaxis(fm, 2,1)
-            data = klipped_coadd
-            for q in range(nl):
-                A[q,:] = np.dot(fm[q,:].T,fm[q,:])[q,:]
-                b[q] = np.dot(fm[q,:].T,data[q])[q]
-            estim_spec[ii,:] = np.dot(np.linalg.inv(A), b)
-        elif method == "leastsq":
-            # MF's suggestion of solving using a least sq function 
-            # instead of matrix inversions
-            
-            #Back to a 2D array pixel array in the middle
-            fm_noSpec_coadd.shape = [int(nl),stamp_N_pix,int(nl)]
-            # Flatten over first 3 dims for the FM matrix to solve FM*spect = klipped
-            fm_noSpec_coadd_mat = np.reshape(fm_noSpec_coadd,(int(nl*stamp_N_pix),int(nl)))
-            # Saving the coadded FM
-            fm_coadd_mat[ii,:, :] = fm_noSpec_coadd_mat
-
-            # used leastsq solver
-            results = linalg.lstsq(fm_noSpec_coadd_mat, klipped_coadd.ravel())
-            # grab the spectrum, not using the other parts for now.
-            estim_spec[ii,:], res, rank, s = results
-
-        else:
-            print("method not understood. Choose either JB, LP or leastsq.")
+    estim_spec = estim_spec.reshape(batch_shape + (nl,))
+    fm_coadd_mat = fm_coadd_mat.reshape(batch_shape + (nl*stamp_N_pix, nl))
 
     if units=="scaled":
         return scaling_factor*estim_spec, fm_coadd_mat / scaling_factor
     else:
         return estim_spec, fm_coadd_mat
-
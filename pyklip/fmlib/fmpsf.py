@@ -9,17 +9,20 @@ from pyklip.fmlib.nofm import NoFM
 import pyklip.fm as fm
 
 from scipy import interpolate
-from copy import copy
 
 debug = False
 
+# maximum number of PSF stamps kept by each FMPlanetPSF object
+stamp_cache_size = 4096
+
 
 class FMPlanetPSF(NoFM):
     """
     Forward models the PSF of the planet through KLIP. Returns the forward modelled planet PSF
     """
     def __init__(self, inputs_shape, numbasis, sep, pa, dflux, input_psfs, input_wvs, flux_conversion=None, spectrallib=None, 
-                 spectrallib_units="flux", star_spt=None, refine_fit=False, field_dependent_correction=None, input_psfs_pas=None):
+                 spectrallib_units="flux", star_spt=None, refine_fit=False, field_dependent_correction=None, input_psfs_pas=None,
+                 stamp_quantization=None, planet_sectors_only=False):
         """
         Defining the planet to characterize
 
@@ -41,6 +44,12 @@ class FMPlanetPSF(NoFM):
             refine_fit: (NOT implemented) refine the separation and pa supplied
             field_dependent_correction: function to implement field dependent correction. See BKA tutorial.
             input_psfs_pas: the parangs corresponding to the input PSFs (optional). Array of size N_cubes
+            stamp_quantization: if not None, the subpixel offsets of the model PSFs are rounded to a multiple of
+                                stamp_quantization (in pixels), so that the PSF stamps can be reused for more images
+                                (e.g. 0.01). If None, the stamps are exact and only reused for the same offset.
+            planet_sectors_only: if True, KLIP-FM is only run on the sectors that contain the PSF of the planet (see
+                                 regions_of_interest()) instead of the whole image. The klipped images and the forward
+                                 model are then only computed around the planet.
         """
         # allocate super class
         super(FMPlanetPSF, self).__init__(inputs_shape, numbasis)
@@ -86,6 +95,12 @@ class FMPlanetPSF(NoFM):
         self.psf_centx_notscaled = {}
         self.psf_centy_notscaled = {}
 
+        # PSF stamps evaluated by the interpolators, keyed by (wv_index, pa_index, subpixel offset, scale)
+        self.stamp_quantization = stamp_quantization
+        self._stamp_cache = {}
+
+        self.planet_sectors_only = planet_sectors_only
+
         if len(self.input_psfs.shape) == 3:
             numwv,ny_psf,nx_psf =  self.input_psfs.shape
             x_psf_grid, y_psf_grid = np.meshgrid(np.arange(nx_psf * 1.) - nx_psf//2, np.arange(ny_psf * 1.) - ny_psf//2)
@@ -173,7 +188,22 @@ class FMPlanetPSF(NoFM):
         return perturbmag, perturbmag_shape
 
 
-    def generate_models(self, input_img_shape, section_ind, pas, wvs, radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, rdi_indices):
+    def regions_of_interest(self):
+        """
+        Region of the image where the forward model is needed: the whole image, or only the PSF of the planet if
+        planet_sectors_only
+
+        Returns:
+            None, or [(sep, pa, radius)] with the radius enclosing the PSF stamp
+        """
+        if not self.planet_sectors_only:
+            return None
+        ny_psf, nx_psf = self.input_psfs.shape[-2:]
+        # half diagonal of the stamp, plus one pixel for the rounding of its position
+        return [(self.sep, self.pa, np.sqrt(nx_psf**2 + ny_psf**2) / 2. + 1)]
+
+
+    def generate_models(self, input_img_shape, section_ind, pas, wvs, radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, rdi_indices, model_cache=None):
         """
         Generate model PSFs at the correct location of this segment for each image denoated by its wv and parallactic angle
 
@@ -190,116 +220,170 @@ class FMPlanetPSF(NoFM):
             ref_wv: wavelength of science image
             flipx: if True, flip x coordinate in final image
             rdi_indices: array of N corresponding to whether it is (1) or isn't (0) an RDI frame
+            model_cache: if not None, a dict to keep the PSF stamps in so that they are only generated once for
+                         science images that share reference images (e.g. a batch of images in fm.klip_parallelized)
 
         Return:
             models: array of size (N, p) where p is the number of pixels in the segment
         """
-        # create a blank canvas the same size as the input image centered at the psf center
         nx = input_img_shape[1] # x dimension of input image
         ny = input_img_shape[0] # y dimension of input image
-        x_grid, y_grid = np.meshgrid(np.arange(nx * 1.)-ref_center[0], np.arange(ny * 1.)-ref_center[1])
 
+        # pixels of the segment, sorted to find the ones covered by each stamp
+        section_pix = np.ravel(section_ind)
+        sort_order = np.argsort(section_pix, kind="stable")
+        sorted_pix = section_pix[sort_order]
+
+        models = np.zeros((np.size(pas), np.size(section_pix)))
+
+        model_indices = []
+        stamp_lowers = []
+        stamp_lefts = []
+        stamps = []
+        for index, (pa, wv, is_rdi) in enumerate(zip(pas, wvs, rdi_indices)):
+            # if RDI, leave a blank model since we assume there is no astrophysical signal in the RDI frames
+            if is_rdi:
+                continue
+
+            # the stamp only depends on this image and the science wavelength, so reuse it if we already made it
+            cache_key = (pa, wv, ref_wv, flipx, ref_center[0], ref_center[1])
+            if model_cache is not None and cache_key in model_cache:
+                stamp_lower, stamp_left, stamp = model_cache[cache_key]
+            else:
+                stamp_lower, stamp_left, stamp = self._place_stamp(pa, wv, ref_wv, flipx, ref_center)
+                if model_cache is not None:
+                    model_cache[cache_key] = (stamp_lower, stamp_left, stamp)
+
+            model_indices.append(index)
+            stamp_lowers.append(stamp_lower)
+            stamp_lefts.append(stamp_left)
+            stamps.append(stamp)
+
+        if len(stamps) == 0:
+            return models
+
+        # write all the stamps in the segment at once. For each row of each stamp, the pixels of the segment it covers
+        # are a contiguous range of the sorted segment pixels
+        stamps = np.array(stamps)
+        numstamps, ny_stamp, nx_stamp = stamps.shape
+        stamp_lowers = np.array(stamp_lowers)
+        stamp_lefts = np.array(stamp_lefts)
+
+        rows = stamp_lowers[:, None] + np.arange(ny_stamp)[None, :] # (M, ny_stamp)
+        col_start = np.clip(stamp_lefts, 0, nx)[:, None]
+        col_end = np.clip(stamp_lefts + nx_stamp, 0, nx)[:, None]
+        valid_rows = (rows >= 0) & (rows < ny)
+        range_start = np.searchsorted(sorted_pix, rows * nx + col_start)
+        range_end = np.searchsorted(sorted_pix, rows * nx + col_end)
+        range_len = np.where(valid_rows, range_end - range_start, 0).ravel()
+
+        num_pix = np.sum(range_len)
+        range_offsets = np.cumsum(range_len) - range_len
+        pix = np.arange(num_pix) - np.repeat(range_offsets, range_len) + np.repeat(range_start.ravel(), range_len)
+        stamp_index = np.repeat(np.repeat(np.arange(numstamps), ny_stamp), range_len)
+        stamp_row = np.repeat(np.tile(np.arange(ny_stamp), numstamps), range_len)
+        stamp_col = sorted_pix[pix] - np.repeat((rows * nx + stamp_lefts[:, None]).ravel(), range_len)
+
+        models[np.array(model_indices)[stamp_index], sort_order[pix]] = stamps[stamp_index, stamp_row, stamp_col]
+
+        return models
+
+
+    def _place_stamp(self, pa, wv, ref_wv, flipx, ref_center):
+        """
+        Model PSF stamp of an image, and where it goes in the image
+
+        Args:
+            pa: parallactic angle of the image [degrees]
+            wv: wavelength of the image
+            ref_wv: wavelength of science image
+            flipx: if True, flip x coordinate in final image
+            ref_center: center of image
+
+        Return:
+            stamp_lower: y index of the first row of the stamp in the image
+            stamp_left: x index of the first column of the stamp in the image
+            stamp: 2D array of the model PSF
+        """
         # retrieve wavelength, x and y dimensions of input psf
         numwv, ny_psf, nx_psf =  self.input_psfs.shape[-3:]
 
         # create stamp for instrumental psf
         psf_lower = int(np.floor(ny_psf/2.0))    # lower bound
-        psf_upper = int(np.ceil(ny_psf/2.0))     # upper bound
         psf_left = int(np.floor(nx_psf/2.0))   # left bound
-        psf_right = int(np.ceil(nx_psf/2.0))    # right bound
-
-        # a blank img array to write model PSFs into
-        whiteboard = np.zeros((ny,nx))
-        if debug:
-            canvases = []
-        models = []
 
-        for pa, wv, is_rdi in zip(pas, wvs, rdi_indices):
-            # if RDI, generate a blank canvas since we assume there is no astrophysical signal in the RDI frames
-            if is_rdi:
-                models.append(np.zeros(np.size(section_ind)))
-                continue
+        # grab PSF given wavelength
+        wv_index = spec.find_nearest(self.input_psfs_wvs,wv)[1]
+
+        # find center of psf
+        # to reduce calculation of sin and cos, see if it has already been calculated before
+        if pa not in self.psf_centx_notscaled:
+            # flipx requires the opposite rotation
+            sign = -1.
+            if flipx:
+                sign = 1.
+            self.psf_centx_notscaled[pa] = self.sep * np.cos(np.radians(90. - sign*self.pa - pa))
+            self.psf_centy_notscaled[pa] = self.sep * np.sin(np.radians(90. - sign*self.pa - pa))
+        scale = ref_wv/wv
+        psf_centx = scale * self.psf_centx_notscaled[pa]
+        psf_centy = scale * self.psf_centy_notscaled[pa]
+
+        # round to nearest pixel and add offset for center
+        planet_centx = int(round(psf_centx + ref_center[0]))
+        planet_centy = int(round(psf_centy + ref_center[1]))
+
+        # recenter stamp coordinate system about the location of the planet
+        stamp_left = planet_centx-psf_left
+        stamp_lower = planet_centy-psf_lower
+
+        # coordinates of the first pixel of the stamp with respect to the model PSF. The stamp only depends on them
+        offset_x = stamp_left - ref_center[0] - psf_centx
+        offset_y = stamp_lower - ref_center[1] - psf_centy
+        if self.stamp_quantization is not None:
+            offset_x = np.round(offset_x / self.stamp_quantization) * self.stamp_quantization
+            offset_y = np.round(offset_y / self.stamp_quantization) * self.stamp_quantization
+
+        if not self.psfs_in_time:
+            pa_index = None
+        else:
+            pa_index = spec.find_nearest(self.input_psfs_pas, pa)[1]
 
-            # grab PSF given wavelength
-            wv_index = spec.find_nearest(self.input_psfs_wvs,wv)[1]
-
-            # find center of psf
-            # to reduce calculation of sin and cos, see if it has already been calculated before
-            if pa not in self.psf_centx_notscaled:
-                # flipx requires the opposite rotation
-                sign = -1.
-                if flipx:
-                    sign = 1.
-                self.psf_centx_notscaled[pa] = self.sep * np.cos(np.radians(90. - sign*self.pa - pa))
-                self.psf_centy_notscaled[pa] = self.sep * np.sin(np.radians(90. - sign*self.pa - pa))
-            psf_centx = (ref_wv/wv) * self.psf_centx_notscaled[pa]
-            psf_centy = (ref_wv/wv) * self.psf_centy_notscaled[pa]
-
-            # create a coordinate system for the image that is with respect to the model PSF
-            # round to nearest pixel and add offset for center
-            planet_centx = int(round(psf_centx + ref_center[0]))
-            planet_centy = int(round(psf_centy + ref_center[1]))
-            
-            # recenter stamp coordinate system about the location of the planet
-            stamp_left = planet_centx-psf_left
-            stamp_right = planet_centx+psf_right
-            stamp_lower = planet_centy-psf_lower
-            stamp_upper = planet_centy+psf_upper
-
-            # Save the stamp length and width as variables for slicing the image
-            stamp_len = slice(stamp_lower, stamp_upper)
-            stamp_width = slice(stamp_left,stamp_right)
-
-            x_vec_stamp_centered = np.copy(x_grid[0, stamp_width]) - psf_centx
-            y_vec_stamp_centered = np.copy(y_grid[stamp_len, 0]) - psf_centy
+        stamp_key = (wv_index, pa_index, offset_x, offset_y, scale)
+        if stamp_key in self._stamp_cache:
+            stamp = self._stamp_cache[stamp_key]
+        else:
             # rescale to account for the align and scaling of the refernce PSFs
             # e.g. for longer wvs, the PSF has shrunk, so we need to shrink the coordinate system
-            x_vec_stamp_centered /= (ref_wv/wv)
-            y_vec_stamp_centered /= (ref_wv/wv)
+            x_vec_stamp_centered = (offset_x + np.arange(nx_psf)) / scale
+            y_vec_stamp_centered = (offset_y + np.arange(ny_psf)) / scale
 
-            # use intepolation spline to generate a model PSF of planet and write to temp img
+            # use intepolation spline to generate a model PSF of planet
             if not self.psfs_in_time:
                 # just grab the right wavelength
                 psf_func = self.psfs_func_list[wv_index]
             else:
-                pa_index = spec.find_nearest(self.input_psfs_pas, pa)[1]
                 psf_func = self.psfs_func_list[pa_index][wv_index]
-            whiteboard[stamp_len, stamp_width] = \
-                    psf_func(x_vec_stamp_centered,y_vec_stamp_centered).transpose()
-            
-            # if specified, make field dependent PSF correction
-            if self.field_dependent_correction is not None:
-                # find distance from center in x and y dimensions
-                dx = x_grid[stamp_len, stamp_width]
-                dy = y_grid[stamp_len, stamp_width]
-                minx = min(x_vec_stamp_centered, key=abs) 
-                miny = min(y_vec_stamp_centered, key=abs)
-                whiteboard[stamp_len, stamp_width] = \
-                        self.field_dependent_correction(whiteboard[stamp_len, stamp_width], dx, dy)
-            # write model img to output (segment is collapsed in x/y so need to reshape)
-            whiteboard.shape = [input_img_shape[0] * input_img_shape[1]]
-            segment_with_model = copy(whiteboard[section_ind])
-            whiteboard.shape = [input_img_shape[0],input_img_shape[1]]
-
-           
-
-            models.append(segment_with_model)
-
-            # clean whiteboard
-            whiteboard[stamp_len, stamp_width] = 0
-
-        
-
+            stamp = psf_func(x_vec_stamp_centered,y_vec_stamp_centered).transpose()
 
-        return np.array(models)
+            # drop the oldest stamps if the cache is full
+            while len(self._stamp_cache) >= stamp_cache_size:
+                del self._stamp_cache[next(iter(self._stamp_cache))]
+            self._stamp_cache[stamp_key] = stamp
 
+        # if specified, make field dependent PSF correction
+        if self.field_dependent_correction is not None:
+            # find distance from center in x and y dimensions
+            dx, dy = np.meshgrid(np.arange(stamp_left, stamp_left + nx_psf) - ref_center[0],
+                                 np.arange(stamp_lower, stamp_lower + ny_psf) - ref_center[1])
+            stamp = self.field_dependent_correction(np.copy(stamp), dx, dy)
 
+        return stamp_lower, stamp_left, stamp
 
 
     def fm_from_eigen(self, klmodes=None, evals=None, evecs=None, input_img_shape=None, input_img_num=None, ref_psfs_indicies=None, section_ind=None, aligned_imgs=None, pas=None,
                      wvs=None, radstart=None, radend=None, phistart=None, phiend=None, padding=None,IOWA = None, ref_center=None,
                      parang=None, ref_wv=None, numbasis=None, fmout=None, perturbmag=None, klipped=None, covar_files=None, flipx=True, 
-                     rdi_psfs=None, **kwargs):
+                     rdi_psfs=None, model_cache=None, **kwargs):
         """
         Generate forward models using the KL modes, eigenvectors, and eigenvectors from KLIP. Calls fm.py functions to
         perform the forward modelling
@@ -332,6 +416,8 @@ class FMPlanetPSF(NoFM):
             klipped: PSF subtracted image. Shape of ( size(section), b)
             ref_rdi_indices: array of N+M indicating N ADI/SDI images (0's) and M RDI images (1;s).
             rdi_psfs: array of M RDI reference images in this sector.  
+            model_cache: dict shared by the science images of a batch to reuse the reference models (see
+                         generate_models)
             kwargs: any other variables that we don't use but are part of the input
         """
         sci = aligned_imgs[input_img_num, section_ind[0]]
@@ -349,11 +435,11 @@ class FMPlanetPSF(NoFM):
 
 
         # generate models for the PSF of the science image
-        model_sci = self.generate_models(input_img_shape, section_ind, [parang], [ref_wv], radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, [0])[0]
+        model_sci = self.generate_models(input_img_shape, section_ind, [parang], [ref_wv], radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, [0], model_cache=model_cache)[0]
         model_sci *= self.flux_conversion[input_img_num] * self.spectrallib[0][np.where(self.input_psfs_wvs == ref_wv)] * self.dflux
 
         # generate models of the PSF for each reference segments. Output is of shape (N, pix_in_segment)
-        models_ref = self.generate_models(input_img_shape, section_ind, pas, wvs, radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, ref_rdi_indices)
+        models_ref = self.generate_models(input_img_shape, section_ind, pas, wvs, radstart, radend, phistart, phiend, padding, ref_center, parang, ref_wv, flipx, ref_rdi_indices, model_cache=model_cache)
 
         # Calculate the spectra to determine the flux of each model reference PSF
         total_imgs = np.size(self.flux_conversion)
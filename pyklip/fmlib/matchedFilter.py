@@ -7,11 +7,13 @@ import numpy as np
 import pyklip.spectra_management as spec
 import os
 import itertools
+import warnings
 
 from pyklip.fmlib.nofm import NoFM
 import pyklip.fm as fm
 
 from scipy import interpolate
+from scipy import sparse
 from copy import copy
 
 import astropy.io.fits as pyfits
@@ -20,6 +22,8 @@ from time import time
 import scipy.ndimage as ndimage
 
 debug = False
+# number of pixels projected at once in the fast mode of MatchedFilter
+fast_fm_chunk_size = 256
 
 class MatchedFilter(NoFM):
     """
@@ -43,7 +47,8 @@ class MatchedFilter(NoFM):
                  background_width = None,
                  save_bbfm = None,
                  save_fm = None,
-                 save_fmout_path = None):
+                 save_fmout_path = None,
+                 fast_fm_step = None):
         '''
         Defining the forward model matched filter parameters
 
@@ -81,6 +86,12 @@ class MatchedFilter(NoFM):
             save_bbfm: If true, saves the broadband forward models
             savebfm: If true, saves all the forward models. This is only tractable for extremely small dataset.
             save_fmout_path: If not None, path to a directory where to save fmout at the end.
+            fast_fm_step: If not None, use the approximate fast mode. The forward model is only calculated on a grid of
+                    positions spaced by fast_fm_step pixels in each sector and it is bilinearly interpolated in between.
+                    The projections on the klipped data are then calculated for all the pixels with batched matrix
+                    products. Larger steps are faster but less accurate, and fast_fm_step=1 gives the same result as
+                    the exact matched filter. It cannot be used with save_bbfm or save_fm and it is ignored when
+                    fakes_sepPa_list is defined. (Default None, exact matched filter)
 
         '''
         # allocate super class
@@ -96,6 +107,10 @@ class MatchedFilter(NoFM):
             raise ValueError("save_bbfm or save_fm cannot be used at the same time ")
         self.save_fmout_path = save_fmout_path
 
+        if fast_fm_step is not None and (self.save_bbfm or self.save_fm):
+            raise ValueError("fast_fm_step cannot be used with save_bbfm or save_fm")
+        self.fast_fm_step = fast_fm_step
+
         if rm_edge is not None:
             self.rm_edge = rm_edge
         else:
@@ -160,7 +175,6 @@ class MatchedFilter(NoFM):
         x_psf_grid, y_psf_grid = np.meshgrid(np.arange(nx_psf * 1.)-nx_psf//2,np.arange(ny_psf* 1.)-ny_psf//2)
         psfs_func_list = []
         self.input_psfs[np.where(np.isnan(self.input_psfs))] = 0
-        import warnings
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             for wv_index in range(numwv_psf):
@@ -446,6 +460,14 @@ class MatchedFilter(NoFM):
             row_id_list = row_id_list_tmp
             col_id_list = col_id_list_tmp
 
+        # Approximate fast mode: FM on a coarse grid of positions and batched projections
+        if self.fast_fm_step is not None and self.fakes_sepPa_list is None:
+            self._fast_fm_from_eigen(klmodes, evals, evecs, input_img_shape, input_img_num, ref_psfs_indicies,
+                                     section_ind, sci, refs, pas, wvs, ref_rdi_indices, radstart, radend, phistart,
+                                     phiend, padding, ref_center, parang, ref_wv, fmout1, klipped, flipx, rdi_psfs,
+                                     r_list, pa_list, row_id_list, col_id_list)
+            return
+
         greenboard = np.zeros((self.ny,self.nx))
         x_bbfm, y_bbfm = np.meshgrid(np.arange(self.ny, dtype=float), np.arange(self.nx, dtype=float))
         # flip x if needed to get East left of North
@@ -711,6 +733,281 @@ class MatchedFilter(NoFM):
                 # exit()
 
 
+    def _fast_fm_from_eigen(self, klmodes, evals, evecs, input_img_shape, input_img_num, ref_psfs_indicies,
+                            section_ind, sci, refs, pas, wvs, ref_rdi_indices, radstart, radend, phistart, phiend,
+                            padding, ref_center, parang, ref_wv, fmout1, klipped, flipx, rdi_psfs, r_list, pa_list,
+                            row_id_list, col_id_list):
+        """
+        Approximate fast version of the loop over the pixels of the sector in fm_from_eigen().
+
+        The FM is only calculated for the pixels of the sector falling on a grid spaced by self.fast_fm_step pixels
+        (the nodes). The distortion of the PSF by KLIP (model PSF minus FM) is saved as a stamp centered on the planet,
+        and it is bilinearly interpolated between the nodes for every pixel of the sector after correcting for the
+        rotation and the subpixel position of the planet. The dot products with the klipped data, the norms of the
+        models and the local statistics of the data are then calculated for chunks of pixels with batched sparse and
+        dense matrix products. Only the interpolation of the FM is approximate.
+
+        Args:
+            sci: array of size p, science image in this sector.
+            refs: array of shape (N, p), reference images in this sector including the RDI frames.
+            ref_rdi_indices: array of size N, 1 for the RDI frames in refs and 0 otherwise.
+            fmout1: numpy output array of shape (4,self.N_spectra,self.N_numbasis,self.N_frames,self.ny,self.nx)
+            r_list: separations of the pixels of the sector [pixels]
+            pa_list: position angles of the pixels of the sector [radians]
+            row_id_list: row indices of the pixels of the sector
+            col_id_list: column indices of the pixels of the sector
+            See fm_from_eigen() for the other arguments.
+        """
+        num_pix = np.size(row_id_list)
+        if num_pix == 0:
+            return
+        N_KL_id = 0 # numbasis has a single element
+        ny, nx = input_img_shape[0], input_img_shape[1]
+        row_ids = np.array(row_id_list, dtype=int)
+        col_ids = np.array(col_id_list, dtype=int)
+        seps = np.array(r_list, dtype=float)
+        pas_fk = np.rad2deg(np.array(pa_list, dtype=float))
+
+        sign = -1.
+        if flipx:
+            sign = 1.
+        # Position of the planet in the science image for every pixel, as in generate_model_sci()
+        psf_centx = seps * np.cos(np.radians(90. - sign*pas_fk - parang))
+        psf_centy = seps * np.sin(np.radians(90. - sign*pas_fk - parang))
+        planet_cols = np.round(psf_centx + ref_center[0]).astype(int)
+        planet_rows = np.round(psf_centy + ref_center[1]).astype(int)
+        # subpixel position of the planet with respect to the center of its pixel
+        phase_rows = psf_centy + ref_center[1] - planet_rows
+        phase_cols = psf_centx + ref_center[0] - planet_cols
+        in_image = (planet_rows >= 0) & (planet_rows < ny) & (planet_cols >= 0) & (planet_cols < nx)
+        planet_rows = np.clip(planet_rows, 0, ny - 1)
+        planet_cols = np.clip(planet_cols, 0, nx - 1)
+
+        # Klipped data and footprint of the sector, padded so that a stamp centered on any pixel of the image fits
+        stamp_ny, stamp_nx = self.row_m + self.row_p, self.col_m + self.col_p
+        stamp_size = stamp_ny * stamp_nx
+        stamp_disk = np.isnan(self.stamp_PSF_mask).ravel()
+        pad_width = ((self.row_m, self.row_p), (self.col_m, self.col_p))
+        klipped_section = np.array(klipped[:, N_KL_id], dtype=float)
+        klipped_canvas = np.zeros(ny * nx) + np.nan
+        klipped_canvas[section_ind[0]] = klipped_section
+        klipped_canvas = np.pad(klipped_canvas.reshape((ny, nx)), pad_width, mode="constant", constant_values=np.nan)
+        sector_canvas = np.zeros(ny * nx, dtype=bool)
+        sector_canvas[section_ind[0]] = True
+        sector_canvas = np.pad(sector_canvas.reshape((ny, nx)), pad_width, mode="constant", constant_values=False)
+
+        # 1/ Calculate the FM at the nodes like in the exact matched filter
+        step = int(self.fast_fm_step)
+        node_pix = np.where((row_ids % step == 0) & (col_ids % step == 0) & in_image)[0]
+        if np.size(node_pix) == 0:
+            node_pix = np.array([num_pix // 2])
+        node_templates = np.zeros((self.N_spectra, np.size(node_pix), stamp_size))
+        node_support = np.zeros((np.size(node_pix), stamp_size))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for node_id, pix_id in enumerate(node_pix):
+                sep_fk, pa_fk = seps[pix_id], pas_fk[pix_id]
+                try:
+                    model_sci, mask = self.generate_model_sci(input_img_shape, section_ind, parang, ref_wv,
+                                                             radstart, radend, phistart, phiend, padding, ref_center,
+                                                             parang, ref_wv, sep_fk, pa_fk, flipx)
+                except ValueError:
+                    # the PSF stamp could not be drawn in the image
+                    continue
+                where_fk = np.where(mask == 2)[0]
+
+                # position of the pixels of the FM in the stamp centered on the planet
+                fk_rows, fk_cols = np.unravel_index(section_ind[0][where_fk], (ny, nx))
+                fk_rows = fk_rows - planet_rows[pix_id] + self.row_m
+                fk_cols = fk_cols - planet_cols[pix_id] + self.col_m
+                in_stamp = (fk_rows >= 0) & (fk_rows < stamp_ny) & (fk_cols >= 0) & (fk_cols < stamp_nx)
+                if np.sum(in_stamp) == 0:
+                    continue
+                fk_stamp_ind = fk_rows[in_stamp] * stamp_nx + fk_cols[in_stamp]
+                node_support[node_id, fk_stamp_ind] = 1
+
+                if self.disable_FM:
+                    # the model PSF is used without any distortion
+                    continue
+                models_ref = self.generate_models(input_img_shape, section_ind, pas, wvs, radstart, radend,
+                                                  phistart, phiend, padding, ref_center, parang, ref_wv,
+                                                  sep_fk, pa_fk, flipx, ref_rdi_indices)
+                for spec_id in range(self.N_spectra):
+                    model_sci_fk = model_sci[where_fk] * self.spectrallib[spec_id][input_img_num]
+                    input_spectrum = self.spectrallib[spec_id][ref_psfs_indicies]
+                    if rdi_psfs is not None:
+                        input_spectrum = np.append(input_spectrum, np.zeros(rdi_psfs.shape[0]), axis=0)
+                    delta_KL = fm.perturb_specIncluded(evals, evecs, klmodes, refs,
+                                                       models_ref * input_spectrum[:, None])
+                    postklip_psf_fk = calculate_fm_opti(delta_KL, klmodes, sci, np.copy(model_sci_fk),
+                                                        delta_KL[:, where_fk], klmodes[:, where_fk])[0]
+                    # only the distortion of the PSF by KLIP is interpolated between the nodes
+                    node_templates[spec_id, node_id, fk_stamp_ind] = (model_sci_fk - postklip_psf_fk)[in_stamp]
+
+        node_valid = np.sum(node_support, axis=1) > 0
+        if np.sum(node_valid) == 0:
+            return
+        node_pix = node_pix[node_valid]
+        # the coverage of the stamps is interpolated with the templates, and a last empty element is added for the
+        # pixels outside of the stamps
+        node_templates = np.append(node_templates[:, node_valid, :], node_support[None, node_valid, :], axis=0)
+        node_templates = np.append(node_templates.reshape((self.N_spectra + 1, -1)),
+                                   np.zeros((self.N_spectra + 1, 1)), axis=1)
+        num_nodes = np.size(node_pix)
+
+        # 2/ Bilinear interpolation weights of the nodes for every pixel of the sector
+        node_map = np.zeros((ny + step, nx + step), dtype=int) - 1
+        node_map[row_ids[node_pix], col_ids[node_pix]] = np.arange(num_nodes)
+        row0 = (row_ids // step) * step
+        col0 = (col_ids // step) * step
+        frac_row = (row_ids - row0) / float(step)
+        frac_col = (col_ids - col0) / float(step)
+        weights_pix, weights_node, weights_val = [], [], []
+        for drow, dcol, weight in [(0, 0, (1 - frac_row) * (1 - frac_col)), (0, step, (1 - frac_row) * frac_col),
+                                   (step, 0, frac_row * (1 - frac_col)), (step, step, frac_row * frac_col)]:
+            corner_node = node_map[row0 + drow, col0 + dcol]
+            where_corner = np.where((corner_node >= 0) & (weight > 0))[0]
+            weights_pix.append(where_corner)
+            weights_node.append(corner_node[where_corner])
+            weights_val.append(weight[where_corner])
+        weights_pix = np.concatenate(weights_pix)
+        weights_node = np.concatenate(weights_node)
+        weights_val = np.concatenate(weights_val)
+        # Pixels without any node around them (edges of the sector) take the FM of the nearest node
+        orphans = np.setdiff1d(np.arange(num_pix), weights_pix)
+        if np.size(orphans) != 0:
+            dist2 = (row_ids[orphans, None] - row_ids[None, node_pix])**2 + \
+                    (col_ids[orphans, None] - col_ids[None, node_pix])**2
+            weights_pix = np.concatenate([weights_pix, orphans])
+            weights_node = np.concatenate([weights_node, np.argmin(dist2, axis=1)])
+            weights_val = np.concatenate([weights_val, np.ones(np.size(orphans))])
+        weights = sparse.csr_matrix((weights_val, (weights_pix, weights_node)), shape=(num_pix, num_nodes))
+
+        # 3/ PSF stamps of the planet at the exact position of every pixel
+        wv_index = spec.find_nearest(self.input_psfs_wvs, ref_wv)[1]
+        stamp_rows, stamp_cols = np.indices((stamp_ny, stamp_nx))
+        stamp_rows, stamp_cols = stamp_rows.ravel(), stamp_cols.ravel()
+        x_stamp_centered = stamp_cols[None, :] + (planet_cols - self.col_m - ref_center[0] - psf_centx)[:, None]
+        y_stamp_centered = stamp_rows[None, :] + (planet_rows - self.row_m - ref_center[1] - psf_centy)[:, None]
+        psf_stamps = self.psfs_func_list[wv_index](x_stamp_centered.ravel(), y_stamp_centered.ravel(), grid=False)
+        psf_stamps = psf_stamps.reshape((num_pix, stamp_size))
+
+        # Coordinates of the pixels of the sector to define the arcs where the local statistics are calculated, as in
+        # generate_model_sci()
+        section_rows, section_cols = np.unravel_index(section_ind[0], (ny, nx))
+        section_x = section_cols - ref_center[0]
+        section_y = section_rows - ref_center[1]
+        section_r = abs(section_x + section_y * 1j)
+        section_th = (np.arctan2(sign * section_x, section_y) - sign * np.radians(parang)) % (2.0 * np.pi)
+        finite_section = np.isfinite(klipped_section)
+        klipped_section0 = np.where(finite_section, klipped_section, 0)
+        w = self.background_width
+
+        # 4/ Interpolate the FM and project it on the klipped data for chunks of pixels
+        planet_angles = np.arctan2(psf_centy, psf_centx)
+        for start in range(0, num_pix, fast_fm_chunk_size):
+            chunk = slice(start, start + fast_fm_chunk_size)
+            chunk_pix = np.arange(num_pix)[chunk]
+            chunk_size = np.size(chunk_pix)
+
+            # The distortion of the PSF by KLIP rotates with the planet and the planet is not at the same subpixel
+            # position in all the stamps. The stamps of the nodes are bilinearly resampled in the frame of the planet
+            # of each pixel before being interpolated between the nodes.
+            chunk_weights = weights[chunk].tocoo()
+            entry_pix = chunk_pix[chunk_weights.row]
+            entry_node = chunk_weights.col
+            dy = stamp_rows[None, :] - self.row_m - phase_rows[entry_pix, None]
+            dx = stamp_cols[None, :] - self.col_m - phase_cols[entry_pix, None]
+            dtheta = (planet_angles[node_pix][entry_node] - planet_angles[entry_pix])[:, None]
+            src_rows = np.sin(dtheta) * dx + np.cos(dtheta) * dy + self.row_m + phase_rows[node_pix][entry_node, None]
+            src_cols = np.cos(dtheta) * dx - np.sin(dtheta) * dy + self.col_m + phase_cols[node_pix][entry_node, None]
+            src_row0 = np.floor(src_rows).astype(int)
+            src_col0 = np.floor(src_cols).astype(int)
+            frac_rows = src_rows - src_row0
+            frac_cols = src_cols - src_col0
+            entry_distortion = np.zeros((self.N_spectra + 1,) + src_rows.shape)
+            for drow, dcol in itertools.product(range(2), range(2)):
+                corner_rows = src_row0 + drow
+                corner_cols = src_col0 + dcol
+                # corners outside of the stamps point to the last, empty, element of the templates
+                corner_ind = np.where((corner_rows >= 0) & (corner_rows < stamp_ny) &
+                                      (corner_cols >= 0) & (corner_cols < stamp_nx),
+                                      entry_node[:, None] * stamp_size + corner_rows * stamp_nx + corner_cols, -1)
+                corner_weights = np.abs(1 - drow - frac_rows) * np.abs(1 - dcol - frac_cols)
+                entry_distortion += node_templates[:, corner_ind] * corner_weights[None, :, :]
+            # sum the nodes of each pixel
+            entry_sum = sparse.csr_matrix((chunk_weights.data, (chunk_weights.row, np.arange(np.size(entry_pix)))),
+                                          shape=(chunk_size, np.size(entry_pix)))
+            distortion = np.array([entry_sum @ entry_distortion[k] for k in range(self.N_spectra + 1)])
+            # the stamps of the nodes only cover their sector, so the interpolation is normalized by their coverage
+            support = distortion[-1]
+            support[np.where(support <= 0)] = np.inf
+            distortion = distortion[:-1] / support[None, :, :]
+
+            # Klipped data around the planet
+            rows = planet_rows[chunk, None] + stamp_rows[None, :]
+            cols = planet_cols[chunk, None] + stamp_cols[None, :]
+            klipped_stamps = klipped_canvas[rows, cols]
+            where_fk = sector_canvas[rows, cols] & stamp_disk[None, :]
+            finite_fk = where_fk & np.isfinite(klipped_stamps)
+            num_fk = np.sum(where_fk, axis=1)
+            num_finite_fk = np.sum(finite_fk, axis=1)
+            klipped_fk0 = np.where(finite_fk, klipped_stamps, 0)
+            quitnow = (num_fk == 0) | ~in_image[chunk]
+            if self.rm_edge:
+                quitnow |= num_finite_fk / np.maximum(num_fk, 1).astype(float) <= self.edge_threshold
+
+            # Sums of the klipped data in the arcs around the planets excluding the planets (mask == 1 in
+            # generate_model_sci()) to get the local sky background and variance
+            thstart = ((np.radians(pas_fk[chunk]) - float(w) / seps[chunk]) % (2.0 * np.pi))[:, None]
+            thend = ((np.radians(pas_fk[chunk]) + float(w) / seps[chunk]) % (2.0 * np.pi))[:, None]
+            in_arc = (section_r[None, :] >= seps[chunk, None] - w) & (section_r[None, :] < seps[chunk, None] + w)
+            in_arc &= np.where(thstart < thend,
+                               (section_th[None, :] >= thstart) & (section_th[None, :] < thend),
+                               (section_th[None, :] >= thstart) | (section_th[None, :] < thend))
+            disk_rows = section_rows[None, :] - planet_rows[chunk, None] + self.row_m
+            disk_cols = section_cols[None, :] - planet_cols[chunk, None] + self.col_m
+            in_stamp = (disk_rows >= 0) & (disk_rows < stamp_ny) & (disk_cols >= 0) & (disk_cols < stamp_nx)
+            in_arc &= ~(in_stamp & stamp_disk[np.clip(disk_rows, 0, stamp_ny - 1) * stamp_nx +
+                                              np.clip(disk_cols, 0, stamp_nx - 1)])
+            in_arc = in_arc.astype(float)
+            num_arc = np.sum(in_arc, axis=1)
+            num_finite_arc = in_arc @ finite_section.astype(float)
+            sum_arc = in_arc @ klipped_section0
+            sum2_arc = in_arc @ klipped_section0**2
+            with np.errstate(divide="ignore", invalid="ignore"):
+                sky = sum_arc / num_finite_arc
+            # background = arc + planet (mask >= 1 in generate_model_sci())
+            npix = num_finite_arc + num_finite_fk
+            sum_bkg = sum_arc + np.sum(klipped_fk0, axis=1)
+            sum2_bkg = sum2_arc + np.sum(klipped_fk0**2, axis=1)
+            bad_bkg = np.zeros(chunk_size, dtype=bool)
+            if self.rm_edge:
+                bad_bkg = npix / np.maximum(num_arc + num_fk, 1) <= self.edge_threshold
+
+            for spec_id in range(self.N_spectra):
+                fm_stamps = psf_stamps[chunk] * self.spectrallib[spec_id][input_img_num] - distortion[spec_id]
+                fm_stamps = np.where(finite_fk, fm_stamps, 0)
+                dot_prod = np.sum((klipped_fk0 - sky[:, None]) * fm_stamps, axis=1)
+                model_norm = np.sum(fm_stamps * fm_stamps, axis=1)
+
+                # variance of the background after removing the best fit of the model
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    amplitude = dot_prod / model_norm
+                    sum_res = sum_bkg - npix * sky - amplitude * np.sum(fm_stamps, axis=1)
+                    sum2_res = sum2_bkg - 2 * sky * sum_bkg + npix * sky**2 - 2 * amplitude * dot_prod + \
+                               amplitude**2 * model_norm
+                    variance = sum2_res / npix - (sum_res / npix)**2
+                variance = np.where(bad_bkg, np.nan, variance)
+                chunk_npix = np.where(bad_bkg, np.nan, npix)
+                # no data to define the sky background
+                dot_prod[np.where(np.isnan(sky))] = 0
+                model_norm[np.where(np.isnan(sky))] = 0
+
+                for term_id, term in enumerate([dot_prod, model_norm, variance, chunk_npix]):
+                    fmout1[term_id, spec_id, N_KL_id, input_img_num, row_ids[chunk], col_ids[chunk]] = \
+                        np.where(quitnow, np.nan, term)
+
     def fm_end_sector(self, interm_data=None, fmout=None, sector_index=None,
                                section_indicies=None):
         """
@@ -150,6 +150,17 @@ class NoFM(object):
         """
         return False
 
+    def regions_of_interest(self):
+        """
+        Declares the regions of the image where the forward model is needed. klip_parallelized() only runs KLIP-FM on
+        the sectors that intersect one of them (before any covariance matrix is computed).
+
+        Returns:
+            None to run on every sector (default), or a list of (sep, pa, radius) circular regions. sep and radius
+            are in pixels and pa in degrees, in the final (North up) frame.
+        """
+        return None
+
     def save_fmout(self, dataset, fmout, outputdir, fileprefix, numbasis, klipparams=None, calibrate_flux=False,
                    spectrum=None, pixel_weights=1):
         """
@@ -273,31 +273,84 @@ def NMFsubtraction(trg, model, frac = 1):
         result[i] = trg-model*fraction
     return result
     
-def NMFbff(trg, model, fracs = None):
+def _NMFbff_clipped_std(trg, model, fracs):
+    """Sigma-clipped standard deviation of the residuals trg - model*frac for every frac at once.
+
+    The clipping is done in place on a (n_frac, p) array and reproduces the frame-by-frame loop: while a residual
+    still has both pixels above median + 3 std and pixels below median - 10 std, the high pixels are masked, the
+    statistics are recomputed, and the low pixels are masked.
+
+    Args:
+        trg: 1D array, target image.
+        model: 1D array, NMF model of the target.
+        fracs: 1D array of the fractions to be tested.
+    Returns:
+        std_infos: 1D array of the clipped standard deviation for each fraction.
+    """
+    fracs = np.atleast_1d(fracs)
+    data_slices = np.asarray(trg, dtype=float)[None, :] - np.asarray(model, dtype=float)[None, :] * fracs[:, None]
+
+    active = np.arange(fracs.shape[0])
+    while active.size > 0:
+        data_active = data_slices[active]
+        medians = np.nanmedian(data_active, axis=1)[:, None]
+        stds = np.nanstd(data_active, axis=1)[:, None]
+        too_high = data_active > medians + 3*stds
+        too_low = data_active < medians - 10*stds
+        keep_clipping = np.any(too_high, axis=1) & np.any(too_low, axis=1)
+        if not np.any(keep_clipping):
+            break
+        active = active[keep_clipping]
+        data_active = data_active[keep_clipping]
+        data_active[too_high[keep_clipping]] = np.nan
+        medians = np.nanmedian(data_active, axis=1)[:, None]
+        stds = np.nanstd(data_active, axis=1)[:, None]
+        data_active[data_active < medians - 10*stds] = np.nan
+        data_slices[active] = data_active
+
+    return np.nanstd(data_slices, axis=1)
+
+def NMFbff(trg, model, fracs = None, method = 'grid'):
     """BFF subtraction.
     Args:
         trg:
         model:
         fracs: (if need to be).
+        method: "grid" evaluates every value in fracs (vectorized), "golden" runs a golden-section search between
+                the smallest and largest value of fracs, stopping at the grid spacing.
     Returns: 
         best frac
     """
     
     if fracs is None:
         fracs = np.arange(0.60, 1.001, 0.001)
-    
-    std_infos = np.zeros(fracs.shape)
-    
-    for i, frac in enumerate(fracs):
-        data_slice = trg - model*frac
-        while 1:
-            if np.nansum(data_slice > np.nanmedian(data_slice) + 3*np.nanstd(data_slice)) == 0 or np.nansum(data_slice < np.nanmedian(data_slice) -10*np.nanstd(data_slice)) == 0:
-                break
-            data_slice[data_slice > np.nanmedian(data_slice) + 3*np.nanstd(data_slice)] = np.nan
-            data_slice[data_slice < np.nanmedian(data_slice) - 10*np.nanstd(data_slice)] = np.nan
-        std_info = np.nanstd(data_slice)
-        std_infos[i] = std_info
-    return fracs[np.where(std_infos == np.nanmin(std_infos))]   
+    fracs = np.atleast_1d(fracs)
+
+    if method == 'grid':
+        std_infos = _NMFbff_clipped_std(trg, model, fracs)
+        return fracs[np.where(std_infos == np.nanmin(std_infos))]
+    elif method == 'golden':
+        if fracs.shape[0] > 1:
+            tol = np.min(np.abs(np.diff(np.sort(fracs))))
+        else:
+            tol = 0
+        invphi = (np.sqrt(5) - 1) / 2
+        lower, upper = np.min(fracs), np.max(fracs)
+        frac1 = upper - invphi * (upper - lower)
+        frac2 = lower + invphi * (upper - lower)
+        std1, std2 = _NMFbff_clipped_std(trg, model, np.array([frac1, frac2]))
+        while (upper - lower) > tol:
+            if std1 <= std2:
+                upper, frac2, std2 = frac2, frac1, std1
+                frac1 = upper - invphi * (upper - lower)
+                std1 = _NMFbff_clipped_std(trg, model, np.array([frac1]))[0]
+            else:
+                lower, frac1, std1 = frac1, frac2, std2
+                frac2 = lower + invphi * (upper - lower)
+                std2 = _NMFbff_clipped_std(trg, model, np.array([frac2]))[0]
+        return np.array([frac1 if std1 <= std2 else frac2])
+    else:
+        raise ValueError("method must be 'grid' or 'golden', got {0}".format(method))
    
 def nmf_math(sci, ref_psfs, sci_err = None, ref_psfs_err = None, componentNum = 5, maxiters = 1e5, oneByOne = True, trg_type = 'disk',
             ignore_mask = None, path_save = None, recalculate = False, 
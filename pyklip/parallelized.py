@@ -34,7 +34,8 @@ if debug is True:
 
 
 def _tpool_init(original_imgs, original_imgs_shape, aligned_imgs, aligned_imgs_shape, output_imgs, output_imgs_shape,
-                pa_imgs, wvs_imgs, centers_imgs, filenums_imgs, psf_library, psf_library_shape):
+                pa_imgs, wvs_imgs, centers_imgs, filenums_imgs, psf_library, psf_library_shape, psf_library_index=None,
+                psf_library_gram=None):
     """
     Initializer function for the thread pool that initializes various shared variables. Main things to note that all
     except the shapes are shared arrays (mp.Array).
@@ -51,10 +52,13 @@ def _tpool_init(original_imgs, original_imgs_shape, aligned_imgs, aligned_imgs_s
         pa_imgs, wvs_imgs: arrays of size N with the PA and wavelength
         centers_img: array of shape (N,2) with [x,y] image center for image frame
         filenums_imgs (np.array): array of size N with the filenumber corresponding to each image. 
-        psf_library: array of shape (N_lib, y, x) with N_lib PSF library images
+        psf_library: array of shape (N_lib, y, x) with N_lib PSF library images, or the filename of a pixel-major
+                     (y*x, N_lib) .npy file (see rdi.PSFLibrary.save_pixel_major) that is memory mapped read-only
+        psf_library_index: rdi.AnnulusIndex of the PSF library to select RDI references with, or None
+        psf_library_gram: rdi.SectorGramCache with the per-sector covariances of the PSF library, or None
     """
     global original, original_shape, aligned, aligned_shape, output, output_shape, img_pa, img_wv, img_center, img_filenums, \
-        psf_lib, psf_lib_shape
+        psf_lib, psf_lib_shape, psf_lib_index, psf_lib_gram
     # original images from files to read and align&scale. Shape of (N,y,x)
     original = original_imgs
     original_shape = original_imgs_shape
@@ -69,8 +73,35 @@ def _tpool_init(original_imgs, original_imgs_shape, aligned_imgs, aligned_imgs_s
     img_wv = wvs_imgs
     img_center = centers_imgs
     img_filenums = filenums_imgs
-    psf_lib = psf_library
+    if isinstance(psf_library, str):
+        # memory map the library instead of holding a copy of it in every process
+        psf_lib = np.load(psf_library, mmap_mode='r')
+    else:
+        psf_lib = psf_library
     psf_lib_shape = psf_library_shape
+    psf_lib_index = psf_library_index
+    psf_lib_gram = psf_library_gram
+
+
+def _psf_library_section(frame_indices, section_ind, dtype=None):
+    """
+    Reads the pixels of a section for some frames of the PSF library set up in _tpool_init(). For a memory-mapped
+    pixel-major library, only the section pixels of the requested frames are read.
+
+    Args:
+        frame_indices: indices of the library frames to read
+        section_ind: np.where(pixels are in this section of the image). Note: coordinate system is collapsed into 1D
+        dtype: data type of the shared arrays. Should be either ctypes.c_float(default) or ctypes.c_double
+
+    Returns:
+        array of shape (np.size(frame_indices), np.size(section_ind))
+    """
+    frame_indices = np.asarray(frame_indices)
+    if isinstance(psf_lib, np.ndarray):
+        # pixel-major (y*x, N_lib) layout
+        return np.array(psf_lib[np.ix_(section_ind[0], frame_indices)].T)
+    psf_library = _arraytonumpy(psf_lib, (psf_lib_shape[0], psf_lib_shape[1]*psf_lib_shape[2]), dtype=dtype)
+    return psf_library[np.ix_(frame_indices, section_ind[0])]
 
 
 def _save_spectral_cubes(dataset, pixel_weights, time_collapse, numbasis, flux_cal, outputdirpath, fileprefix):
@@ -354,7 +385,8 @@ def _klip_section_multifile_profiler(scidata_indices, wavelength, wv_index, numb
 
 def _klip_section_multifile(scidata_indices, wavelength, wv_index, numbasis, maxnumbasis, radstart, radend, phistart,
                             phiend, minmove, ref_center, minrot, maxrot, spectrum, mode, corr_smooth=1, psflib_good=None,
-                            psflib_corr=None, lite=False, dtype=None, algo='klip', verbose=True):
+                            psflib_corr=None, lite=False, dtype=None, algo='klip', verbose=True, empca_niter=15,
+                            empca_tol=None, empca_mode='joint'):
     """
     Runs klip on a section of the image for all the images of a given wavelength.
     Bigger size of atomization of work than _klip_section but saves computation time and memory. Currently no need to
@@ -384,6 +416,11 @@ def _klip_section_multifile(scidata_indices, wavelength, wv_index, numbasis, max
         dtype: data type of the arrays. Should be either ctypes.c_float(default) or ctypes.c_double
         algo (str): algorithm to use ('klip', 'nmf', 'empca')
         verbose (bool): if True, prints out warnings
+        empca_niter (int): maximum number of EMPCA iterations for each rank
+        empca_tol (float): if not None, relative chi squared change at which EMPCA stops iterating
+        empca_mode (str): 'joint' models all the frames together with EMPCA. 'project' builds an EMPCA basis from the
+                    reference PSFs selected for each science frame and projects the science frames on it
+                    (see _empca_section_project)
 
     Returns:
         returns True on success, False on failure. Does not return whether KLIP on each individual image was sucessful.
@@ -416,9 +453,18 @@ def _klip_section_multifile(scidata_indices, wavelength, wv_index, numbasis, max
 
     ref_psfs = aligned_imgs[:,  section_ind[0]]
 
+    if algo.lower() == 'empca' and empca_mode.lower() == 'project':
+        try:
+            return _empca_section_project(scidata_indices, section_ind, r[section_ind[0]], aligned_imgs, wavelength,
+                                          wv_index, (radstart + radend) / 2.0, numbasis, minmove, minrot, mode,
+                                          maxnumbasis=maxnumbasis, spectrum=spectrum, psflib_good=psflib_good, dtype=dtype,
+                                          empca_niter=empca_niter, empca_tol=empca_tol, verbose=verbose)
+        except (ValueError, RuntimeError, TypeError) as err:
+            print(err.args)
+            return False
+
     if algo.lower() == 'empca':
 
-        #TODO: include scidata_indices selection in here
         try:
             full_model = np.zeros(ref_psfs.shape)
             ref_psfs[np.isnan(ref_psfs)] = 0.
@@ -432,9 +478,14 @@ def _klip_section_multifile(scidata_indices, wavelength, wv_index, numbasis, max
 
             # run empca reduction
             output_imgs_np = _arraytonumpy(output, (output_shape[0], output_shape[1] * output_shape[2], output_shape[3]), dtype=dtype)
+            # each rank is started from the basis of the previous (lower) rank, so a sweep over numbasis only
+            # needs a few extra iterations per rank instead of converging from a random start every time
+            init_vecs = None
             for i, rank in enumerate(numbasis):
                 # get indices of the image section that have enough finite values along the time dimension
-                good_ind_model = empca.weighted_empca(ref_psfs[:, good_ind], weights=weights, niter=15, nvec=rank)
+                good_ind_model = empca.weighted_empca(ref_psfs[:, good_ind], weights=weights, niter=empca_niter,
+                                                      nvec=rank, init_vecs=init_vecs, tol=empca_tol)
+                init_vecs = empca.model_basis(good_ind_model, rank)
                 full_model[:, good_ind] = good_ind_model
                 output_imgs_np[:, section_ind[0], i] = aligned_imgs[:, section_ind[0]] - full_model
 
@@ -513,7 +564,8 @@ def _klip_section_multifile(scidata_indices, wavelength, wv_index, numbasis, max
                                             parang, filenum, wavelength, wv_index, (radstart + radend) / 2.0, numbasis,
                                             maxnumbasis, minmove, minrot, maxrot, mode, psflib_good=psflib_good,
                                             psflib_corr=psflib_corr, spectrum=spectrum, lite=lite, dtype=dtype,
-                                            algo=algo, verbose=verbose)
+                                            algo=algo, verbose=verbose,
+                                            sector_bounds=(radstart, radend, phistart, phiend))
         except (ValueError, RuntimeError, TypeError) as err:
             print(err.args)
             return False
@@ -526,10 +578,181 @@ def _klip_section_multifile(scidata_indices, wavelength, wv_index, numbasis, max
     return True
 
 
+def _empca_section_project(scidata_indices, section_ind, rflat, aligned_imgs, wavelength, wv_index, avg_rad,
+                           numbasis, minmove, minrot, mode, maxnumbasis=None, spectrum=None, psflib_good=None,
+                           dtype=None, empca_niter=15, empca_tol=None, ref_tol=0.1, verbose=True):
+    """
+    EMPCA on a section with the same reference PSF selection as KLIP. The science frames are grouped by the set of
+    reference PSFs they are allowed to use. For each group, a weighted low-rank basis is computed once from the
+    references, and all the science frames of the group are fit to it with their pixel weights in one batched solve.
+
+    The frames are visited in order of PA and a frame joins the current group as long as the references shared by
+    the whole group (the intersection of their selections) keep at least a fraction 1 - ref_tol of the references of
+    every member. A group therefore never uses a reference one of its frames is not allowed to use, and with
+    movement/minrot criteria (where no two frames have exactly the same references) the number of EMPCA runs scales
+    with 1 / ref_tol instead of with the number of frames.
+
+    Args:
+        scidata_indices: array of file indicies that are the science images for this wavelength
+        section_ind: np.where(pixels are in this section of the image). Note: coordinate system is collapsed into 1D
+        rflat: radius of each pixel in the section
+        aligned_imgs: aligned images for this wavelength, shape (N, y*x)
+        wavelength: value of the wavelength we are processing
+        wv_index: index of the wavelenght we are processing
+        avg_rad: average radius of this annulus
+        numbasis: number of basis vectors to use (list like)
+        minmove: minimum movement between science image and PSF reference image to use PSF reference image (in pixels)
+        minrot: minimum PA rotation (in degrees) to be considered for use as a reference PSF
+        mode: some combination of ADI, SDI, and RDI
+        maxnumbasis: if not None, maximum number of reference PSFs to build the basis of a group from. The references
+                    most correlated with the science frames of the group are kept. Otherwise, use max(numbasis)
+        spectrum: if not None, a array of length N with the flux of the template spectrum at each wavelength
+        psflib_good: array of size N_lib indicating which PSFs of the RDI library can be used
+        dtype: data type of the arrays. Should be either ctypes.c_float(default) or ctypes.c_double
+        empca_niter (int): maximum number of EMPCA iterations for each rank
+        empca_tol (float): if not None, relative chi squared change at which EMPCA stops iterating
+        ref_tol (float): fraction of its references a science frame can lose by sharing a basis with other frames.
+                    0 only groups frames with exactly the same references
+        verbose (bool): if True, prints out warnings
+
+    Returns:
+        returns True on success, False if no science frame could be processed.
+        Saves data to output array as defined in _tpool_init()
+    """
+    if dtype is None:
+        dtype = ctypes.c_float
+    if maxnumbasis is None:
+        maxnumbasis = np.max(numbasis)
+
+    wvs_imgs = _arraytonumpy(img_wv, dtype=dtype)
+    pa_imgs = _arraytonumpy(img_pa, dtype=dtype)
+    filenums_imgs = _arraytonumpy(img_filenums, dtype=dtype)
+
+    sci_psfs = aligned_imgs[:, section_ind[0]]
+    # same as KLIP, don't use references that are mostly nans
+    enough_pix = np.sum(np.isfinite(sci_psfs), axis=1) >= 5
+    sci_psfs = np.nan_to_num(sci_psfs)
+
+    include_rdi = "RDI" in mode.upper()
+    if include_rdi:
+        rdi_psfs = np.nan_to_num(_psf_library_section(psflib_good, section_ind, dtype=dtype))
+    else:
+        rdi_psfs = np.zeros((0, sci_psfs.shape[1]))
+
+    # group the science frames that share (almost) the same references. Frames close in PA have similar references
+    groups = []
+    for img_num in sorted(scidata_indices, key=lambda img_num: pa_imgs[img_num]):
+        goodmv = _reference_selection(avg_rad, pa_imgs[img_num], filenums_imgs[img_num], wavelength, wv_index,
+                                      pa_imgs, wvs_imgs, filenums_imgs, minmove, minrot, mode, spectrum=spectrum)
+        goodmv &= enough_pix
+        if len(groups) > 0:
+            group_refs, group_nrefs, img_nums = groups[-1]
+            shared_refs = group_refs & goodmv
+            if np.sum(shared_refs) >= (1 - ref_tol) * max(group_nrefs, np.sum(goodmv)):
+                groups[-1] = (shared_refs, max(group_nrefs, np.sum(goodmv)), img_nums + [img_num])
+                continue
+        groups.append((goodmv, np.sum(goodmv), [img_num]))
+
+    output_imgs_np = _arraytonumpy(output, (output_shape[0], output_shape[1] * output_shape[2], output_shape[3]),
+                                   dtype=dtype)
+    success = False
+    for goodmv, _, img_nums in groups:
+        img_nums = np.array(img_nums)
+        ref_psfs = np.append(sci_psfs[goodmv], rdi_psfs, axis=0)
+        if ref_psfs.shape[0] < 1:
+            if verbose is True:
+                print("less than 1 reference PSFs available for minmove={0}, skipping...".format(minmove))
+            continue
+
+        # keep the references most correlated with the science frames of the group, like KLIP does for each frame
+        if ref_psfs.shape[0] > maxnumbasis:
+            sci_mean_sub = sci_psfs[img_nums] - np.mean(sci_psfs[img_nums], axis=1)[:, None]
+            ref_mean_sub = ref_psfs - np.mean(ref_psfs, axis=1)[:, None]
+            sci_norm = np.sqrt(np.sum(sci_mean_sub * sci_mean_sub, axis=1))
+            ref_norm = np.sqrt(np.sum(ref_mean_sub * ref_mean_sub, axis=1))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                xcorr = np.dot(sci_mean_sub, ref_mean_sub.T) / sci_norm[:, None] / ref_norm[None, :]
+            xcorr = np.mean(np.nan_to_num(xcorr), axis=0)
+            ref_psfs = ref_psfs[np.sort(np.argsort(xcorr)[-maxnumbasis:])]
+
+        # pixels that have enough signal in the references to be modelled
+        good_ind = np.sum(ref_psfs > 0., axis=0) > np.min([numbasis[-1], ref_psfs.shape[0] - 1])
+        ref_weights = empca.set_pixel_weights(ref_psfs[:, good_ind], rflat[good_ind], mode='standard',
+                                              inner_sup=17, outer_sup=66)
+        sci_imgs = sci_psfs[img_nums][:, good_ind]
+        sci_weights = empca.set_pixel_weights(sci_imgs, rflat[good_ind], mode='standard', inner_sup=17,
+                                              outer_sup=66)
+
+        full_model = np.zeros((len(img_nums), sci_psfs.shape[1]))
+        init_vecs = None
+        for i, rank in enumerate(numbasis):
+            # can't have more basis vectors than references
+            rank = np.min([rank, ref_psfs.shape[0]])
+            ref_model = empca.weighted_empca(ref_psfs[:, good_ind], weights=ref_weights, niter=empca_niter,
+                                             nvec=rank, init_vecs=init_vecs, tol=empca_tol)
+            init_vecs = empca.model_basis(ref_model, rank)
+            full_model[:, good_ind] = empca.weighted_projection(sci_imgs, init_vecs, weights=sci_weights)
+            output_imgs_np[img_nums, section_ind[0][:, None], i] = \
+                (aligned_imgs[img_nums][:, section_ind[0]] - full_model).T
+        success = True
+
+    return success
+
+
+def _reference_selection(avg_rad, parang, filenum, wavelength, wv_index, pa_imgs, wvs_imgs, filenums_imgs, minmove,
+                         minrot, mode, spectrum=None):
+    """
+    Applies the movement, rotation and ADI/SDI criteria to decide which frames of the sequence can be used as
+    reference PSFs for a science image.
+
+    Args:
+        avg_rad: average radius of this annulus
+        parang: PA of science iamage
+        filenum (int): file number of science image
+        wavelength: wavelength of science image
+        wv_index: array index of the wavelength of the science image
+        pa_imgs: PAs of all the frames in the sequence
+        wvs_imgs: wavelengths of all the frames in the sequence
+        filenums_imgs: file numbers of all the frames in the sequence
+        minmove: minimum movement between science image and PSF reference image to use PSF reference image (in pixels)
+        minrot: minimum PA rotation (in degrees) to be considered for use as a reference PSF
+        mode: one of ['ADI', 'SDI', 'ADI+SDI'] for ADI, SDI, or ADI+SDI
+        spectrum: if not None, a array of length N with the flux of the template spectrum at each wavelength.
+
+    Returns:
+        goodmv: boolean array of length N, True for the frames that can be used as reference PSFs
+    """
+    # calculate average movement in this section for each PSF reference image w.r.t the science image
+    moves = klip.estimate_movement(avg_rad, parang, pa_imgs, wavelength, wvs_imgs, mode)
+    # check all the PSF selection criterion
+    # enough movement of the astrophyiscal source
+    if spectrum is None:
+        goodmv = (moves >= minmove)
+    else:
+        # optimize the selection based on the spectral template rather than just an exclusion principle
+        goodmv = (spectrum * norm.sf(moves  -minmove/2.355, scale=minmove/2.355) <= 0.1 * spectrum[wv_index])
+
+    # enough field rotation
+    if minrot > 0:
+        goodmv = (goodmv) & (np.abs(pa_imgs - parang) >= minrot)
+
+    # if no SDI, don't use other wavelengths
+    if "SDI" not in mode.upper():
+        goodmv = (goodmv) & (wvs_imgs == wavelength)
+    # if no ADI, don't use other parallactic angles
+    if "ADI" not in mode.upper():
+        goodmv = (goodmv) & (filenums_imgs == filenum)
+    # if both aren't in here, we shouldn't be using any frames in the sequence
+    if "ADI" not in mode.upper() and "SDI" not in mode.upper():
+        goodmv = (goodmv) & False
+
+    return goodmv
+
+
 def _klip_section_multifile_perfile(img_num, section_ind, ref_psfs, covar,  corr, parang, filenum, wavelength, wv_index, avg_rad,
                                     numbasis, maxnumbasis, minmove, minrot, maxrot, mode,
                                     psflib_good=None, psflib_corr=None,
-                                    spectrum=None, lite=False, dtype=None, algo='klip', verbose=True):
+                                    spectrum=None, lite=False, dtype=None, algo='klip', verbose=True, sector_bounds=None):
     """
     Imitates the rest of _klip_section for the multifile code. Does the rest of the PSF reference selection and runs KLIP.
 
@@ -558,6 +781,8 @@ def _klip_section_multifile_perfile(img_num, section_ind, ref_psfs, covar,  corr
         lite: if True, in memory-lite mode
         dtype: data type of the arrays. Should be either ctypes.c_float(default) or ctypes.c_double
         verbose (bool): if True, prints out error messages
+        sector_bounds: (radstart, radend, phistart, phiend) of this section, used to find the precomputed
+                        covariances of the PSF library if there are any
 
     Returns:
         return True on success, False on failure.
@@ -571,29 +796,8 @@ def _klip_section_multifile_perfile(img_num, section_ind, ref_psfs, covar,  corr
     wvs_imgs = _arraytonumpy(img_wv, dtype=dtype)
     pa_imgs = _arraytonumpy(img_pa, dtype=dtype)
     filenums_imgs = _arraytonumpy(img_filenums, dtype=dtype)
-    # calculate average movement in this section for each PSF reference image w.r.t the science image
-    moves = klip.estimate_movement(avg_rad, parang, pa_imgs, wavelength, wvs_imgs, mode)
-    # check all the PSF selection criterion
-    # enough movement of the astrophyiscal source
-    if spectrum is None:
-        goodmv = (moves >= minmove)
-    else:
-        # optimize the selection based on the spectral template rather than just an exclusion principle
-        goodmv = (spectrum * norm.sf(moves  -minmove/2.355, scale=minmove/2.355) <= 0.1 * spectrum[wv_index])
-
-    # enough field rotation
-    if minrot > 0:
-        goodmv = (goodmv) & (np.abs(pa_imgs - parang) >= minrot)
-
-    # if no SDI, don't use other wavelengths
-    if "SDI" not in mode.upper():
-        goodmv = (goodmv) & (wvs_imgs == wavelength)
-    # if no ADI, don't use other parallactic angles
-    if "ADI" not in mode.upper():
-        goodmv = (goodmv) & (filenums_imgs == filenum)
-    # if both aren't in here, we shouldn't be using any frames in the sequence
-    if "ADI" not in mode.upper() and "SDI" not in mode.upper():
-        goodmv = (goodmv) & False
+    goodmv = _reference_selection(avg_rad, parang, filenum, wavelength, wv_index, pa_imgs, wvs_imgs, filenums_imgs,
+                                  minmove, minrot, mode, spectrum=spectrum)
     include_rdi = "RDI" in mode.upper()
 
     good_file_ind = np.where(goodmv)
@@ -616,7 +820,6 @@ def _klip_section_multifile_perfile(img_num, section_ind, ref_psfs, covar,  corr
     if include_rdi:
         num_good_rdi = np.size(psflib_good)
         maxbasis_possible += num_good_rdi
-        psf_library = _arraytonumpy(psf_lib, (psf_lib_shape[0], psf_lib_shape[1]*psf_lib_shape[2]), dtype=dtype)
 
     # load input/output data
     if lite:
@@ -634,10 +837,19 @@ def _klip_section_multifile_perfile(img_num, section_ind, ref_psfs, covar,  corr
             # best reference PSFs.
             # grab the maxnumbasis most correlated PSFs from the library
             num_rdi_psfs_first_downselect = np.min([maxnumbasis, num_good_rdi])
-            rdi_best_corr_max_possbile_indices = np.argsort(psflib_corr[img_num, psflib_good])[-num_rdi_psfs_first_downselect:]
+            index_annulus = None
+            if psf_lib_index is not None:
+                index_annulus = psf_lib_index.annulus_at(avg_rad)
+            if index_annulus is not None:
+                # query the library frames most correlated to the science frame in this annulus
+                rdi_best_corr_max_possbile_indices = psf_lib_index.query(aligned_imgs[img_num], index_annulus,
+                                                                         num_rdi_psfs_first_downselect,
+                                                                         subset=psflib_good)
+            else:
+                rdi_best_corr_max_possbile_indices = np.argsort(psflib_corr[img_num, psflib_good])[-num_rdi_psfs_first_downselect:]
             # grab these PSFs
-            rdi_best_corr_max_possible = psf_library[psflib_good[rdi_best_corr_max_possbile_indices]]
-            rdi_best_corr_max_possible = rdi_best_corr_max_possible[:, section_ind[0]]
+            rdi_best_corr_max_possible = _psf_library_section(psflib_good[rdi_best_corr_max_possbile_indices],
+                                                              section_ind, dtype=dtype)
             # recalculate their correlations in this sector
             sci_img = aligned_imgs[img_num, section_ind[0]].reshape(1, numpix)
             # to calculate correlation, first subtract off mean for each image
@@ -675,28 +887,39 @@ def _klip_section_multifile_perfile(img_num, section_ind, ref_psfs, covar,  corr
         covar_files = covar_files[closest_matched.reshape(np.size(closest_matched), 1), closest_matched]
 
         if include_rdi:
-            rdi_psfs_selected = psf_library[rdi_closest_matched]
-            rdi_psfs_selected = rdi_psfs_selected[:, section_ind[0]]
+            rdi_selected_indices = rdi_closest_matched
+            rdi_psfs_selected = _psf_library_section(rdi_closest_matched, section_ind, dtype=dtype)
     else:
         # else just grab the reference PSFs for all the valid files
         ref_psfs_selected = ref_psfs[good_file_ind[0], :]
 
         if include_rdi:
-            rdi_psfs_selected = psf_library[psflib_good][:, section_ind[0]]
+            rdi_selected_indices = psflib_good
+            rdi_psfs_selected = _psf_library_section(psflib_good, section_ind, dtype=dtype)
     
     # add PSF library to reference psf list and covariance matrix if needed
     if include_rdi:
 
+        # look for precomputed covariances of the library in this sector
+        gram_sector = None
+        if psf_lib_gram is not None and sector_bounds is not None and algo.lower() != 'nmf':
+            gram_sector = psf_lib_gram.lookup(*sector_bounds, npix=numpix)
+
         #subctract the mean and remove the Nans from the RDI PSFs before measuring the covariance.
         # this was already done in _klip_section_multifile for the other PSFs)
         if algo.lower() == 'nmf': # do not do mean subtraction for NMF
             rdi_psfs_selected = rdi_psfs_selected
+        elif gram_sector is not None:
+            rdi_psfs_selected = rdi_psfs_selected - psf_lib_gram.means(gram_sector, rdi_selected_indices)[:, None]
         else:
             rdi_psfs_selected = rdi_psfs_selected - np.nanmean(rdi_psfs_selected, axis=1)[:, None]
         rdi_psfs_selected[np.where(np.isnan(rdi_psfs_selected))] = 0
 
-        # compute covariances. I could just grab these from ~20 lines above, but too lazy
-        rdi_covar = np.cov(rdi_psfs_selected) # N_rdi_sel x N_rdi_sel
+        # compute covariances, or slice them out of the precomputed ones
+        if gram_sector is not None:
+            rdi_covar = psf_lib_gram.covariance(gram_sector, rdi_selected_indices)
+        else:
+            rdi_covar = np.cov(rdi_psfs_selected) # N_rdi_sel x N_rdi_sel
         # EDGE CASE: if there's only 1 image, we need to reshape to covariance matrix into a 2D matrix
         if not rdi_covar.shape:
             rdi_covar = rdi_covar.reshape([1,1])
@@ -1111,7 +1334,9 @@ def klip_parallelized(imgs, centers, parangs, wvs, filenums, IWA, OWA=None, mode
                       numbasis=None, aligned_center=None, numthreads=None, minrot=0, maxrot=360, 
                       annuli_spacing="constant", maxnumbasis=None, corr_smooth=1,
                       spectrum=None, psf_library=None, psf_library_good=None, psf_library_corr=None,
-                      save_aligned = False, restored_aligned = None, dtype=None, algo='klip', compute_noise_cube=False, verbose = True):
+                      save_aligned = False, restored_aligned = None, dtype=None, algo='klip', compute_noise_cube=False, verbose = True,
+                      empca_niter=15, empca_tol=None, empca_mode='joint', psf_library_index=None,
+                      psf_library_gram=None):
     """
     Multitprocessed KLIP PSF Subtraction
 
@@ -1143,7 +1368,8 @@ def klip_parallelized(imgs, centers, parangs, wvs, filenums, IWA, OWA=None, mode
                     the size of the PSF (TODO: make PSF size another quanitity)
                     (e.g. minmove=3, checks how much containmination is within 3 pixels of the hypothetical source)
                     if smaller than 10%, (hard coded quantity), then use it for reference PSF
-        psf_library: array of (N_lib, y, x) with N_lib PSF library PSFs
+        psf_library: array of (N_lib, y, x) with N_lib PSF library PSFs, or the filename of a pixel-major library
+                     saved by rdi.PSFLibrary.save_pixel_major, which is memory mapped instead of copied
         psf_library_good: array of size N_lib indicating which N_good are good are selected in the passed in corr matrix
         psf_library_corr: matrix of size N_sci x N_good with correlation between the target franes and the good RDI PSFs
         save_aligned:	Save the aligned and scaled images (as well as various wcs information), True/False
@@ -1152,6 +1378,16 @@ def klip_parallelized(imgs, centers, parangs, wvs, filenums, IWA, OWA=None, mode
         dtype: data type of the arrays. Should be either ctypes.c_float(default) or ctypes.c_double
         algo (str): algorithm to use ('klip', 'nmf', 'empca')
         compute_noise_cube:  if True, compute the noise in each pixel assuming azimuthally uniform noise
+        verbose (bool): if True, prints out warnings
+        empca_niter (int): maximum number of EMPCA iterations for each KL mode cutoff (only for algo='empca')
+        empca_tol (float): if not None, EMPCA stops iterating once the relative change in chi squared is below
+                    empca_tol (only for algo='empca')
+        empca_mode (str): (only for algo='empca') 'joint' to model all frames together, 'project' to build a basis
+                    from the selected reference PSFs and project each science frame on it
+        psf_library_index: if not None, a rdi.AnnulusIndex of the PSF library used to pick the RDI candidates of
+                    each science frame in each annulus instead of psf_library_corr
+        psf_library_gram: if not None, a rdi.SectorGramCache with precomputed per-sector covariances of the PSF
+                    library, for sectors matching this reduction
 
     Returns:
         sub_imgs: array of [array of 2D images (PSF subtracted)] using different number of KL basis vectors as
@@ -1288,7 +1524,11 @@ def klip_parallelized(imgs, centers, parangs, wvs, filenums, IWA, OWA=None, mode
     filenums_imgs = mp.Array(mp_data_type, np.size(filenums))
     filenums_imgs_np = _arraytonumpy(filenums_imgs,dtype=dtype)
     filenums_imgs_np[:] = filenums
-    if psf_library is not None:
+    if isinstance(psf_library, str):
+        # pixel-major library on disk. Each process memory maps it in _tpool_init()
+        psf_lib = psf_library
+        psf_lib_shape = None
+    elif psf_library is not None:
         psf_lib = mp.Array(mp_data_type, np.size(psf_library))
         psf_lib_np = _arraytonumpy(psf_lib, psf_library.shape, dtype=dtype)
         psf_lib_np[:] = psf_library
@@ -1303,13 +1543,15 @@ def klip_parallelized(imgs, centers, parangs, wvs, filenums, IWA, OWA=None, mode
 
     tpool = mp.Pool(processes=numthreads, initializer=_tpool_init,
                     initargs=(original_imgs, original_imgs_shape, recentered_imgs, recentered_imgs_shape, output_imgs,
-                            output_imgs_shape, pa_imgs, wvs_imgs, centers_imgs, filenums_imgs, psf_lib, psf_lib_shape),
+                            output_imgs_shape, pa_imgs, wvs_imgs, centers_imgs, filenums_imgs, psf_lib, psf_lib_shape,
+                            psf_library_index, psf_library_gram),
                     maxtasksperchild=50)
 
     # # SINGLE THREAD DEBUG PURPOSES ONLY
     if debug:
         _tpool_init(original_imgs, original_imgs_shape, recentered_imgs, recentered_imgs_shape, output_imgs,
-                            output_imgs_shape, pa_imgs, wvs_imgs, centers_imgs, filenums_imgs, psf_lib, psf_lib_shape)
+                            output_imgs_shape, pa_imgs, wvs_imgs, centers_imgs, filenums_imgs, psf_lib, psf_lib_shape,
+                            psf_library_index, psf_library_gram)
 
 
     if restored_aligned is None:
@@ -1348,7 +1590,8 @@ def klip_parallelized(imgs, centers, parangs, wvs, filenums, IWA, OWA=None, mode
                                                                         aligned_center, minrot, maxrot, spectrum,
                                                                         mode, corr_smooth, 
                                                                         psf_library_good, psf_library_corr, False,
-                                                                        dtype, algo, verbose))
+                                                                        dtype, algo, verbose, empca_niter,
+                                                                        empca_tol, empca_mode))
                         for phistart,phiend in phi_bounds
                         for radstart, radend in rad_bounds]
         else:
@@ -1358,7 +1601,7 @@ def klip_parallelized(imgs, centers, parangs, wvs, filenums, IWA, OWA=None, mode
                                                 aligned_center, minrot, maxrot, spectrum,
                                                 mode, corr_smooth,
                                                 psf_library_good, psf_library_corr, False,
-                                                dtype, algo, verbose)
+                                                dtype, algo, verbose, empca_niter, empca_tol, empca_mode)
                         for phistart,phiend in phi_bounds
                         for radstart, radend in rad_bounds]
 
@@ -1410,7 +1653,8 @@ def klip_dataset(dataset, mode='ADI+SDI', outputdir=".", fileprefix="", annuli=5
                  numbasis=None, numthreads=None, minrot=0, calibrate_flux=False, aligned_center=None,
                  annuli_spacing="constant", maxnumbasis=None, corr_smooth=1, spectrum=None, psf_library=None, 
                  highpass=False, lite=False, save_aligned = False, restored_aligned = None, save_ints = False, dtype=None, algo='klip',
-                 skip_derot=False, time_collapse="mean", wv_collapse='mean', verbose = True):
+                 skip_derot=False, time_collapse="mean", wv_collapse='mean', verbose = True, empca_niter=15, empca_tol=None,
+                 empca_mode='joint'):
     """
     run klip on a dataset class outputted by an implementation of Instrument.Data
 
@@ -1456,6 +1700,13 @@ def klip_dataset(dataset, mode='ADI+SDI', outputdir=".", fileprefix="", annuli=5
         time_collapse:  how to collapse the data in time. Currently support: "mean", "weighted-mean", 'median', "weighted-median"
         wv_collapse:    how to collapse the data in wavelength. Currently support: 'median', 'mean', 'trimmed-mean'
         verbose (bool): if True, print warning messages during KLIP process.
+        empca_niter:    (only for algo='empca') maximum number of EMPCA iterations for each KL mode cutoff.
+                        Each cutoff is started from the basis of the previous one.
+        empca_tol:      (only for algo='empca') if not None, stop the EMPCA iterations once the relative change in
+                        chi squared is smaller than empca_tol
+        empca_mode:     (only for algo='empca') 'joint' models all the frames together (movement and minrot must be 0).
+                        'project' computes one basis per sector from the reference PSFs selected like KLIP does
+                        (respecting movement and minrot) and projects each science frame on it.
 
     Returns
         Saved files in the output directory
@@ -1465,10 +1716,12 @@ def klip_dataset(dataset, mode='ADI+SDI', outputdir=".", fileprefix="", annuli=5
     """
     ######### Check inputs ##########
 
-    # empca currently does not support movement or minrot
-    if algo.lower() == 'empca' and (minrot != 0 or movement != 0):
-        raise ValueError('empca currently does not support movement, minrot selection criteria, '
-                         'must be set to 0')
+    # joint empca does not support movement or minrot
+    if algo.lower() == 'empca' and empca_mode.lower() not in ('joint', 'project'):
+        raise ValueError("empca_mode must be 'joint' or 'project'")
+    if algo.lower() == 'empca' and empca_mode.lower() == 'joint' and (minrot != 0 or movement != 0):
+        raise ValueError('empca_mode="joint" does not support movement, minrot selection criteria, '
+                         'must be set to 0 (or use empca_mode="project")')
     elif algo.lower() == 'none':
         # remove some psfsubtraction params
         movement = 0
@@ -1511,13 +1764,21 @@ def klip_dataset(dataset, mode='ADI+SDI', outputdir=".", fileprefix="", annuli=5
         else:
             aligned_center = psf_library.aligned_center
         # good rdi_library
-        master_library = psf_library.master_library
+        if psf_library.pixel_major_file is not None:
+            # workers memory map the sector pixels they need
+            master_library = psf_library.pixel_major_file
+        else:
+            master_library = psf_library.master_library
         rdi_corr_matrix = psf_library.correlation
         rdi_good_psfs = psf_library.isgoodpsf
+        rdi_index = psf_library.annulus_index
+        rdi_gram = psf_library.sector_grams
     else:
         master_library = None
         rdi_corr_matrix = None
         rdi_good_psfs = None
+        rdi_index = None
+        rdi_gram = None
 
     ######### End chcking inputs ########
 
@@ -1604,6 +1865,14 @@ def klip_dataset(dataset, mode='ADI+SDI', outputdir=".", fileprefix="", annuli=5
                     'psf_library_corr':rdi_corr_matrix, 'psf_library_good':rdi_good_psfs,
                     'save_aligned' : save_aligned, 'restored_aligned' : restored_aligned, 'dtype':dtype,
                     'algo':algo, 'compute_noise_cube':weighted, 'verbose':verbose}
+    if algo.lower() == 'empca':
+        pyklip_args['empca_niter'] = empca_niter
+        pyklip_args['empca_tol'] = empca_tol
+        pyklip_args['empca_mode'] = empca_mode
+    if rdi_index is not None:
+        pyklip_args['psf_library_index'] = rdi_index
+    if rdi_gram is not None:
+        pyklip_args['psf_library_gram'] = rdi_gram
 
     #Set MLK parameters
     if mkl_exists:
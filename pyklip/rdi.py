@@ -1,10 +1,219 @@
 import numpy as np
 import os
+import collections
+import threading
+import json
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 from sys import stdout
 from astropy.io import fits
 import pyklip.klip as klip
 from pyklip.parallelized import high_pass_filter_imgs
 
+# upper bound (in bytes) on the prepared frames held in memory while computing a correlation matrix block by block
+_corr_block_bytes = 2**28
+
+
+def _prepare_correlation_block(frames, mask=None):
+    """
+    Flattens a block of frames for masked correlations: NaNs (and pixels outside the mask) are zeroed after
+    subtracting the mean of each frame, and a matching float array flags the valid pixels.
+
+    Args:
+        frames (np.ndarray): (n, y, x) block of frames
+        mask (np.ndarray): (y, x) array with NaNs where pixels should not be used, or None
+
+    Returns:
+        data (np.ndarray): (n, y*x) mean-subtracted frames with 0 at invalid pixels
+        valid (np.ndarray): (n, y*x) 1 where the pixel is valid, 0 otherwise
+    """
+    data = np.array(frames, dtype=float).reshape(np.shape(frames)[0], -1)
+    valid = ~np.isnan(data)
+    if mask is not None:
+        valid &= ~np.isnan(np.ravel(mask))[None, :]
+    data[~valid] = 0
+    # correlations do not depend on an offset of each frame, but removing it keeps the sums below well conditioned
+    npix = np.sum(valid, axis=1)
+    data -= (np.sum(data, axis=1) / np.maximum(npix, 1))[:, None]
+    data[~valid] = 0
+    return data, valid.astype(float)
+
+
+def _masked_correlation(data1, valid1, data2, valid2, sq1=None, sq2=None):
+    """
+    Pearson correlation between every frame of block 1 and every frame of block 2, each pair only using the
+    pixels that are valid in both frames (same as np.cov on the pixels both frames have in common).
+
+    Args:
+        data1, valid1: outputs of _prepare_correlation_block for the first block (n1 frames)
+        data2, valid2: outputs of _prepare_correlation_block for the second block (n2 frames)
+        sq1, sq2: data1 * data1 and data2 * data2 if they have already been computed, or None
+
+    Returns:
+        (n1, n2) correlation matrix
+    """
+    if sq1 is None:
+        sq1 = data1 * data1
+    if sq2 is None:
+        sq2 = data2 * data2
+
+    if np.all(valid1 == valid1[0]) and np.all(valid2 == valid1[0]):
+        # every frame has the same valid pixels (e.g. no NaNs): the frames are already mean subtracted on the common
+        # pixels, so only the cross products are needed
+        norm1 = np.sqrt(np.sum(sq1, axis=1))
+        norm2 = np.sqrt(np.sum(sq2, axis=1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = np.dot(data1, data2.T) / norm1[:, None] / norm2[None, :]
+        if np.sum(valid1[0]) < 2:
+            corr[:] = np.nan
+        return corr
+
+    npix = np.dot(valid1, valid2.T)
+    sum1 = np.dot(data1, valid2.T)
+    sum2 = np.dot(valid1, data2.T)
+    cross = np.dot(data1, data2.T)
+    sumsq1 = np.dot(sq1, valid2.T)
+    sumsq2 = np.dot(valid1, sq2.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covar = cross - sum1 * sum2 / npix
+        var1 = sumsq1 - sum1 * sum1 / npix
+        var2 = sumsq2 - sum2 * sum2 / npix
+        corr = covar / np.sqrt(var1 * var2)
+    # pairs with fewer than 2 pixels in common have an undefined correlation, like np.cov
+    corr[npix < 2] = np.nan
+    return corr
+
+
+def _blocked_correlation(frames1, frames2=None, mask=None, block_size=None, numthreads=None):
+    """
+    Masked Pearson correlation matrix between two stacks of frames, computed in blocks of frames with matrix
+    products. Each thread prepares (mean subtracts and masks, see _prepare_correlation_block) one block of frames2 at
+    a time and correlates it with the blocks of frames1, which are prepared lazily and kept in a small LRU cache
+    shared by the threads. Blocks of frames1 evicted from the cache are prepared again when needed, so only a bounded
+    number of prepared blocks (and never the whole of frames1 or frames2) is held in memory at once.
+
+    Args:
+        frames1 (np.ndarray): (n1, y, x) stack of frames (can be a memmap)
+        frames2 (np.ndarray): (n2, y, x) stack of frames (can be a memmap). If None, correlate frames1 with itself,
+                              in which case only the upper triangle of blocks is computed.
+        mask (np.ndarray): (y, x) array with NaNs where pixels should not be correlated, or None
+        block_size (int): number of frames per block. If None, chosen from the image size so that the prepared
+                          blocks held by the threads and the cache stay below rdi._corr_block_bytes
+        numthreads (int): number of threads. If None, use all the cores
+
+    Returns:
+        (n1, n2) correlation matrix
+    """
+    symmetric = frames2 is None
+    if symmetric:
+        frames2 = frames1
+    n1, n2 = np.shape(frames1)[0], np.shape(frames2)[0]
+    if numthreads is None:
+        numthreads = mp.cpu_count()
+    # a prepared block holds data, valid pixels and squared data in float64
+    npix = max(int(np.prod(np.shape(frames1)[1:])), 1)
+    if block_size is None:
+        # share the budget between the block of frames2 of each thread and ~3 cached blocks of frames1 per thread
+        block_size = max(1, _corr_block_bytes // (8 * 3 * npix * 4 * numthreads))
+    # whatever the threads' blocks of frames2 leave of the budget goes to the cache (at least one block per thread)
+    cache_size = max(numthreads, _corr_block_bytes // (8 * 3 * npix * block_size) - numthreads)
+
+    blocks1 = [(start, min(start + block_size, n1)) for start in range(0, n1, block_size)]
+    blocks2 = [(start, min(start + block_size, n2)) for start in range(0, n2, block_size)]
+
+    corr = np.zeros((n1, n2))
+    cache = collections.OrderedDict()
+    cache_lock = threading.Lock()
+
+    def _prepare(frames, bounds):
+        data, valid = _prepare_correlation_block(frames[bounds[0]:bounds[1]], mask)
+        return data, valid, data * data
+
+    def _get_block1(i1):
+        with cache_lock:
+            if i1 in cache:
+                cache.move_to_end(i1)
+                return cache[i1]
+        prepared = _prepare(frames1, blocks1[i1])
+        with cache_lock:
+            cache[i1] = prepared
+            cache.move_to_end(i1)
+            while len(cache) > cache_size:
+                cache.popitem(last=False)
+        return prepared
+
+    def _correlate_block2(i2):
+        start2, end2 = blocks2[i2]
+        if symmetric:
+            data2, valid2, sq2 = _get_block1(i2)
+            order1 = range(i2 + 1)
+        else:
+            data2, valid2, sq2 = _prepare(frames2, blocks2[i2])
+            order1 = range(len(blocks1))
+        # alternate the direction of the sweep so that the blocks cached at the end of one are used by the next
+        if i2 % 2 == 1:
+            order1 = order1[::-1]
+        for i1 in order1:
+            start1, end1 = blocks1[i1]
+            data1, valid1, sq1 = _get_block1(i1)
+            corr_block = _masked_correlation(data1, valid1, data2, valid2, sq1=sq1, sq2=sq2)
+            corr[start1:end1, start2:end2] = corr_block
+            if symmetric:
+                corr[start2:end2, start1:end1] = corr_block.T
+
+    if numthreads > 1 and len(blocks2) > 1:
+        pool = ThreadPool(processes=min(numthreads, len(blocks2)))
+        try:
+            # blocks at the end of the upper triangle have the most pairs, start them first
+            for _ in pool.imap_unordered(_correlate_block2, range(len(blocks2))[::-1]):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for i2 in range(len(blocks2)):
+            _correlate_block2(i2)
+
+    return corr
+
+
+def _grow_array(array, nrows, capacity, square=False, filename=None):
+    """
+    Copies the first nrows rows of array into a new array with room for capacity rows (and columns if square).
+    If filename is given, the new array is a .npy memmap that replaces the file at filename.
+
+    Args:
+        array (np.ndarray): array to grow (can be a memmap or None if nrows is 0)
+        nrows (int): number of rows (and columns if square) of array that are in use
+        capacity (int): new size of the first axis (and second axis if square)
+        square (bool): if True, grow both of the first two axes
+        filename (str): if not None, path of the .npy file backing the array
+
+    Returns:
+        the new array
+    """
+    shape = (capacity,) + ((capacity,) if square else ()) + array.shape[2 if square else 1:]
+    if filename is None:
+        new_array = np.zeros(shape, dtype=array.dtype)
+    else:
+        new_array = np.lib.format.open_memmap(filename + ".tmp", mode='w+', dtype=array.dtype, shape=shape)
+
+    # copy by blocks of rows to avoid pulling a whole memmap in memory
+    for start in range(0, nrows, 1024):
+        end = min(start + 1024, nrows)
+        if square:
+            new_array[start:end, :nrows] = array[start:end, :nrows]
+        else:
+            new_array[start:end] = array[start:end]
+
+    if filename is not None:
+        new_array.flush()
+        del new_array
+        os.replace(filename + ".tmp", filename)
+        new_array = np.lib.format.open_memmap(filename, mode='r+')
+    return new_array
+
+
 class PSFLibrary(object):
     """
     This is an PSF Library to use for reference differential imaging
@@ -79,6 +288,22 @@ class PSFLibrary(object):
         self.dataset = None
         self.correlation = None
         self.isgoodpsf = None
+        # arrays with spare rows that master_library and master_correlation are views of, so appending new files
+        # does not copy the whole library every time. Capacity doubles when they are full.
+        self._library_buffer = None
+        self._correlation_buffer = None
+        # directory of the on-disk library (see save_library), if any
+        self.library_dir = None
+        # read-only pixel-major copy of the library (see save_pixel_major), if any
+        self.pixel_major_file = None
+        # approximate nearest-neighbour index for RDI reference selection (see build_annulus_index), if any
+        self.annulus_index = None
+        # per-sector covariance matrices of the library (see build_sector_grams), if any
+        self.sector_grams = None
+
+        # basename -> library rows, to cross-match datasets with the library
+        self._filename_index = {}
+        self._index_filenames(self.master_filenames)
 
         # check if correlation matrix was passed in
         if correlation_matrix is None and not compute_correlation:
@@ -87,7 +312,7 @@ class PSFLibrary(object):
         elif compute_correlation:
             self._compute_correlation()
 
-    def _compute_correlation(self, verbose=False, force=False, mask=None):
+    def _compute_correlation(self, verbose=False, force=False, mask=None, block_size=None, numthreads=None):
         """
         Computes the correlation matrix and saves it in self.master_correlation
 
@@ -98,6 +323,15 @@ class PSFLibrary(object):
 
         The mask should have 0s where you want to correlate and NANs when you don't. 
 
+        Each pair of frames is correlated over the pixels that are finite in both (and in the mask). The matrix is
+        computed in blocks of frames in parallel (see _blocked_correlation).
+
+        Args:
+            verbose (bool): if True, print progress
+            force (bool): if True, overwrite an existing correlation matrix
+            mask (np.ndarray): (y, x) array with 0s where to correlate and NaNs where not to
+            block_size (int): number of frames correlated at once. If None, picked to bound the memory usage
+            numthreads (int): number of threads to use. If None, use all the cores
         """
 
         #Get the number of files
@@ -111,46 +345,16 @@ class PSFLibrary(object):
             else: 
                 print("WARNING: overwriting master_correlation")
 
-
-        self.master_correlation=np.zeros([self.nfiles,self.nfiles])
-
         if verbose:
             print("Making correlation matrix")
 
         if mask is not None:
             self.correlation_mask = mask
 
-        #Loop the correlation matrix calculation
-        for i in np.arange(0, self.nfiles):
-            self.master_correlation[i,i]=1.
-
-            #TODO: PARALLELIZE THIS STEP. 
-
-            #Cycle through every file that comes AFTER the current file 
-            for j in np.arange(i+1, self.nfiles):
-
-                if verbose:
-                    # print("Correlating file "+ str(i) + " with file "+str(j) + "  \r")
-                    stdout.write("\r Correlating file {0} with file {1}".format(i,j))
-                    stdout.flush()
-                
-                #You might want to only correlate some of the image. 
-                if mask is not None:
-                    where_to_corr = (self.master_library[i,:,:] == self.master_library[i,:,:]) & (self.master_library[j,:,:] == self.master_library[j,:,:]) & (mask == mask)
-                else: 
-                #Ditch where either of the two arrays have NANs
-                    where_to_corr = (self.master_library[i,:,:] == self.master_library[i,:,:]) & (self.master_library[j,:,:] == self.master_library[j,:,:]) 
-
-                data1= self.master_library[i,:,:]
-                data2= self.master_library[j,:,:]
-
-                #I believe this bit was copied and pasted from pyklip at some point. 
-                covar_psfs=np.cov([data2[where_to_corr], data1[where_to_corr]])
-                covar_diag = np.diagflat(1./np.sqrt(np.diag(covar_psfs)))
-                corr_psfs = np.dot( np.dot(covar_diag, covar_psfs ), covar_diag)
-
-                self.master_correlation[i,j]=corr_psfs[0,1]
-                self.master_correlation[j,i]=corr_psfs[0,1]
+        # correlate blocks of frames at a time with matrix products
+        self.master_correlation = _blocked_correlation(self.master_library, mask=mask, block_size=block_size,
+                                                       numthreads=numthreads)
+        np.fill_diagonal(self.master_correlation, 1.)
 
         if verbose:
             print("Done making correlation matrix")
@@ -204,40 +408,33 @@ class PSFLibrary(object):
         """
 
         # we need to exclude bad files and files already in the dataset itself (since that'd be ADI/SDI/etc)
-        # strip away the directories in the master_filenames
-        master_just_filenames = np.asarray([filename.split(os.sep)[-1] for filename in self.master_filenames])
-        dataset_just_filenames = np.asarray([filename.split(os.sep)[-1] for filename in dataset.filenames])
-        # print(dataset_just_filenames)
-        # compare with the dataset filnames (also d)
-        in_dataset = np.in1d(master_just_filenames, dataset_just_filenames)
-        
-        # don't compare directly with None
-        if badfiles is None:
-            badfiles = np.full(np.shape(self.master_filenames), False, dtype=bool)
-        are_bad = np.in1d(self.master_filenames, badfiles)
-        
+        # files are matched by their names without the directories, using the filename index of the library
+        dataset_rows = [self._filename_index.get(str(filename).split(os.sep)[-1], []) for filename in dataset.filenames]
+        in_dataset = np.zeros(self.nfiles, dtype=bool)
+        for rows in dataset_rows:
+            in_dataset[rows] = True
+
+        are_bad = np.zeros(self.nfiles, dtype=bool)
+        if badfiles is not None:
+            for filename in np.atleast_1d(badfiles):
+                are_bad[self._filename_index.get(str(filename).split(os.sep)[-1], [])] = True
+
         # good ones are the ones that don't fall in either category
-        isgood = ~in_dataset & ~badfiles
+        isgood = ~in_dataset & ~are_bad
         good = np.where(isgood)[0]
 
         if np.size(good) == 0:
             raise ValueError("There are no good PSFs to use in the reference library. Are all the images in the PSF library from the science dataset?")
 
-        # create a view on the good files
-
-        # figure out how the ordering of dataset files are in the PSF library compared to the dataset
-        # we want to match the dataset
-        # filenames_of_dataset_in_lib = self.master_filenames[np.where(in_dataset)]
-        filenames_of_dataset_in_lib = self.master_filenames[in_dataset]
-        dataset_file_indices_in_lib = []
-        for filename in filenames_of_dataset_in_lib:
-            index = np.where(filename == self.master_filenames)[0][0]
-            dataset_file_indices_in_lib.append(index)
-
-        if np.size(dataset_file_indices_in_lib) < 1:
+        # figure out where the dataset files are in the PSF library, in the same order as the dataset
+        num_found = np.sum([len(rows) > 0 for rows in dataset_rows])
+        if num_found < 1:
             print("Dataset not found in PSF Library, library not prepared.")
+        elif num_found < len(dataset_rows):
+            raise ValueError("{0} of the {1} dataset files are not in the PSF Library. Add the dataset to the library "
+                             "first.".format(len(dataset_rows) - num_found, len(dataset_rows)))
         else:
-            dataset_file_indices_in_lib = np.array(dataset_file_indices_in_lib)
+            dataset_file_indices_in_lib = np.array([rows[0] for rows in dataset_rows])
             # generate a correlation matrix that's N_dataset x N_goodpsfs
             # the ordering of the correlation matrix also ensures that N_dataset is ordered the same as datasets
             self.correlation = self.master_correlation[dataset_file_indices_in_lib]
@@ -247,15 +444,257 @@ class PSFLibrary(object):
 
             self.dataset = dataset
 
-    def add_new_dataset_to_library(self, dataset, collapse = False, verbose=False):
+    def _index_filenames(self, filenames, first_row=0):
+        """
+        Adds filenames to the filename index of the library, which maps the name of each file (without its
+        directories) to the rows of the library with that name.
+
+        Args:
+            filenames (np.ndarray): filenames to add
+            first_row (int): library row of the first filename
+        """
+        for row, filename in enumerate(filenames, start=first_row):
+            self._filename_index.setdefault(str(filename).split(os.sep)[-1], []).append(row)
+
+    def _save_filename_index(self):
+        """
+        Saves the filename index next to the on-disk library
+        """
+        with open(os.path.join(self.library_dir, "filename_index.json"), "w") as f:
+            json.dump({"nfiles": int(self.nfiles), "index": self._filename_index}, f)
+
+    def _reserve(self, nfiles):
+        """
+        Makes sure the library buffers have room for nfiles files, doubling their capacity if needed.
+
+        Args:
+            nfiles (int): number of files the library needs to hold
+        """
+        if self._library_buffer is None:
+            self._library_buffer = self.master_library
+            self._correlation_buffer = self.master_correlation
+        capacity = self._library_buffer.shape[0]
+        if capacity >= nfiles:
+            return
+
+        new_capacity = max(nfiles, 2 * capacity)
+        if self.library_dir is None:
+            library_file, correlation_file = None, None
+        else:
+            library_file = os.path.join(self.library_dir, "library.npy")
+            correlation_file = os.path.join(self.library_dir, "correlation.npy")
+        self._library_buffer = _grow_array(self._library_buffer, self.nfiles, new_capacity, filename=library_file)
+        self._correlation_buffer = _grow_array(self._correlation_buffer, self.nfiles, new_capacity, square=True,
+                                               filename=correlation_file)
+        if self.library_dir is not None:
+            self._write_library_metadata()
+
+    def _write_library_metadata(self):
+        """
+        Writes the number of files and other metadata of the on-disk library. This is written last when the library
+        changes, so a library interrupted while appending still opens with its previous files.
+        """
+        metadata = {"nfiles": int(self.nfiles), "capacity": int(self._library_buffer.shape[0]),
+                    "aligned_center": [float(c) for c in self.aligned_center], "highpass": self.highpass,
+                    "pixel_major": self.pixel_major_file == os.path.join(self.library_dir,
+                                                                          "library_pixel_major.npy")}
+        with open(os.path.join(self.library_dir, "metadata.json.tmp"), "w") as f:
+            json.dump(metadata, f)
+        os.replace(os.path.join(self.library_dir, "metadata.json.tmp"), os.path.join(self.library_dir, "metadata.json"))
+
+    def save_library(self, library_dir):
+        """
+        Saves the library, correlation matrix, filenames and wavelengths into a directory that can be reopened with
+        PSFLibrary.load_library and appended to in place with add_new_dataset_to_library.
+
+        The frames and correlation matrix are stored as .npy memory maps with spare capacity, so appending files
+        only writes the new rows instead of rewriting the whole library.
+
+        Args:
+            library_dir (str): directory to save the library to. Created if it does not exist.
+        """
+        if not os.path.isdir(library_dir):
+            os.makedirs(library_dir)
+
+        capacity = max(self.nfiles, 1)
+        library = np.lib.format.open_memmap(os.path.join(library_dir, "library.npy"), mode='w+',
+                                            dtype=np.asarray(self.master_library[:1]).dtype,
+                                            shape=(capacity,) + tuple(np.shape(self.master_library)[1:]))
+        library[:self.nfiles] = self.master_library
+        correlation = np.lib.format.open_memmap(os.path.join(library_dir, "correlation.npy"), mode='w+',
+                                                dtype=float, shape=(capacity, capacity))
+        correlation[:self.nfiles, :self.nfiles] = self.master_correlation
+        library.flush()
+        correlation.flush()
+        with open(os.path.join(library_dir, "filenames.txt"), "w") as f:
+            for filename in self.master_filenames:
+                f.write("{0}\n".format(filename))
+        if self.master_wvs is not None:
+            np.save(os.path.join(library_dir, "wvs.npy"), np.asarray(self.master_wvs))
+
+        self.library_dir = library_dir
+        self._save_filename_index()
+        self._library_buffer = library
+        self._correlation_buffer = correlation
+        self.master_library = library[:self.nfiles]
+        self.master_correlation = correlation[:self.nfiles, :self.nfiles]
+        self._write_library_metadata()
+
+    def save_pixel_major(self, filename=None):
+        """
+        Saves a pixel-major (y*x, N) copy of the library. klip_dataset passes this file to the RDI workers, which
+        memory map it read-only and read only the pixels of the sector they work on, instead of every process
+        holding a copy of the whole library.
+
+        The file needs to be saved again after adding new datasets to the library.
+
+        Args:
+            filename (str): .npy file to write. Defaults to library_pixel_major.npy in library_dir if the library
+                            was saved with save_library
+
+        Returns:
+            filename (str): the file that was written
+        """
+        if filename is None:
+            if self.library_dir is None:
+                raise ValueError("A filename is needed for libraries that were not saved with save_library")
+            filename = os.path.join(self.library_dir, "library_pixel_major.npy")
+
+        npix = int(np.prod(np.shape(self.master_library)[1:]))
+        pixel_major = np.lib.format.open_memmap(filename, mode='w+', dtype=np.asarray(self.master_library[:1]).dtype,
+                                                shape=(npix, self.nfiles))
+        # transpose by blocks of frames to avoid pulling a memory mapped library in memory
+        for start in range(0, self.nfiles, 1024):
+            end = min(start + 1024, self.nfiles)
+            pixel_major[:, start:end] = np.reshape(self.master_library[start:end], (end - start, npix)).T
+        pixel_major.flush()
+        del pixel_major
+
+        self.pixel_major_file = filename
+        if self.library_dir is not None:
+            self._write_library_metadata()
+        return filename
+
+    def build_annulus_index(self, rad_bounds, ncomp=32, nlist=None, nprobe=None, seed=0):
+        """
+        Builds an AnnulusIndex of the library. When it exists, RDI reductions pick the library frames most correlated
+        to each science frame in each annulus from this index, rather than from the full frame correlation matrix.
+        Use AnnulusIndex.recall() to check how well it matches the exact selection.
+
+        The index needs to be built again after adding new datasets to the library.
+
+        Args:
+            rad_bounds (list): (radstart, radend) of each annulus. Should match the annuli of the reduction, e.g.
+                               klip.define_annuli_bounds(annuli, dataset.IWA, dataset.OWA)
+            ncomp (int): number of principal components kept for each annulus
+            nlist (int): number of cells for each annulus. Defaults to sqrt(N)
+            nprobe (int): number of cells scanned for each query. Defaults to nlist / 4
+            seed (int): random seed
+
+        Returns:
+            annulus_index (AnnulusIndex): the index, also stored in self.annulus_index
+        """
+        self.annulus_index = AnnulusIndex(self.master_library, self.aligned_center, rad_bounds, ncomp=ncomp,
+                                          nlist=nlist, nprobe=nprobe, seed=seed)
+        return self.annulus_index
+
+    def build_sector_grams(self, rad_bounds, subsections, dtype=float, numthreads=None):
+        """
+        Precomputes the covariance matrix and means of the library frames in each sector (see SectorGramCache).
+        RDI reductions with the same sectors then slice the covariance of the selected library PSFs out of it
+        instead of recomputing it for every science frame. If the library was saved with save_library, the
+        matrices are saved with it and reused when the library is loaded again.
+
+        The cache needs to be built again after adding new datasets to the library.
+
+        Args:
+            rad_bounds (list): (radstart, radend) of each annulus. Should match the annuli of the reduction, e.g.
+                               klip.define_annuli_bounds(annuli, dataset.IWA, dataset.OWA)
+            subsections (int): number of subsections in each annulus, as passed to klip_dataset
+            dtype: data type to store the covariance matrices in
+            numthreads (int): number of threads. If None, use all the cores
+
+        Returns:
+            sector_grams (SectorGramCache): the cache, also stored in self.sector_grams
+        """
+        # same sectors as parallelized.klip_parallelized
+        dphi = 2 * np.pi / subsections
+        phi_bounds = [[dphi * phi_i - np.pi, dphi * (phi_i + 1) - np.pi] for phi_i in range(subsections)]
+        phi_bounds[-1][1] = np.pi
+        sectors = [(radstart, radend, phistart, phiend) for phistart, phiend in phi_bounds
+                   for radstart, radend in rad_bounds]
+
+        cache_dir = None
+        if self.library_dir is not None:
+            cache_dir = os.path.join(self.library_dir, "sector_grams")
+        self.sector_grams = SectorGramCache(self.master_library, self.aligned_center, sectors, cache_dir=cache_dir,
+                                            dtype=dtype, numthreads=numthreads)
+        return self.sector_grams
+
+    @classmethod
+    def load_library(cls, library_dir):
+        """
+        Opens a library saved with save_library. The frames and correlation matrix are memory mapped, so only the
+        parts that are used are read from disk.
+
+        Args:
+            library_dir (str): directory the library was saved to
+
+        Returns:
+            psflib (PSFLibrary): the library. New datasets added to it are written to library_dir
+        """
+        with open(os.path.join(library_dir, "metadata.json")) as f:
+            metadata = json.load(f)
+        nfiles = metadata["nfiles"]
+
+        library = np.lib.format.open_memmap(os.path.join(library_dir, "library.npy"), mode='r+')
+        correlation = np.lib.format.open_memmap(os.path.join(library_dir, "correlation.npy"), mode='r+')
+        with open(os.path.join(library_dir, "filenames.txt")) as f:
+            filenames = np.array(f.read().splitlines()[:nfiles])
+        wvs_file = os.path.join(library_dir, "wvs.npy")
+        wvs = np.load(wvs_file)[:nfiles] if os.path.isfile(wvs_file) else None
+
+        # the library was already high-pass filtered (if requested) when it was saved
+        psflib = cls(library[:nfiles], metadata["aligned_center"], filenames,
+                     correlation_matrix=correlation[:nfiles, :nfiles], wvs=wvs)
+        psflib.highpass = metadata["highpass"]
+        psflib.library_dir = library_dir
+        psflib._library_buffer = library
+        psflib._correlation_buffer = correlation
+        index_file = os.path.join(library_dir, "filename_index.json")
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                filename_index = json.load(f)
+            # a stale index (e.g. from an interrupted append) is rebuilt from the filenames instead
+            if filename_index["nfiles"] == nfiles:
+                psflib._filename_index = filename_index["index"]
+        pixel_major_file = os.path.join(library_dir, "library_pixel_major.npy")
+        if metadata.get("pixel_major", False) and os.path.isfile(pixel_major_file):
+            psflib.pixel_major_file = pixel_major_file
+        sector_grams_dir = os.path.join(library_dir, "sector_grams")
+        if os.path.isfile(os.path.join(sector_grams_dir, "sectors.json")):
+            sector_grams = SectorGramCache.load(sector_grams_dir)
+            # only use it if it has all the files of the library
+            if sector_grams.nfiles == nfiles:
+                psflib.sector_grams = sector_grams
+        return psflib
+
+    def add_new_dataset_to_library(self, dataset, collapse = False, verbose=False, numthreads=None):
         """
         Add all the files from a new dataset to the PSF library and add them to the correlation matrix. 
         If a mask was used for the correlation matrix, use it here too. 
 
+        The new files are written into spare rows of the library (capacity doubles when it runs out) and correlated
+        against the whole library in blocks. If the library was saved with save_library, the new files are written
+        to disk.
+
         NOTE: This routine already assumes that the data has been centered. 
 
         Args:
             dataset (pyklip.instruments.Instrument.Data)
+            collapse (bool): if True, collapse the spectral cubes of the dataset first
+            verbose (bool): if True, print progress
+            numthreads (int): number of threads to compute the correlations with. If None, use all the cores
         """
 
         if collapse: 
@@ -268,6 +707,8 @@ class PSFLibrary(object):
                 stdout.write("\rCollapsing spectral cubes.....Done\n")
 
         n_newfiles = dataset.input.shape[0]
+        n_oldfiles = self.nfiles
+        n_allfiles = n_oldfiles + n_newfiles
         if verbose:
             print("Found {} new files".format(n_newfiles))
 
@@ -275,15 +716,9 @@ class PSFLibrary(object):
             stdout.write("Appending to master_library and master_filenames arrays.....")
             stdout.flush()
 
-        #Increase the size of the data array, correlation matrix and file list
-        self.master_correlation = np.pad(self.master_correlation,((0,n_newfiles),(0,n_newfiles)), mode='constant', constant_values=0)
-        self.master_library = np.pad(self.master_library,((0,n_newfiles),(0,0),(0,0)), mode='constant', constant_values=0)
-
-        #Add the filenames to the library
-        self.master_filenames = np.append(self.master_filenames,dataset.filenames)        
-
-        #Put the new data in the master_library
-        self.master_library[self.nfiles:self.nfiles+n_newfiles] = dataset.input
+        #Make room for the new files and put the new data in the library
+        self._reserve(n_allfiles)
+        self._library_buffer[n_oldfiles:n_allfiles] = dataset.input
 
         if verbose:
             stdout.write("Appending to master_library and master_filenames arrays.....Done\n")
@@ -292,38 +727,454 @@ class PSFLibrary(object):
         if verbose:
             print("Correlating {} new files with existing {} files in the library".format(n_newfiles,self.nfiles))
 
-        #Run the correlation
-        for i in np.arange(self.nfiles+n_newfiles-1,self.nfiles-1,-1):
-            self.master_correlation[i,i]=1.
+        #Run the correlation of the new files against the whole library (including themselves)
+        new_correlation = _blocked_correlation(dataset.input, self._library_buffer[:n_allfiles],
+                                               mask=self.correlation_mask, numthreads=numthreads)
+        new_correlation[np.arange(n_newfiles), n_oldfiles + np.arange(n_newfiles)] = 1.
+        self._correlation_buffer[n_oldfiles:n_allfiles, :n_allfiles] = new_correlation
+        self._correlation_buffer[:n_oldfiles, n_oldfiles:n_allfiles] = new_correlation[:, :n_oldfiles].T
+
+        #Add the filenames (and wavelengths) to the library
+        self.master_filenames = np.append(self.master_filenames,dataset.filenames)
+        self._index_filenames(dataset.filenames, first_row=n_oldfiles)
+        if self.master_wvs is not None:
+            self.master_wvs = np.append(self.master_wvs, dataset.wvs)
+
+        self.nfiles = n_allfiles
+        # the pixel-major copy, annulus index and sector covariances no longer have all the files
+        self.pixel_major_file = None
+        self.annulus_index = None
+        self.sector_grams = None
+        self.master_library = self._library_buffer[:self.nfiles]
+        self.master_correlation = self._correlation_buffer[:self.nfiles, :self.nfiles]
+
+        if self.library_dir is not None:
+            self._library_buffer.flush()
+            self._correlation_buffer.flush()
+            with open(os.path.join(self.library_dir, "filenames.txt"), "w") as f:
+                for filename in self.master_filenames:
+                    f.write("{0}\n".format(filename))
+            if self.master_wvs is not None:
+                np.save(os.path.join(self.library_dir, "wvs.npy"), np.asarray(self.master_wvs))
+            self._save_filename_index()
+            self._write_library_metadata()
 
-            #TODO: PARALLELIZE THIS STEP
+        if verbose:
+            print("Done updating correlation matrix")
 
-            #Cycle through every file that comes AFTER the current file 
-            for j in np.arange(0,i):
 
-                if verbose:
-                    # print("Correlating file "+ str(i) + " with file "+str(j) + "  \r")
-                    stdout.write("\r Correlating new file {0} with file {1}".format(n_newfiles - (i-self.nfiles+1),j))
-                    stdout.flush()
-                
-                #You might want to only correlate some of the image. 
-                if self.correlation_mask is not None:
-                    where_to_corr = (self.master_library[i,:,:] == self.master_library[i,:,:]) & (self.master_library[j,:,:] == self.master_library[j,:,:]) & (self.correlation_mask == self.correlation_mask)
-                else: 
-                #Ditch where either of the two arrays have NANs
-                    where_to_corr = (self.master_library[i,:,:] == self.master_library[i,:,:]) & (self.master_library[j,:,:] == self.master_library[j,:,:]) 
+class AnnulusIndex(object):
+    """
+    Approximate nearest-neighbour index of a PSF library, used to pick the most correlated library frames of a
+    science frame without a precomputed N_sci x N_lib correlation matrix.
 
-                data1= self.master_library[i,:,:]
-                data2= self.master_library[j,:,:]
+    For each annulus, the library frames are mean subtracted and normalized over the pixels of the annulus, so that
+    the correlation between two frames is the dot product of their vectors. The vectors are compressed by projecting
+    them on their first ncomp principal components, and the projections are clustered into nlist cells.
+    A query only scores the library frames in the nprobe cells closest to the science frame, so it does not scan
+    the whole library.
 
-                #I believe this bit was copied and pasted from pyklip at some point. 
-                covar_psfs=np.cov([data2[where_to_corr], data1[where_to_corr]])
-                covar_diag = np.diagflat(1./np.sqrt(np.diag(covar_psfs)))
-                corr_psfs = np.dot( np.dot(covar_diag, covar_psfs ), covar_diag)
+    Attributes:
+        rad_bounds (list): (radstart, radend) of each annulus
+        aligned_center (array-like): (x,y) center the library is aligned to
+        nfiles (int): number of library frames in the index
+        ncomp (int): number of principal components kept for each annulus
+        nlist (int): number of cells for each annulus
+        nprobe (int): default number of cells scanned by a query
+    """
 
-                self.master_correlation[i,j]=corr_psfs[0,1]
-                self.master_correlation[j,i]=corr_psfs[0,1]
-        self.nfiles = self.nfiles+n_newfiles
-        if verbose:
-            print("\nDone updating correlation matrix")
+    def __init__(self, library, aligned_center, rad_bounds, ncomp=32, nlist=None, nprobe=None, seed=0,
+                 block_size=1024):
+        """
+        Args:
+            library (np.ndarray): (N, y, x) aligned PSF library (can be a memmap)
+            aligned_center (array-like): (x,y) center the library is aligned to
+            rad_bounds (list): (radstart, radend) of each annulus, e.g. from klip.define_annuli_bounds()
+            ncomp (int): number of principal components to keep for each annulus
+            nlist (int): number of cells for each annulus. Defaults to sqrt(N)
+            nprobe (int): default number of cells to scan for each query. Defaults to nlist / 4
+            seed (int): seed of the random number generator used for the PCA and clustering
+            block_size (int): number of library frames read at a time
+        """
+        self.rad_bounds = [tuple(bounds) for bounds in rad_bounds]
+        self.aligned_center = aligned_center
+        self.nfiles = np.shape(library)[0]
+        self.ncomp = int(min(ncomp, self.nfiles))
+        if nlist is None:
+            nlist = int(np.sqrt(self.nfiles))
+        self.nlist = int(max(1, min(nlist, self.nfiles)))
+        if nprobe is None:
+            nprobe = int(np.ceil(self.nlist / 4.))
+        self.nprobe = int(max(1, nprobe))
+
+        rng = np.random.RandomState(seed)
+        ny, nx = np.shape(library)[1:]
+        x, y = np.meshgrid(np.arange(nx * 1.0), np.arange(ny * 1.0))
+        r, _ = klip.make_polar_coordinates(x.ravel(), y.ravel(), aligned_center)
+
+        self._pixels = []
+        self._components = []
+        self._embeddings = []
+        self._centroids = []
+        self._cell_order = []
+        self._cell_offsets = []
+        for radstart, radend in self.rad_bounds:
+            pixels = np.where((r >= radstart) & (r < radend))[0]
+
+            def _read_block(start, end, pixels=pixels):
+                frames = np.reshape(library[start:end], (end - start, ny * nx))[:, pixels]
+                return self._normalize(frames)
+
+            components = self._principal_components(_read_block, pixels.size, rng, block_size)
+            embeddings = np.concatenate([np.dot(_read_block(start, min(start + block_size, self.nfiles)),
+                                                components.T)
+                                         for start in range(0, self.nfiles, block_size)]).astype(np.float32)
+            centroids, labels = self._cluster(embeddings, rng)
+            cell_order = np.argsort(labels, kind='stable')
+            cell_offsets = np.searchsorted(labels[cell_order], np.arange(self.nlist + 1))
+
+            self._pixels.append(pixels)
+            self._components.append(components.astype(np.float32))
+            self._embeddings.append(embeddings)
+            self._centroids.append(centroids)
+            self._cell_order.append(cell_order)
+            self._cell_offsets.append(cell_offsets)
+
+    @staticmethod
+    def _normalize(frames):
+        """
+        Mean subtracts and normalizes each row over its finite pixels, setting NaNs to 0
+
+        Args:
+            frames (np.ndarray): (n, p) array
+
+        Returns:
+            (n, p) array of unit vectors (or zeros for empty rows)
+        """
+        frames = np.array(frames, dtype=float)
+        with np.errstate(invalid='ignore'):
+            frames -= np.nanmean(frames, axis=1)[:, None]
+        frames[np.isnan(frames)] = 0
+        norms = np.sqrt(np.sum(frames * frames, axis=1))
+        norms[norms == 0] = 1
+        return frames / norms[:, None]
+
+    def _principal_components(self, read_block, npix, rng, block_size, n_oversample=10, n_power_iter=1):
+        """
+        First ncomp principal components of the normalized library vectors, using a randomized SVD that reads the
+        library one block of frames at a time
 
+        Returns:
+            (ncomp, npix) array of orthonormal components
+        """
+        nsketch = min(self.ncomp + n_oversample, npix, self.nfiles)
+        blocks = [(start, min(start + block_size, self.nfiles)) for start in range(0, self.nfiles, block_size)]
+        # range of the library
+        omega = rng.normal(size=(npix, nsketch))
+        sketch = np.concatenate([np.dot(read_block(start, end), omega) for start, end in blocks])
+        for _ in range(n_power_iter):
+            q = np.linalg.qr(sketch)[0]
+            projected = np.zeros((nsketch, npix))
+            for start, end in blocks:
+                projected += np.dot(q[start:end].T, read_block(start, end))
+            sketch = np.concatenate([np.dot(read_block(start, end), projected.T) for start, end in blocks])
+        q = np.linalg.qr(sketch)[0]
+        projected = np.zeros((nsketch, npix))
+        for start, end in blocks:
+            projected += np.dot(q[start:end].T, read_block(start, end))
+        components = np.linalg.svd(projected, full_matrices=False)[2]
+        return components[:self.ncomp]
+
+    def _cluster(self, embeddings, rng, niter=10):
+        """
+        Spherical k-means of the embeddings into nlist cells
+
+        Returns:
+            centroids: (nlist, ncomp) array
+            labels: cell of each library frame
+        """
+        centroids = embeddings[rng.choice(embeddings.shape[0], self.nlist, replace=False)].astype(float)
+        for _ in range(niter):
+            labels = np.argmax(np.dot(embeddings, centroids.T), axis=1)
+            for cell in range(self.nlist):
+                members = embeddings[labels == cell]
+                if members.shape[0] > 0:
+                    centroid = np.sum(members, axis=0)
+                    centroids[cell] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        labels = np.argmax(np.dot(embeddings, centroids.T), axis=1)
+        return centroids.astype(np.float32), labels
+
+    def annulus_at(self, radius):
+        """
+        Index of the annulus that contains a radius, or None if the radius is outside of the index
+        """
+        for i, (radstart, radend) in enumerate(self.rad_bounds):
+            if radstart <= radius < radend:
+                return i
+        return None
+
+    def query(self, img, annulus, k, subset=None, nprobe=None):
+        """
+        Approximate k most correlated library frames of a science image in an annulus
+
+        Args:
+            img (np.ndarray): science image aligned to the library, shape (y, x) or flattened (y*x)
+            annulus (int): index of the annulus (see annulus_at)
+            k (int): number of library frames to return
+            subset (np.ndarray): if not None, indices of the library frames allowed to be returned
+            nprobe (int): number of cells to scan. More cells are scanned if they hold fewer than k allowed frames
+
+        Returns:
+            indices of the selected frames, most correlated last. Indices are into subset if it is given,
+            otherwise into the library
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        sci_vec = self._normalize(np.ravel(img)[self._pixels[annulus]][None, :])[0]
+        sci_embedding = np.dot(self._components[annulus], sci_vec)
+
+        if subset is not None:
+            subset = np.asarray(subset)
+            # position of each library frame in subset (-1 if not allowed)
+            subset_position = np.full(self.nfiles, -1)
+            subset_position[subset] = np.arange(subset.size)
+            navailable = subset.size
+        else:
+            navailable = self.nfiles
+        k = int(min(k, navailable))
+
+        cell_scores = np.dot(self._centroids[annulus], sci_embedding)
+        cell_rank = np.argsort(cell_scores)[::-1]
+        offsets = self._cell_offsets[annulus]
+        nprobe = min(nprobe, self.nlist)
+        while True:
+            cells = cell_rank[:nprobe]
+            candidates = np.concatenate([self._cell_order[annulus][offsets[cell]:offsets[cell + 1]]
+                                         for cell in cells])
+            if subset is not None:
+                candidates = candidates[subset_position[candidates] >= 0]
+            if candidates.size >= k or nprobe >= self.nlist:
+                break
+            nprobe = min(2 * nprobe, self.nlist)
+
+        scores = np.dot(self._embeddings[annulus][candidates], sci_embedding)
+        best = candidates[np.argsort(scores)[-k:]]
+        if subset is not None:
+            best = subset_position[best]
+        return best
+
+    def recall(self, library, imgs, k, subset=None, nprobe=None):
+        """
+        Recall of the approximate selection against the exact k most correlated library frames (correlation over
+        the pixels of each annulus)
+
+        Args:
+            library (np.ndarray): (N, y, x) library the index was built from
+            imgs (np.ndarray): (M, y, x) science images aligned to the library
+            k (int): number of library frames selected for each image
+            subset (np.ndarray): if not None, indices of the library frames allowed to be selected
+            nprobe (int): number of cells to scan
+
+        Returns:
+            recall (np.ndarray): mean fraction of the exact k best frames that the index returns, for each annulus
+        """
+        imgs = np.reshape(imgs, (np.shape(imgs)[0], -1))
+        library_flat = np.reshape(library, (self.nfiles, -1))
+        recall = np.zeros(len(self.rad_bounds))
+        for annulus, pixels in enumerate(self._pixels):
+            library_vecs = self._normalize(library_flat[:, pixels])
+            if subset is not None:
+                library_vecs = library_vecs[subset]
+            sci_vecs = self._normalize(imgs[:, pixels])
+            exact = np.argsort(np.dot(sci_vecs, library_vecs.T), axis=1)[:, -k:]
+            for img, exact_best in zip(imgs, exact):
+                approx_best = self.query(img, annulus, k, subset=subset, nprobe=nprobe)
+                recall[annulus] += np.intersect1d(approx_best, exact_best).size / float(exact_best.size)
+        return recall / imgs.shape[0]
+
+
+class SectorGramCache(object):
+    """
+    Per-sector covariance (Gram) matrices and means of a PSF library. The covariance of a set of library frames in a
+    sector only depends on the library and the sector geometry, so it can be computed once and reused by every
+    RDI reduction with the same annuli/subsections, instead of recomputing np.cov of the selected library frames for
+    every science frame.
+
+    For each sector, the library frames are mean subtracted (NaN-aware) over the sector pixels and NaNs are set to 0,
+    like the RDI PSFs in parallelized._klip_section_multifile_perfile. The cache stores those means and the N x N
+    covariance matrix of the resulting vectors.
+
+    The covariance matrices are never pickled. Processes that get a pickled copy of the cache memory map them from
+    cache_dir, or, for a cache kept in memory, don't find the sectors with lookup and compute the covariances of the
+    selected frames themselves. Use cache_dir to share the matrices with worker processes.
+
+    Attributes:
+        sectors (list): (radstart, radend, phistart, phiend) of each sector
+        npix (list): number of pixels in each sector
+        nfiles (int): number of library frames
+        cache_dir (str): directory the matrices are saved in, or None if they are only in memory
+    """
+
+    def __init__(self, library, aligned_center, sectors, cache_dir=None, dtype=float, block_size=None,
+                 numthreads=None):
+        """
+        Args:
+            library (np.ndarray): (N, y, x) aligned PSF library (can be a memmap)
+            aligned_center (array-like): (x,y) center the library is aligned to
+            sectors (list): (radstart, radend, phistart, phiend) of each sector, as used by the reduction
+            cache_dir (str): if not None, save the matrices as .npy files in this directory and memory map them
+            dtype: data type to store the covariance matrices in
+            block_size (int): number of frames per block when computing the matrices
+            numthreads (int): number of threads. If None, use all the cores
+        """
+        self.sectors = [tuple(float(bound) for bound in sector) for sector in sectors]
+        self.nfiles = np.shape(library)[0]
+        self.cache_dir = cache_dir
+        self._covars = []
+        self._means = []
+        self.npix = []
+
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        if numthreads is None:
+            numthreads = mp.cpu_count()
+
+        ny, nx = np.shape(library)[1:]
+        x, y = np.meshgrid(np.arange(nx * 1.0), np.arange(ny * 1.0))
+        r, phi = klip.make_polar_coordinates(x.ravel(), y.ravel(), aligned_center)
+
+        for i, (radstart, radend, phistart, phiend) in enumerate(self.sectors):
+            section_ind = np.where((r >= radstart) & (r < radend) & (phi >= phistart) & (phi < phiend))[0]
+            npix = section_ind.size
+            frames = np.reshape(library, (self.nfiles, ny * nx))[:, section_ind]
+            with np.errstate(invalid='ignore'):
+                means = np.nanmean(frames, axis=1)
+            frames = frames - means[:, None]
+            frames[np.isnan(frames)] = 0
+
+            if cache_dir is None:
+                covar = np.zeros((self.nfiles, self.nfiles), dtype=dtype)
+            else:
+                covar = np.lib.format.open_memmap(os.path.join(cache_dir, "covar_{0}.npy".format(i)), mode='w+',
+                                                  dtype=dtype, shape=(self.nfiles, self.nfiles))
+            self._fill_covariance(covar, frames, max(npix - 1, 1), block_size, numthreads)
+
+            if cache_dir is not None:
+                covar.flush()
+                del covar
+                np.save(os.path.join(cache_dir, "means_{0}.npy".format(i)), means)
+                covar = None
+            self._covars.append(covar)
+            self._means.append(means)
+            self.npix.append(int(npix))
+
+        if cache_dir is not None:
+            with open(os.path.join(cache_dir, "sectors.json"), "w") as f:
+                json.dump({"sectors": self.sectors, "npix": self.npix, "nfiles": int(self.nfiles)}, f)
+
+    @staticmethod
+    def _fill_covariance(covar, frames, norm, block_size, numthreads):
+        """
+        Fills covar with frames . frames.T / norm, one pair of blocks of frames at a time
+        """
+        nfiles = frames.shape[0]
+        if block_size is None:
+            block_size = max(1, _corr_block_bytes // (8 * 2 * max(frames.shape[1], 1) * numthreads))
+        blocks = [(start, min(start + block_size, nfiles)) for start in range(0, nfiles, block_size)]
+        pairs = [(b1, b2) for i1, b1 in enumerate(blocks) for i2, b2 in enumerate(blocks) if i2 >= i1]
+
+        def _covar_pair(pair):
+            (start1, end1), (start2, end2) = pair
+            block = np.dot(frames[start1:end1], frames[start2:end2].T) / norm
+            covar[start1:end1, start2:end2] = block
+            covar[start2:end2, start1:end1] = block.T
+
+        if numthreads > 1 and len(pairs) > 1:
+            pool = ThreadPool(processes=min(numthreads, len(pairs)))
+            try:
+                pool.map(_covar_pair, pairs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for pair in pairs:
+                _covar_pair(pair)
+
+    @classmethod
+    def load(cls, cache_dir):
+        """
+        Opens a cache saved in cache_dir. The covariance matrices are memory mapped when they are first used.
+
+        Args:
+            cache_dir (str): directory the cache was saved in
+
+        Returns:
+            SectorGramCache
+        """
+        with open(os.path.join(cache_dir, "sectors.json")) as f:
+            metadata = json.load(f)
+        cache = cls.__new__(cls)
+        cache.sectors = [tuple(sector) for sector in metadata["sectors"]]
+        cache.npix = metadata["npix"]
+        cache.nfiles = metadata["nfiles"]
+        cache.cache_dir = cache_dir
+        cache._covars = [None for _ in cache.sectors]
+        cache._means = [np.load(os.path.join(cache_dir, "means_{0}.npy".format(i))) for i in range(len(cache.sectors))]
+        return cache
+
+    def __getstate__(self):
+        # don't pickle the N x N matrices: workers open them again from cache_dir, or compute them without the cache
+        state = self.__dict__.copy()
+        state["_covars"] = [None for _ in self.sectors]
+        return state
+
+    def lookup(self, radstart, radend, phistart, phiend, npix=None):
+        """
+        Index of a sector in the cache, or None if it is not cached
+
+        Args:
+            radstart, radend, phistart, phiend: bounds of the sector
+            npix (int): if not None, also check the sector has this many pixels
+
+        Returns:
+            index of the sector or None
+        """
+        for i, sector in enumerate(self.sectors):
+            if np.allclose(sector, (radstart, radend, phistart, phiend), rtol=0, atol=1e-6):
+                if npix is not None and npix != self.npix[i]:
+                    return None
+                # a pickled copy of an in-memory cache does not have the covariance matrices
+                if self._covars[i] is None and self.cache_dir is None:
+                    return None
+                return i
+        return None
+
+    def means(self, sector, indices):
+        """
+        Means of library frames in a sector
+
+        Args:
+            sector (int): index of the sector (see lookup)
+            indices (np.ndarray): indices of library frames
+
+        Returns:
+            array of the mean of each frame over the sector pixels
+        """
+        return self._means[sector][indices]
+
+    def covariance(self, sector, indices):
+        """
+        Covariance matrix of library frames in a sector, same as np.cov of their mean subtracted, NaN zeroed pixels
+
+        Args:
+            sector (int): index of the sector (see lookup)
+            indices (np.ndarray): indices of library frames
+
+        Returns:
+            (np.size(indices), np.size(indices)) covariance matrix
+        """
+        if self._covars[sector] is None:
+            self._covars[sector] = np.load(os.path.join(self.cache_dir, "covar_{0}.npy".format(sector)),
+                                           mmap_mode='r')
+        indices = np.asarray(indices)
+        return np.array(self._covars[sector][np.ix_(indices, indices)], dtype=float)
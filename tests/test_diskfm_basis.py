@@ -0,0 +1,175 @@
+import gc
+import os
+import types
+
+import numpy as np
+
+import pyklip.fm as fm
+import pyklip.klip as klip
+from pyklip.fmlib.diskfm import DiskFM
+
+
+def _make_disk_basis(tmpdir, nframes=8, size=41, numbasis=(1, 3), seed=0, extension=".h5"):
+    """
+    Measures and saves the KL basis of a small ADI sequence with a DiskFM object, and returns a disk model with the
+    filename of the basis
+    """
+    rng = np.random.RandomState(seed)
+    y, x = np.indices((size, size))
+    center = (size - 1) / 2.
+    r = np.sqrt((x - center)**2 + (y - center)**2)
+    speckles = np.exp(-r / 6.) * (1 + 0.2 * rng.normal(size=(size, size)))
+    imgs = np.array([speckles * (1 + 0.05 * rng.normal()) + 0.01 * rng.normal(size=(size, size))
+                     for _ in range(nframes)])
+    centers = np.zeros((nframes, 2)) + center
+    parangs = np.linspace(0, 60, nframes)
+    wvs = np.ones(nframes)
+    dataset = types.SimpleNamespace(PAs=parangs, wvs=wvs, centers=centers)
+
+    model = np.exp(-((x - center - 8)**2 + (y - center)**2 / 4.) / 4.)
+    numbasis = np.array(numbasis)
+    basis_filename = os.path.join(str(tmpdir), "diskfm_KLbasis" + extension)
+
+    diskobj = DiskFM(imgs.shape, numbasis, dataset, model, basis_filename=basis_filename, save_basis=True,
+                     aligned_center=[center, center])
+    fm.klip_parallelized(imgs, centers, parangs, wvs, 3, diskobj, np.copy(centers), OWA=int(center) - 2,
+                         mode="ADI", annuli=3, subsections=2, movement=1, numbasis=numbasis,
+                         aligned_center=[center, center], numthreads=2, corr_smooth=0, mute_progression=True)
+    return model, basis_filename
+
+
+def test_fm_parallelized_pool(tmpdir):
+    """
+    Forward modelling the loaded KL basis with the persistent pool of processes should give the same models as the
+    serial loop, also after updating the disk model
+    """
+    model, basis_filename = _make_disk_basis(tmpdir)
+    diskobj = DiskFM(None, None, None, model, basis_filename=basis_filename, load_from_basis=True)
+
+    pools = []
+    try:
+        for shift in range(3):
+            diskobj.update_disk(np.roll(model, shift, axis=1))
+            serial_fm = diskobj.fm_parallelized()
+            pool_fm = diskobj.fm_parallelized(numthreads=2)
+            pools.append(diskobj._fm_pool)
+
+            assert np.nanmax(np.abs(serial_fm)) > 0
+            np.testing.assert_array_equal(pool_fm, serial_fm)
+        # the pool is started once and reused for the following models
+        assert all(pool is pools[0] for pool in pools)
+    finally:
+        diskobj.close_pool()
+    assert diskobj._fm_pool is None
+
+
+def test_fm_pool_lifetime(tmpdir):
+    """
+    The pool of processes should be closed when a new KL basis is loaded, and when the DiskFM object is garbage
+    collected without calling close_pool
+    """
+    model, basis_filename = _make_disk_basis(tmpdir)
+    diskobj = DiskFM(None, None, None, model, basis_filename=basis_filename, load_from_basis=True)
+    serial_fm = diskobj.fm_parallelized()
+
+    diskobj.fm_parallelized(numthreads=2)
+    pool = diskobj._fm_pool
+    diskobj.load_basis_files()
+    assert diskobj._fm_pool is None
+    assert pool._state != 'RUN'
+    # a new pool is started with the new KL basis
+    np.testing.assert_array_equal(diskobj.fm_parallelized(numthreads=2), serial_fm)
+    assert diskobj._fm_pool is not pool
+
+    pool = diskobj._fm_pool
+    del diskobj
+    gc.collect()
+    assert pool._state != 'RUN'
+
+
+def test_fm_batch(tmpdir):
+    """
+    Forward modelling a stack of disk models at once should give the same models as updating the disk and forward
+    modelling each of them
+    """
+    model, basis_filename = _make_disk_basis(tmpdir)
+    diskobj = DiskFM(None, None, None, model, basis_filename=basis_filename, load_from_basis=True)
+
+    models = np.array([np.roll(model, shift, axis=1) * (1 + 0.1 * shift) for shift in range(4)])
+    models[1, 3:6, 10:12] = np.nan
+    batch_fm = diskobj.fm_batch(models)
+
+    serial_fm = []
+    for one_model in models:
+        diskobj.update_disk(one_model)
+        serial_fm.append(diskobj.fm_parallelized())
+    serial_fm = np.array(serial_fm)
+
+    assert batch_fm.shape == serial_fm.shape
+    assert np.nanmax(np.abs(serial_fm)) > 0
+    np.testing.assert_allclose(batch_fm, serial_fm, rtol=1e-10, atol=1e-12)
+
+
+def test_update_disk_rotation_operators(tmpdir):
+    """
+    Rotating the models with the precomputed sparse operators should give the same models as klip.rotate, and the
+    operators cached next to the KL basis should be reused
+    """
+    model, basis_filename = _make_disk_basis(tmpdir)
+    model[3:6, 10:12] = np.nan
+    diskobj = DiskFM(None, None, None, model, basis_filename=basis_filename, load_from_basis=True,
+                     cache_rotation_operators=True)
+
+    rotated_models = np.zeros(diskobj.inputs_shape)
+    for i, pa in enumerate(diskobj.PAs):
+        rotated_models[i] = klip.rotate(np.copy(model), pa, diskobj.aligned_center, flipx=True)
+    rotated_models[np.isnan(rotated_models)] = 0
+    rotated_models = rotated_models.reshape(diskobj.model_disks.shape)
+    np.testing.assert_allclose(diskobj.model_disks, rotated_models, rtol=1e-10, atol=1e-12)
+
+    assert os.path.exists(diskobj.rotation_operators_filename)
+    cached_diskobj = DiskFM(None, None, None, model, basis_filename=basis_filename, load_from_basis=True,
+                            cache_rotation_operators=True)
+    for pa in diskobj._rotation_operators:
+        assert (cached_diskobj._rotation_operators[pa] != diskobj._rotation_operators[pa]).nnz == 0
+    np.testing.assert_array_equal(cached_diskobj.model_disks, diskobj.model_disks)
+
+
+def test_packed_kl_basis(tmpdir):
+    """
+    The packed KL basis should be memory-mapped when it is loaded and give the same FM as the h5 KL basis, also when
+    it is converted from a loaded h5 KL basis
+    """
+    model, basis_filename = _make_disk_basis(tmpdir)
+    diskobj = DiskFM(None, None, None, model, basis_filename=basis_filename, load_from_basis=True)
+    h5_fm = diskobj.fm_parallelized()
+
+    _, packed_filename = _make_disk_basis(tmpdir, extension=".klbasis")
+    assert os.path.isdir(packed_filename)
+    packed_diskobj = DiskFM(None, None, None, model, basis_filename=packed_filename, load_from_basis=True)
+    key = packed_diskobj.dict_keys[0]
+    assert isinstance(packed_diskobj.klmodes_dict[key].base, np.memmap)
+    np.testing.assert_array_equal(packed_diskobj.klmodes_dict[key], diskobj.klmodes_dict[key])
+    np.testing.assert_array_equal(packed_diskobj.fm_parallelized(), h5_fm)
+
+    # convert the loaded h5 KL basis
+    diskobj.basis_filename = os.path.join(str(tmpdir), "converted_KLbasis.klbasis")
+    diskobj.save_kl_basis()
+    converted_diskobj = DiskFM(None, None, None, model, basis_filename=diskobj.basis_filename, load_from_basis=True)
+    assert converted_diskobj.dict_keys == diskobj.dict_keys
+    np.testing.assert_array_equal(converted_diskobj.fm_parallelized(), h5_fm)
+
+
+def test_precomputed_fm_operators(tmpdir):
+    """
+    The precomputed linear FM operators should give the same FM as the perturbation of the KL modes
+    """
+    model, basis_filename = _make_disk_basis(tmpdir)
+    diskobj = DiskFM(None, None, None, model, basis_filename=basis_filename, load_from_basis=True)
+    linear_diskobj = DiskFM(None, None, None, model, basis_filename=basis_filename, load_from_basis=True,
+                            precompute_fm_operators=True)
+
+    np.testing.assert_allclose(linear_diskobj.fm_parallelized(), diskobj.fm_parallelized(), rtol=1e-10, atol=1e-12)
+
+    models = np.array([np.roll(model, shift, axis=1) for shift in range(3)])
+    np.testing.assert_allclose(linear_diskobj.fm_batch(models), diskobj.fm_batch(models), rtol=1e-10, atol=1e-12)
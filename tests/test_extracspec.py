@@ -1,8 +1,10 @@
 import glob
 import os
 import time
+import types
 import pytest
 import numpy as np
+import scipy.linalg
 
 import pyklip.instruments.GPI as GPI
 import pyklip.fmlib.extractSpec as es
@@ -84,6 +86,183 @@ def test_spectral_extract():
     plt.plot(np.unique(dataset.wvs), exspect[1])
     plt.show()
 
+def _make_spec_dataset(ncubes=4, nl=2, size=41, seed=0):
+    """
+    Makes a small IFS-like sequence of ncubes cubes of nl wavelengths, and the PSFs of the wavelengths
+    """
+    rng = np.random.RandomState(seed)
+    y, x = np.indices((size, size))
+    center = (size - 1) / 2.
+    r = np.sqrt((x - center)**2 + (y - center)**2)
+    speckles = np.exp(-r / 6.) * (1 + 0.2 * rng.normal(size=(size, size)))
+    imgs = np.array([speckles * (1 + 0.05 * rng.normal()) + 0.01 * rng.normal(size=(size, size))
+                     for _ in range(ncubes * nl)])
+    centers = np.zeros((ncubes * nl, 2)) + center
+    parangs = np.repeat(np.linspace(0, 60, ncubes), nl)
+    psfs_wvs = 1 + 0.1 * np.arange(nl)
+    wvs = np.tile(psfs_wvs, ncubes)
+    dataset = types.SimpleNamespace(input=imgs, centers=centers, PAs=parangs, wvs=wvs,
+                                    filenums=np.repeat(np.arange(ncubes), nl))
+    psf_y, psf_x = np.indices((9, 9)) - 4
+    input_psfs = np.array([np.exp(-(psf_x**2 + psf_y**2) / (3. * wv)) for wv in psfs_wvs])
+    return dataset, input_psfs, psfs_wvs
+
+
+def _run_extract_spec(dataset, input_psfs, psfs_wvs, numbasis, sep, pa, subsections=1, **kwargs):
+    """
+    Runs KLIP-FM with ExtractSpec on a dataset made by _make_spec_dataset and returns fmout
+    """
+    fm_class = es.ExtractSpec(dataset.input.shape, numbasis, sep, pa, input_psfs, psfs_wvs, stamp_size=6,
+                              datatype="double", **kwargs)
+    _, fmout, _, _, _ = fm.klip_parallelized(dataset.input, dataset.centers, dataset.PAs, dataset.wvs, 4, fm_class,
+                                             np.copy(dataset.centers), OWA=19, annuli=[[4, 19]], subsections=subsections,
+                                             movement=1, numbasis=numbasis, mode="ADI", numthreads=1, corr_smooth=0,
+                                             mute_progression=True)
+    return np.array(fmout)
+
+
+def test_multi_planet_extraction():
+    """
+    Extracting the spectra of several planets at once should give the same fmout and spectra as extracting them one
+    at a time
+    """
+    ncubes, nl = 4, 2
+    dataset, input_psfs, psfs_wvs = _make_spec_dataset(ncubes, nl)
+    numbasis = np.array([1, 3])
+    seps, pas = [10., 13.], [40., 200.]
+
+    planets_fmout = _run_extract_spec(dataset, input_psfs, psfs_wvs, numbasis, seps, pas)
+    assert planets_fmout.shape == (2, 2, ncubes * nl, ncubes * nl + 1, 36)
+    planets_spec, planets_fm = es.invert_spect_fmodel(planets_fmout, dataset, method="leastsq")
+    assert planets_spec.shape == (2, 2, nl)
+    for i, (sep, pa) in enumerate(zip(seps, pas)):
+        fmout = _run_extract_spec(dataset, input_psfs, psfs_wvs, numbasis, sep, pa)
+        assert np.max(np.abs(fmout)) > 0
+        np.testing.assert_allclose(planets_fmout[i], fmout, rtol=1e-10, atol=1e-12)
+        spec, fm_matrix = es.invert_spect_fmodel(fmout, dataset, method="leastsq")
+        np.testing.assert_allclose(planets_spec[i], spec, rtol=1e-8)
+        np.testing.assert_allclose(planets_fm[i], fm_matrix, rtol=1e-10, atol=1e-12)
+
+
+def test_multi_planet_straddling_stamp():
+    """
+    A planet whose stamp straddles two sectors can't be forward modelled: it should be reported, and not change the
+    fmout of the other planets
+    """
+    dataset, input_psfs, psfs_wvs = _make_spec_dataset()
+    numbasis = np.array([1, 3])
+    # with 2 subsections, the stamp of the planet at pa=90 is cut in two in every frame
+    with pytest.warns(RuntimeWarning, match="planet 1 .* never inside a single sector"):
+        planets_fmout = _run_extract_spec(dataset, input_psfs, psfs_wvs, numbasis, [10., 13.], [40., 90.],
+                                          subsections=2)
+    assert np.all(planets_fmout[1] == 0)
+    fmout = _run_extract_spec(dataset, input_psfs, psfs_wvs, numbasis, 10., 40., subsections=2)
+    assert np.max(np.abs(fmout)) > 0
+    np.testing.assert_allclose(planets_fmout[0], fmout, rtol=1e-10, atol=1e-12)
+
+
+def test_coadd_spectra():
+    """
+    Coadding the spectral dimension of fmout while forward modelling should give the same spectra as the full fmout,
+    and the stacked inversion should match the inversion of each KL mode cutoff
+    """
+    ncubes, nl = 3, 3
+    dataset, input_psfs, psfs_wvs = _make_spec_dataset(ncubes, nl, seed=1)
+    numbasis = np.array([1, 2, 4])
+
+    fmout = _run_extract_spec(dataset, input_psfs, psfs_wvs, numbasis, 11., 70.)
+    coadded_fmout = _run_extract_spec(dataset, input_psfs, psfs_wvs, numbasis, 11., 70., coadd_spectra=True)
+    assert coadded_fmout.shape == (3, ncubes * nl, nl + 1, 36)
+    np.testing.assert_array_equal(coadded_fmout[:, :, -1], fmout[:, :, -1])
+
+    for method in ["JB", "LP", "leastsq"]:
+        spec, fm_matrix = es.invert_spect_fmodel(fmout, dataset, method=method)
+        assert spec.shape == (3, nl)
+        assert fm_matrix.shape == (3, nl * 36, nl)
+        assert np.all(np.isfinite(spec))
+        coadded_spec, coadded_fm_matrix = es.invert_spect_fmodel(coadded_fmout, dataset, method=method)
+        np.testing.assert_allclose(coadded_spec, spec, rtol=1e-8, atol=1e-12)
+        np.testing.assert_allclose(coadded_fm_matrix, fm_matrix, rtol=1e-10, atol=1e-12)
+        for k in range(len(numbasis)):
+            spec_k, fm_matrix_k = es.invert_spect_fmodel(fmout[k:k+1], dataset, method=method)
+            np.testing.assert_allclose(spec_k[0], spec[k], rtol=1e-8, atol=1e-12)
+            np.testing.assert_array_equal(fm_matrix_k[0], fm_matrix[k])
+
+
+def _looped_invert_spect_fmodel(fmout, dataset, method):
+    """
+    Reference implementation of invert_spect_fmodel, inverting each planet and KL mode cutoff one at a time
+    """
+    if np.ndim(fmout) == 5:
+        planets_spec, planets_fm = zip(*[_looped_invert_spect_fmodel(planet_fmout, dataset, method)
+                                         for planet_fmout in fmout])
+        return np.array(planets_spec), np.array(planets_fm)
+
+    N_frames = fmout.shape[2] - 1
+    N_cubes = np.size(np.unique(dataset.filenums))
+    nl = N_frames // N_cubes
+    stamp_N_pix = fmout.shape[-1]
+    selec = np.tile(np.identity(nl), (N_frames // nl, 1))
+
+    estim_spec = np.zeros((fmout.shape[0], nl))
+    fm_coadd_mat = np.zeros((fmout.shape[0], nl * stamp_N_pix, nl))
+    for ii in range(fmout.shape[0]):
+        klipped_coadd = np.sum([fmout[ii, k*nl:(k+1)*nl, -1, :] for k in range(N_cubes)], axis=0)
+        FM_noSpec = np.rollaxis(fmout[ii, :, :N_frames, :], 2, 1)
+        fm_noSpec_coadd = np.dot(selec.T, np.dot(np.rollaxis(FM_noSpec, 1, 0), selec))
+        fm_coadd_mat[ii] = fm_noSpec_coadd.reshape(nl * stamp_N_pix, nl)
+        if method == "JB":
+            estim_spec[ii] = np.dot(np.linalg.pinv(fm_coadd_mat[ii]), klipped_coadd.ravel())
+        elif method == "LP":
+            fm_planet = np.rollaxis(np.rollaxis(fm_noSpec_coadd.reshape(nl, stamp_N_pix, nl), 2, 0), 2, 1)
+            A = np.zeros((nl, nl))
+            b = np.zeros(nl)
+            for q in range(nl):
+                A[q, :] = np.dot(fm_planet[q, :].T, fm_planet[q, :])[q, :]
+                b[q] = np.dot(fm_planet[q, :].T, klipped_coadd[q])[q]
+            estim_spec[ii] = np.dot(np.linalg.inv(A), b)
+        elif method == "leastsq":
+            estim_spec[ii] = scipy.linalg.lstsq(fm_coadd_mat[ii], klipped_coadd.ravel())[0]
+    return estim_spec, fm_coadd_mat
+
+
+def test_batched_inversion():
+    """
+    The batched inversion of all the planets and KL mode cutoffs should match inverting them one at a time
+    """
+    ncubes, nl, npix = 3, 4, 25
+    rng = np.random.RandomState(2)
+    dataset = types.SimpleNamespace(filenums=np.repeat(np.arange(ncubes), nl))
+    fmout = rng.normal(size=(2, 3, ncubes * nl, ncubes * nl + 1, npix))
+
+    for method in ["JB", "LP", "leastsq"]:
+        spec, fm_matrix = es.invert_spect_fmodel(fmout, dataset, method=method)
+        looped_spec, looped_fm_matrix = _looped_invert_spect_fmodel(fmout, dataset, method)
+        assert spec.shape == (2, 3, nl)
+        np.testing.assert_allclose(spec, looped_spec, rtol=1e-8, atol=1e-12)
+        np.testing.assert_allclose(fm_matrix, looped_fm_matrix, rtol=1e-10, atol=1e-12)
+
+        scaled_spec, scaled_fm_matrix = es.invert_spect_fmodel(fmout[0], dataset, method=method, units="scaled",
+                                                               scaling_factor=2.)
+        np.testing.assert_allclose(scaled_spec, 2. * looped_spec[0], rtol=1e-8, atol=1e-12)
+        np.testing.assert_allclose(scaled_fm_matrix, looped_fm_matrix[0] / 2., rtol=1e-10, atol=1e-12)
+
+
+def test_planet_sectors_only():
+    """
+    Running KLIP-FM only on the sectors that contain the stamps of the planets should give the same fmout
+    """
+    dataset, input_psfs, psfs_wvs = _make_spec_dataset()
+    numbasis = np.array([1, 3])
+    seps, pas = [10., 13.], [40., 200.]
+
+    fmout = _run_extract_spec(dataset, input_psfs, psfs_wvs, numbasis, seps, pas, subsections=6)
+    roi_fmout = _run_extract_spec(dataset, input_psfs, psfs_wvs, numbasis, seps, pas, subsections=6,
+                                  planet_sectors_only=True)
+    assert np.max(np.abs(fmout)) > 0
+    np.testing.assert_allclose(roi_fmout, fmout, rtol=1e-10, atol=1e-12)
+
+
 if __name__ == "__main__":
     test_spectral_extract()
                                                 
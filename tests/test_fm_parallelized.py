@@ -0,0 +1,245 @@
+import os
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndimage
+
+import pyklip.fm as fm
+import pyklip.fmlib.fmpsf as fmpsf
+import pyklip.fmlib.nofm as nofm
+
+
+class PickleCountingFM(nofm.NoFM):
+    """
+    NoFM that counts how many times it has been pickled by the main process. Defined at the top level so the worker
+    processes can unpickle it.
+    """
+    num_pickled = 0
+
+    def __getstate__(self):
+        PickleCountingFM.num_pickled += 1
+        return self.__dict__
+
+
+def _make_dataset(nframes=8, size=41, seed=0):
+    """
+    Makes a small ADI sequence of a PSF with speckles and noise, centered on the middle of the images
+    """
+    rng = np.random.RandomState(seed)
+    y, x = np.indices((size, size))
+    center = (size - 1) / 2.
+    r = np.sqrt((x - center)**2 + (y - center)**2)
+    speckles = np.exp(-r / 6.) * (1 + 0.2 * rng.normal(size=(size, size)))
+    imgs = np.array([speckles * (1 + 0.05 * rng.normal()) + 0.01 * rng.normal(size=(size, size))
+                     for _ in range(nframes)])
+    centers = np.zeros((nframes, 2)) + center
+    parangs = np.linspace(0, 60, nframes)
+    wvs = np.ones(nframes)
+    return imgs, centers, parangs, wvs
+
+
+def test_fm_class_shipped_once(monkeypatch):
+    """
+    The FM class should be set up once per worker by the pool initializer instead of being pickled with every task,
+    and the KLIP subtraction should match the single process (debug) code path
+    """
+    imgs, centers, parangs, wvs = _make_dataset()
+    numbasis = np.array([1, 3])
+    fm_class = PickleCountingFM(imgs.shape, numbasis)
+    PickleCountingFM.num_pickled = 0
+
+    sub_imgs, _, _, _, _ = fm.klip_parallelized(imgs, centers, parangs, wvs, 3, fm_class, np.copy(centers), OWA=18,
+                                                 annuli=2, subsections=2, movement=1, numbasis=numbasis,
+                                                 numthreads=2, corr_smooth=0, mute_progression=True)
+    # 8 frames x 4 sectors = 32 tasks. At most each worker gets its own copy.
+    assert PickleCountingFM.num_pickled <= 2
+
+    monkeypatch.setattr(fm, "debug", True)
+    klipped, _, _, _, _ = fm.klip_parallelized(imgs, centers, parangs, wvs, 3, nofm.NoFM(imgs.shape, numbasis),
+                                               np.copy(centers), OWA=18, annuli=2, subsections=2, movement=1,
+                                               numbasis=numbasis, numthreads=2, corr_smooth=0, mute_progression=True)
+    assert np.sum(np.isfinite(klipped)) > 0
+    np.testing.assert_array_equal(np.isfinite(sub_imgs), np.isfinite(klipped))
+    finite = np.isfinite(klipped)
+    assert np.allclose(sub_imgs[finite], klipped[finite], rtol=1e-5, atol=1e-6)
+
+
+def test_batched_fm_matches_perfile():
+    """
+    Processing the science images of a sector in batches (sharing the reference models) should give the same KLIP and
+    FM outputs as processing them one at a time, also when images in a batch share the same PA
+    """
+    imgs, centers, parangs, wvs = _make_dataset(nframes=10)
+    # two images at each PA, so they also share their sector covariance in a batch
+    parangs = np.repeat(np.linspace(0, 60, 5), 2)
+    numbasis = np.array([1, 3])
+    y, x = np.indices((9, 9)) - 4
+    input_psfs = np.exp(-(x**2 + y**2) / 3.)[None, :, :]
+
+    outputs = []
+    for batch_size in [1, 10]:
+        fm_class = fmpsf.FMPlanetPSF(imgs.shape, numbasis, 10, 45, 1e-2, input_psfs, np.array([1.]))
+        outputs.append(fm.klip_parallelized(imgs, centers, parangs, wvs, 3, fm_class, np.copy(centers), OWA=18,
+                                            annuli=2, subsections=2, movement=1, numbasis=numbasis, numthreads=2,
+                                            corr_smooth=0, mute_progression=True, batch_size=batch_size))
+
+    (klipped1, fmout1, perturbmag1, _, _), (klipped10, fmout10, perturbmag10, _, _) = outputs
+    np.testing.assert_allclose(klipped10, klipped1, rtol=1e-5, atol=1e-7)
+    assert np.nanmax(np.abs(fmout1)) > 0
+    np.testing.assert_allclose(fmout10, fmout1, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(perturbmag10, perturbmag1, rtol=1e-5, atol=1e-7)
+
+
+def test_klbasis_reuse(tmpdir, monkeypatch):
+    """
+    FM with the KL basis saved by a previous run (with another FM class) should give the same outputs as computing the
+    KL basis again, without any eigendecomposition, and the KL basis should not be reused with other KLIP parameters
+    or another RDI library. The workers save the KL basis in files rather than sending it to the main process.
+    """
+    imgs, centers, parangs, wvs = _make_dataset()
+    numbasis = np.array([1, 3])
+    y, x = np.indices((9, 9)) - 4
+    input_psfs = np.exp(-(x**2 + y**2) / 3.)[None, :, :]
+    klbasis_dirname = os.path.join(str(tmpdir), "dataset.klbasis")
+    klip_kwargs = dict(OWA=18, annuli=2, subsections=2, movement=1, numbasis=numbasis, numthreads=2, corr_smooth=0,
+                       mute_progression=True)
+
+    def no_manager(*args, **kwargs):
+        raise AssertionError("the KL basis should not go through a multiprocessing manager")
+    with monkeypatch.context() as patch:
+        patch.setattr(fm.mp, "Manager", no_manager)
+        fm.klip_parallelized(imgs, centers, parangs, wvs, 3, nofm.NoFM(imgs.shape, numbasis), np.copy(centers),
+                             save_klbasis=klbasis_dirname, **klip_kwargs)
+    assert os.path.isdir(klbasis_dirname)
+    # the shards of the tasks have been packed and removed
+    assert not os.path.exists(os.path.join(klbasis_dirname, "shards"))
+    packed_klbasis = fm._load_packed_kl_basis(klbasis_dirname)
+    assert len(packed_klbasis["klmodes_dict"]) > 0
+    assert list(packed_klbasis["klmodes_dict"].keys()) == sorted(packed_klbasis["klmodes_dict"].keys())
+
+    fm_class = fmpsf.FMPlanetPSF(imgs.shape, numbasis, 10, 45, 1e-2, input_psfs, np.array([1.]))
+    klipped, fmout, perturbmag, _, _ = fm.klip_parallelized(imgs, centers, parangs, wvs, 3, fm_class,
+                                                            np.copy(centers), **klip_kwargs)
+
+    def no_klip_math(*args, **kwargs):
+        raise AssertionError("the KL basis should be reused")
+    monkeypatch.setattr(fm, "debug", True)
+    monkeypatch.setattr(fm, "klip_math", no_klip_math)
+    fm_class = fmpsf.FMPlanetPSF(imgs.shape, numbasis, 10, 45, 1e-2, input_psfs, np.array([1.]))
+    reused_klipped, reused_fmout, reused_perturbmag, _, _ = fm.klip_parallelized(imgs, centers, parangs, wvs, 3,
+                                                                                 fm_class, np.copy(centers),
+                                                                                 klbasis=klbasis_dirname,
+                                                                                 **klip_kwargs)
+    assert np.nanmax(np.abs(fmout)) > 0
+    np.testing.assert_allclose(reused_klipped, klipped, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(reused_fmout, fmout, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(reused_perturbmag, perturbmag, rtol=1e-5, atol=1e-7)
+
+    psf_library = np.random.RandomState(3).normal(size=(5,) + imgs.shape[1:])
+    with pytest.raises(ValueError, match="psf_library"):
+        fm.klip_parallelized(imgs, centers, parangs, wvs, 3, nofm.NoFM(imgs.shape, numbasis), np.copy(centers),
+                             klbasis=klbasis_dirname, psf_library=psf_library, psf_library_good=np.arange(5),
+                             psf_library_corr=np.zeros((imgs.shape[0], 5)), **klip_kwargs)
+
+    # same geometry but different pixels (e.g. an injected planet) should not reuse the KL basis
+    modified_imgs = np.copy(imgs)
+    modified_imgs[:, 20:23, 20:23] += 1.
+    with pytest.raises(ValueError, match="imgs"):
+        fm.klip_parallelized(modified_imgs, centers, parangs, wvs, 3, nofm.NoFM(imgs.shape, numbasis),
+                             np.copy(centers), klbasis=klbasis_dirname, **klip_kwargs)
+
+    klip_kwargs["numbasis"] = np.array([1, 2])
+    with pytest.raises(ValueError, match="numbasis"):
+        fm.klip_parallelized(imgs, centers, parangs, wvs, 3, nofm.NoFM(imgs.shape, klip_kwargs["numbasis"]),
+                             np.copy(centers), klbasis=klbasis_dirname, **klip_kwargs)
+
+
+def test_planet_sectors_only():
+    """
+    A sector should be queued if any of its pixels is in a region of interest, and FM restricted to the sectors of the
+    planet should give the same forward model around the planet as FM over the whole image
+    """
+    dims = [81, 81]
+    center = [40., 40.]
+    rng = np.random.RandomState(2)
+    dphi = 2 * np.pi / 6
+    sectors = [((r0, r0 + 8), (dphi * i - np.pi, dphi * (i + 1) - np.pi)) for r0 in [4, 12, 20, 28] for i in range(6)]
+    for flipx in [True, False]:
+        for sep, pa, radius in zip(rng.uniform(5, 35, 20), rng.uniform(0, 360, 20), rng.uniform(1, 6, 20)):
+            # planet position in the aligned images at a PA of 0 (see FMPlanetPSF.generate_models)
+            sign = 1. if flipx else -1.
+            x_planet = center[0] + sep * np.cos(np.radians(90. - sign * pa))
+            y_planet = center[1] + sep * np.sin(np.radians(90. - sign * pa))
+            for (radstart, radend), (phistart, phiend) in sectors:
+                y, x = fm._get_section_indicies(dims, center, radstart, radend, phistart, phiend, 0, 0, (0, None),
+                                                flatten=False)
+                dist = np.min(np.sqrt((x - x_planet)**2 + (y - y_planet)**2))
+                queued = fm._sector_in_regions(radstart, radend, phistart, phiend, 0, [(sep, pa, radius)], flipx)
+                if dist <= radius:
+                    assert queued
+                if dist > radius + 2:
+                    assert not queued
+
+    imgs, centers, parangs, wvs = _make_dataset()
+    numbasis = np.array([1, 3])
+    y, x = np.indices((9, 9)) - 4
+    input_psfs = np.exp(-(x**2 + y**2) / 3.)[None, :, :]
+    outputs = []
+    for planet_sectors_only in [False, True]:
+        fm_class = fmpsf.FMPlanetPSF(imgs.shape, numbasis, 12, 45, 1e-2, input_psfs, np.array([1.]),
+                                     planet_sectors_only=planet_sectors_only)
+        outputs.append(fm.klip_parallelized(imgs, centers, parangs, wvs, 3, fm_class, np.copy(centers), OWA=18,
+                                            annuli=2, subsections=4, movement=1, numbasis=numbasis, numthreads=2,
+                                            corr_smooth=0, mute_progression=True))
+    (klipped, fmout, _, _, _), (roi_klipped, roi_fmout, _, _, _) = outputs
+
+    # fewer sectors were processed
+    assert np.sum(np.isfinite(roi_klipped)) < np.sum(np.isfinite(klipped)) / 2
+    # same forward model around the planet
+    y_planet, x_planet = np.unravel_index(np.argmax(np.sum(fmout, axis=(0, 1))), fmout.shape[2:])
+    y, x = np.indices(fmout.shape[2:])
+    near_planet = (x - x_planet)**2 + (y - y_planet)**2 <= 4**2
+    assert np.max(np.abs(fmout[:, :, near_planet])) > 0
+    np.testing.assert_allclose(roi_fmout[:, :, near_planet], fmout[:, :, near_planet], rtol=1e-5, atol=1e-7)
+
+
+def test_save_rotated_section_cache():
+    """
+    Derotating a sector with the cached rotation maps should match cubic spline interpolation with
+    ndimage.map_coordinates, and reuse the map for the same geometry
+    """
+    rng = np.random.RandomState(3)
+    dims = [61, 67]
+    center = [30.3, 31.7]
+    angle, radstart, radend, phistart, phiend, padding, IOWA = 33., 8, 20, -1, 1, 2, (3, 30)
+    section_ind = fm._get_section_indicies(dims, center, radstart, radend, phistart, phiend, padding, angle, IOWA)
+    sector = rng.normal(size=np.size(section_ind))
+
+    fm._rotation_maps.clear()
+    output_img = np.zeros(dims[0] * dims[1]) * np.nan
+    numstacked = np.zeros(dims[0] * dims[1], dtype=int)
+    fm._save_rotated_section(dims, sector, section_ind, output_img, numstacked, angle, radstart, radend, phistart,
+                             phiend, padding, IOWA, center, flipx=True)
+    assert len(fm._rotation_maps) == 1
+    fm._save_rotated_section(dims, sector, section_ind, output_img, None, angle, radstart, radend, phistart,
+                             phiend, padding, IOWA, center, flipx=True)
+    assert len(fm._rotation_maps) == 1
+
+    # reference: interpolate the input image at the rotated (and flipped) coordinates of the output sector
+    input_img = np.zeros(dims[0] * dims[1])
+    input_img[section_ind] = sector
+    input_img.shape = dims
+    rot_pix = fm._get_section_indicies(dims, center, radstart, radend, phistart, phiend, padding, 0, IOWA,
+                                       flatten=False, flipx=True)
+    y, x = rot_pix[0].astype(float), center[0] - (rot_pix[1] - center[0])
+    angle_rad = np.radians(angle)
+    xp = (x - center[0]) * np.cos(angle_rad) + (y - center[1]) * np.sin(angle_rad) + center[0]
+    yp = -(x - center[0]) * np.sin(angle_rad) + (y - center[1]) * np.cos(angle_rad) + center[1]
+    expected = ndimage.map_coordinates(input_img, [yp, xp], cval=np.nan)
+
+    output_img.shape = dims
+    numstacked.shape = dims
+    valid = np.isfinite(expected)
+    assert np.sum(valid) > 100
+    np.testing.assert_allclose(output_img[rot_pix][valid], 2 * expected[valid], rtol=1e-12, atol=1e-12)
+    np.testing.assert_array_equal(numstacked[rot_pix], valid.astype(int))
@@ -0,0 +1,93 @@
+import numpy as np
+
+import pyklip.fm as fm
+
+
+def _klip_basis(nref=20, npix=300, numbasis=np.array([1, 3, 6]), seed=0):
+    """
+    KL basis of random reference images
+    """
+    rng = np.random.RandomState(seed)
+    refs = rng.normal(size=(nref, npix)) * np.linspace(1, 3, nref)[:, None]
+    sci = rng.normal(size=npix)
+    klipped, original_KL, evals, evecs = fm.klip_math(sci, refs, numbasis)
+    return rng, refs, original_KL, evals, evecs
+
+
+def test_perturb_specIncluded_batch():
+    """
+    The batched perturbed KL modes should match the per reference perturbations of pertrurb_nospec() summed over the
+    references, and the covariance perturbation for each model
+    """
+    rng, refs, original_KL, evals, evecs = _klip_basis()
+    models = rng.normal(size=(5,) + refs.shape) * 0.1
+    models[0, 2, :4] = np.nan
+
+    delta_KL, covar_perturb = fm.perturb_specIncluded_batch(evals, evecs, original_KL, refs, np.copy(models),
+                                                            return_perturb_covar=True)
+    assert delta_KL.shape == (5,) + original_KL.shape
+    refs_mean_sub = refs - np.mean(refs, axis=1)[:, None]
+    for models_ref, this_delta_KL, this_covar in zip(models, delta_KL, covar_perturb):
+        models_ref = np.nan_to_num(models_ref)
+        delta_KL_nospec = fm.pertrurb_nospec(evals, evecs, original_KL, refs, np.copy(models_ref))
+        np.testing.assert_allclose(this_delta_KL, np.sum(delta_KL_nospec, axis=1), rtol=1e-10, atol=1e-12)
+        expected_covar = models_ref.dot(refs_mean_sub.T) + refs_mean_sub.dot(models_ref.T)
+        np.testing.assert_allclose(this_covar, expected_covar, rtol=1e-10, atol=1e-12)
+
+    # single model version
+    single = fm.perturb_specIncluded(evals, evecs, original_KL, refs, np.copy(models[1]))
+    np.testing.assert_allclose(single, delta_KL[1], rtol=1e-12, atol=1e-14)
+
+
+def test_calculate_fm_batch():
+    """
+    The batched FM should match calculate_fm() for each image and each KL mode cutoff
+    """
+    rng, refs, original_KL, evals, evecs = _klip_basis()
+    numbasis = np.array([1, 3, 6])
+    sci = rng.normal(size=(4, refs.shape[1]))
+    sci[1, 10] = np.nan
+    model_sci = rng.normal(size=(4, refs.shape[1]))
+    delta_KL = fm.perturb_specIncluded_batch(evals, evecs, original_KL, refs,
+                                             rng.normal(size=(4,) + refs.shape) * 0.1)
+
+    fm_psf, klipped_oversub, klipped_selfsub = fm.calculate_fm_batch(delta_KL, original_KL, numbasis, sci,
+                                                                     np.copy(model_sci))
+    assert fm_psf.shape == (4, 3, refs.shape[1])
+    for i in range(4):
+        outputs = fm.calculate_fm(delta_KL[i], original_KL, numbasis, sci[i], np.copy(model_sci[i]))
+        for output, batch_output in zip(outputs, [fm_psf[i], klipped_oversub[i], klipped_selfsub[i]]):
+            np.testing.assert_allclose(batch_output, output, rtol=1e-10, atol=1e-12)
+        # the single KL mode code is a separate implementation that expects a truncated basis
+        for j, kl in enumerate(numbasis):
+            outputs = fm.calculate_fm_singleNumbasis(delta_KL[i, :kl], original_KL[:kl], np.array([kl]), sci[i],
+                                                     np.copy(model_sci[i]))
+            np.testing.assert_allclose(fm_psf[i, j], np.ravel(outputs[0]), rtol=1e-10, atol=1e-12)
+
+
+def test_linear_fm_operator():
+    """
+    The precomputed linear FM operator should give the same FM as perturbing the KL modes and forward modelling, with
+    and without the perturbation of the KL modes
+    """
+    rng, refs, original_KL, evals, evecs = _klip_basis()
+    numbasis = np.array([1, 3, 6])
+    sci = rng.normal(size=refs.shape[1])
+    sci[3] = np.nan
+    model_sci = rng.normal(size=(4, refs.shape[1])) * 0.1
+    models_ref = rng.normal(size=(4,) + refs.shape) * 0.1
+    models_ref[1, 0, :2] = np.nan
+
+    operator = fm.linear_fm_operator(evals, evecs, original_KL, refs, numbasis, sci)
+    fm_psf = fm.apply_linear_fm_operator(operator, np.copy(model_sci), np.copy(models_ref))
+
+    delta_KL = fm.perturb_specIncluded_batch(evals, evecs, original_KL, refs, np.copy(models_ref))
+    expected_fm, _, _ = fm.calculate_fm_batch(delta_KL, original_KL, numbasis, np.tile(sci, (4, 1)),
+                                              np.copy(model_sci))
+    np.testing.assert_allclose(fm_psf, expected_fm, rtol=1e-10, atol=1e-12)
+
+    # no perturbation of the KL modes
+    fm_psf = fm.apply_linear_fm_operator(operator, np.copy(model_sci))
+    expected_fm, _, _ = fm.calculate_fm_batch(np.zeros_like(delta_KL), original_KL, numbasis, np.tile(sci, (4, 1)),
+                                              np.copy(model_sci))
+    np.testing.assert_allclose(fm_psf, expected_fm, rtol=1e-10, atol=1e-12)
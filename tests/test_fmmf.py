@@ -114,6 +114,63 @@ def test_fmmf():
         assert mf_snr_planet < snr_planet
 
 
+def _fmmf_map(fmout):
+    """
+    Combines the terms of the matched filter like MatchedFilter.save_fmout()
+    """
+    fmout = np.array(fmout[:, 0, 0], dtype=float)
+    fmout[np.where(fmout == 0)] = np.nan
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.nansum(fmout[0] / fmout[2], axis=0) / np.sqrt(np.nansum(fmout[1] / fmout[2], axis=0))
+
+
+def test_fast_fmmf():
+    """
+    Compare the SNR maps of the approximate fast FMMF and of the exact FMMF on a small simulated ADI sequence with a
+    planet. fast_fm_step=1 should give the exact FMMF and coarser grids should give close maps.
+    """
+    nframes, size = 8, 41
+    rng = np.random.RandomState(0)
+    y, x = np.indices((size, size))
+    center = (size - 1) / 2.
+    r = np.sqrt((x - center)**2 + (y - center)**2)
+    speckles = np.exp(-r / 6.) * (1 + 0.2 * rng.normal(size=(size, size)))
+    parangs = np.linspace(0, 60, nframes)
+    imgs = []
+    for pa in parangs:
+        planet_x = center - 12 * np.sin(np.radians(30 + pa))
+        planet_y = center + 12 * np.cos(np.radians(30 + pa))
+        planet = 0.05 * np.exp(-((x - planet_x)**2 + (y - planet_y)**2) / 3.)
+        imgs.append(speckles * (1 + 0.05 * rng.normal()) + 0.01 * rng.normal(size=(size, size)) + planet)
+    imgs = np.array(imgs)
+    centers = np.zeros((nframes, 2)) + center
+    wvs = np.ones(nframes)
+    psf_y, psf_x = np.indices((9, 9)) - 4
+    psfs = np.exp(-(psf_x**2 + psf_y**2) / 3.)[None, :, :]
+    numbasis = np.array([3])
+
+    fmmf_maps = {}
+    for fast_fm_step in [None, 1, 2]:
+        fm_class = mf.MatchedFilter(imgs.shape, numbasis, psfs, np.array([1.]), [np.ones(nframes)],
+                                    ref_center=centers[0], flipx=True, datatype="double", fast_fm_step=fast_fm_step)
+        _, fmout, _, _, _ = fm.klip_parallelized(imgs, centers, parangs, wvs, 3, fm_class, np.copy(centers), OWA=18,
+                                                 annuli=2, subsections=2, movement=1, numbasis=numbasis,
+                                                 numthreads=1, corr_smooth=0, mute_progression=True,
+                                                 aligned_center=centers[0])
+        fmmf_maps[fast_fm_step] = _fmmf_map(fmout)
+
+    exact_map = fmmf_maps[None]
+    np.testing.assert_array_equal(np.isnan(fmmf_maps[1]), np.isnan(exact_map))
+    finite = np.isfinite(exact_map)
+    np.testing.assert_allclose(fmmf_maps[1][finite], exact_map[finite], rtol=1e-8, atol=1e-10)
+
+    # the planet is detected with almost the same SNR on the coarse grid, and the map is close everywhere
+    planet = np.unravel_index(np.nanargmax(np.where((r > 8) & (r < 16), exact_map, np.nan)), exact_map.shape)
+    assert exact_map[planet] > 5
+    assert np.abs(fmmf_maps[2][planet] - exact_map[planet]) < 0.05 * exact_map[planet]
+    assert np.nanmedian(np.abs(fmmf_maps[2] - exact_map)) < 0.05 * np.nanstd(exact_map)
+
+
 if __name__ == "__main__":
     test_fmmf()
 
@@ -0,0 +1,96 @@
+import numpy as np
+
+import pyklip.fm as fm
+import pyklip.fmlib.fmpsf as fmpsf
+
+
+class CountingPSF(object):
+    """
+    Wraps a PSF interpolator to count how many stamps are evaluated
+    """
+    def __init__(self, psf_func):
+        self.psf_func = psf_func
+        self.num_calls = 0
+
+    def __call__(self, x, y):
+        self.num_calls += 1
+        return self.psf_func(x, y)
+
+
+def _make_fm_class(stamp_quantization=None):
+    y, x = np.indices((9, 9)) - 4
+    input_psfs = np.array([np.exp(-(x**2 + y**2) / 3.), np.exp(-(x**2 + y**2) / 4.)])
+    input_wvs = np.array([1., 1.2])
+    fm_class = fmpsf.FMPlanetPSF((20, 81, 81), np.array([1]), 20, 45, 1e-2, input_psfs, input_wvs,
+                                 spectrallib=[np.ones(2)], spectrallib_units="contrast",
+                                 stamp_quantization=stamp_quantization)
+    fm_class.psfs_func_list = [CountingPSF(psf_func) for psf_func in fm_class.psfs_func_list]
+    return fm_class
+
+
+def test_generate_models():
+    """
+    The models should be the PSF interpolator evaluated at the position of the planet in each image, for the pixels
+    of the sector, and the stamps should be reused between sectors
+    """
+    fm_class = _make_fm_class()
+    shape = (81, 81)
+    center = [40.3, 39.6]
+    pas = np.linspace(0, 60, 20)
+    wvs = np.tile([1., 1.2], 10)
+    ref_wv = 1.2
+    is_rdi = np.zeros(20)
+    is_rdi[3] = 1
+
+    all_models = []
+    for phistart in np.linspace(0, 2 * np.pi, 4, endpoint=False):
+        section_ind = fm._get_section_indicies(shape, center, 12, 28, phistart, phistart + np.pi / 2, 0, 10, (5, 35))
+        models = fm_class.generate_models(shape, section_ind, pas, wvs, 12, 28, phistart, phistart + np.pi / 2, 0,
+                                          center, 10., ref_wv, True, is_rdi)
+        all_models.append(models)
+
+        y, x = np.unravel_index(np.ravel(section_ind), shape)
+        for i, (pa, wv) in enumerate(zip(pas, wvs)):
+            scale = ref_wv / wv
+            psf_centx = scale * 20 * np.cos(np.radians(90. - 45 - pa))
+            psf_centy = scale * 20 * np.sin(np.radians(90. - 45 - pa))
+            stamp_x = x - int(round(psf_centx + center[0])) + 4
+            stamp_y = y - int(round(psf_centy + center[1])) + 4
+            in_stamp = (stamp_x >= 0) & (stamp_x < 9) & (stamp_y >= 0) & (stamp_y < 9)
+
+            expected = np.zeros(x.size)
+            if not is_rdi[i]:
+                psf_func = fm_class.psfs_func_list[int(wv > 1)].psf_func
+                expected[in_stamp] = [psf_func((x_pix - center[0] - psf_centx) / scale,
+                                               (y_pix - center[1] - psf_centy) / scale)[0, 0]
+                                      for x_pix, y_pix in zip(x[in_stamp], y[in_stamp])]
+            np.testing.assert_allclose(models[i], expected, rtol=1e-10, atol=1e-12)
+
+    assert np.max(np.concatenate(all_models, axis=1)) > 0.5
+    # one stamp per image that is not RDI, for all the sectors
+    assert sum(psf_func.num_calls for psf_func in fm_class.psfs_func_list) == 19
+
+    # quantized offsets give close models with fewer stamps: pairs of images 0.05 degree apart at the same
+    # wavelength have stamps less than 0.02 pixel apart, which round to the same quarter of a pixel
+    stamp_quantization = 0.25
+    pas = np.repeat(np.linspace(0, 60, 10), 2) + np.tile([0, 0.05], 10)
+    wvs = np.tile([1., 1., 1.2, 1.2], 5)
+    fm_class = _make_fm_class()
+    quantized_fm_class = _make_fm_class(stamp_quantization=stamp_quantization)
+    section_ind = fm._get_section_indicies(shape, center, 12, 28, 0, 2 * np.pi, 0, 10, (5, 35))
+    models = fm_class.generate_models(shape, section_ind, pas, wvs, 12, 28, 0, 2 * np.pi, 0, center, 10., ref_wv,
+                                      True, is_rdi)
+    quantized_models = quantized_fm_class.generate_models(shape, section_ind, pas, wvs, 12, 28, 0, 2 * np.pi, 0,
+                                                          center, 10., ref_wv, True, is_rdi)
+    num_calls = sum(psf_func.num_calls for psf_func in fm_class.psfs_func_list)
+    quantized_num_calls = sum(psf_func.num_calls for psf_func in quantized_fm_class.psfs_func_list)
+    assert num_calls == 19
+    assert quantized_num_calls < num_calls
+    # rounding moves the stamp by at most half a step along each axis, so the models differ by at most the largest
+    # gradient of the PSFs (which are only stretched, scale >= 1) times stamp_quantization / sqrt(2)
+    grid = np.arange(-4, 4.01, 0.05)
+    max_gradient = 0
+    for psf_func in fm_class.psfs_func_list:
+        gradients = np.gradient(psf_func.psf_func(grid, grid), grid, grid)
+        max_gradient = max(max_gradient, np.max(np.hypot(*gradients)))
+    assert np.max(np.abs(quantized_models - models)) <= max_gradient * stamp_quantization / np.sqrt(2)
@@ -96,4 +96,36 @@ class empca_functions_TestCase(unittest.TestCase):
 
     def test_set_pixel_weights(self):
         # TODO: write test for this function after more weighting schemes are implemented
-        pass
\ No newline at end of file
+        pass
+
+    def test_weighted_empca_chunked(self):
+        # chunked and threaded normal equations should give the same model as a single block
+        rng = np.random.RandomState(0)
+        data = np.dot(rng.normal(size=(20, 3)), rng.normal(size=(3, 500))) + 0.01 * rng.normal(size=(20, 500))
+        weights = rng.uniform(0.5, 2., size=data.shape)
+        model = empca.weighted_empca(data, weights=weights, niter=15, nvec=3)
+        # a rank 3 model of rank 3 data (plus small noise) should fit well
+        assert np.std(data - model) < 0.05
+        with mock.patch.object(empca, '_chunk_bytes', 8 * 9 * 64):
+            assert len(empca._pixel_chunks(500, 3, 2)) > 2
+            model_chunked = empca.weighted_empca(data, weights=weights, niter=15, nvec=3, maxcpus=2)
+        assert np.allclose(model, model_chunked)
+
+    def test_weighted_empca_warm_start(self):
+        # starting from the rank k basis and stopping on chi squared convergence should fit as well as a cold start
+        rng = np.random.RandomState(1)
+        data = np.dot(rng.normal(size=(20, 4)), rng.normal(size=(4, 300))) + 0.01 * rng.normal(size=(20, 300))
+        weights = rng.uniform(0.5, 2., size=data.shape)
+        model_rank3 = empca.weighted_empca(data, weights=weights, niter=15, nvec=3)
+        init_vecs = empca.model_basis(model_rank3, 3)
+        assert init_vecs.shape == (3, 300)
+        assert np.allclose(np.dot(init_vecs, init_vecs.T), np.identity(3))
+
+        model_cold = empca.weighted_empca(data, weights=weights, niter=15, nvec=4)
+        model_warm = empca.weighted_empca(data, weights=weights, niter=15, nvec=4, init_vecs=init_vecs, tol=1e-6)
+        chisq_cold = empca.np_calc_chisq(data, np.identity(300), weights, model_cold)
+        chisq_warm = empca.np_calc_chisq(data, np.identity(300), weights, model_warm)
+        assert chisq_warm <= chisq_cold * 1.01
+
+        with pytest.raises(ValueError):
+            empca.weighted_empca(data, weights=weights, nvec=4, init_vecs=init_vecs[:, :10])
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pytest
+
+# nmf_imaging needs NonnegMFPy at import time
+pytest.importorskip("NonnegMFPy")
+import pyklip.nmf_imaging as nmf_imaging
+
+
+def _NMFbff_loop(trg, model, fracs):
+    """
+    Frame-by-frame reference implementation of the best fraction search
+    """
+    std_infos = np.zeros(fracs.shape)
+    for i, frac in enumerate(fracs):
+        data_slice = trg - model*frac
+        while 1:
+            if np.nansum(data_slice > np.nanmedian(data_slice) + 3*np.nanstd(data_slice)) == 0 or np.nansum(data_slice < np.nanmedian(data_slice) -10*np.nanstd(data_slice)) == 0:
+                break
+            data_slice[data_slice > np.nanmedian(data_slice) + 3*np.nanstd(data_slice)] = np.nan
+            data_slice[data_slice < np.nanmedian(data_slice) - 10*np.nanstd(data_slice)] = np.nan
+        std_infos[i] = np.nanstd(data_slice)
+    return std_infos
+
+
+def test_NMFbff_matches_loop():
+    """
+    The vectorized clipping should give the same clipped std and best fraction as the per-fraction loop
+    """
+    rng = np.random.RandomState(0)
+    model = np.abs(rng.normal(size=2000)) * 5
+    trg = 0.83 * model + rng.standard_t(2, size=2000)
+    trg[rng.randint(0, 2000, 20)] = np.nan
+    fracs = np.arange(0.60, 1.001, 0.001)
+
+    expected = _NMFbff_loop(trg, model, fracs)
+    std_infos = nmf_imaging._NMFbff_clipped_std(trg, model, fracs)
+    assert np.allclose(std_infos, expected, equal_nan=True)
+
+    best_frac = nmf_imaging.NMFbff(trg, model)
+    assert np.array_equal(best_frac, fracs[np.where(expected == np.nanmin(expected))])
+
+
+def test_NMFbff_golden():
+    """
+    The golden-section search should land near the minimum of a smooth residual curve
+    """
+    rng = np.random.RandomState(1)
+    model = np.abs(rng.normal(size=2000)) * 5
+    trg = 0.75 * model + rng.normal(size=2000)
+
+    best_frac = nmf_imaging.NMFbff(trg, model, method='golden')
+    assert best_frac.shape == (1,)
+    assert np.abs(best_frac[0] - 0.75) < 0.02
+
+    with pytest.raises(ValueError):
+        nmf_imaging.NMFbff(trg, model, method='brent')
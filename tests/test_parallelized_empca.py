@@ -66,6 +66,119 @@ class weighted_empca_section_TestCase(unittest.TestCase):
         assert mock_weighted_empca.call_args[1]['nvec'] == 2
         assert return_value
 
+    @mock.patch('pyklip.empca.weighted_empca')
+    @mock.patch('pyklip.parallelized._arraytonumpy')
+    def test_weighted_empca_warm_started_across_ranks(self, mock_arraytonumpy, mock_weighted_empca):
+        '''
+        Test each rank after the first is started from the basis of the previous rank,
+        and that the iteration settings are passed through
+        '''
+
+        numbasis = [1, 2]
+        aligned_cubes = np.tile(np.arange(9)*1. + 1., (1, 5, 1)) # shape (nwv, N, y*x)
+        aligned_cubes[0] *= np.arange(1, 6)[:, None]
+        mock_arraytonumpy.side_effect = [aligned_cubes, np.ones((5, 3*3, len(numbasis)))]
+        mock_weighted_empca.return_value = aligned_cubes[0]
+        pyklip.parallelized.original_shape = (5, 3, 3)
+        pyklip.parallelized.aligned_shape = (1, 5, 3, 3)
+        pyklip.parallelized.aligned = 'aligned data'
+        pyklip.parallelized.output_shape = (5, 3, 3, len(numbasis))
+        pyklip.parallelized.output = 'output data'
+
+        return_value = pyklip.parallelized._klip_section_multifile('scidata_indices', 'wavelength', 0, numbasis, 2,
+                                                    radstart=0., radend=100., phistart=-np.pi*2., phiend=np.pi*2, minmove=0,
+                                                    ref_center=[1, 1], minrot=0, maxrot=None, spectrum=None,
+                                                    mode='ADI', corr_smooth=1, psflib_good=None, psflib_corr=None,
+                                                    lite=False, dtype=None, algo='empca', empca_niter=40, empca_tol=1e-4)
+
+        assert return_value
+        first_call, second_call = mock_weighted_empca.call_args_list
+        assert first_call[1]['init_vecs'] is None
+        assert second_call[1]['nvec'] == 2
+        assert second_call[1]['init_vecs'].shape == (1, 9)
+        assert second_call[1]['niter'] == 40
+        assert second_call[1]['tol'] == 1e-4
+
+class empca_section_project_TestCase(unittest.TestCase):
+
+    '''
+    test _empca_section_project
+    '''
+
+    @mock.patch('pyklip.parallelized._arraytonumpy')
+    def test_references_follow_minrot(self, mock_arraytonumpy):
+        '''
+        Test science frames are only modelled from references that pass the minrot criterion, and that frames
+        sharing the same references share one EMPCA run
+        '''
+        nframes = 6
+        rng = np.random.RandomState(0)
+        aligned_imgs = 10. + rng.uniform(size=(nframes, 25))
+        rflat = np.linspace(20., 40., 25)
+        pas = np.array([0., 0., 0., 90., 90., 90.])
+        output_imgs = np.zeros((nframes, 25, 1))
+        mock_arraytonumpy.side_effect = [np.ones(nframes), pas, np.zeros(nframes), output_imgs]
+        pyklip.parallelized.img_wv = 'wvs'
+        pyklip.parallelized.img_pa = 'pas'
+        pyklip.parallelized.img_filenums = 'filenums'
+        pyklip.parallelized.output_shape = (nframes, 5, 5, 1)
+        pyklip.parallelized.output = 'output data'
+
+        with mock.patch('pyklip.empca.weighted_empca', wraps=pyklip.empca.weighted_empca) as mock_weighted_empca:
+            return_value = pyklip.parallelized._empca_section_project(np.arange(nframes), (np.arange(25),), rflat,
+                                                                      aligned_imgs, 1., 0, 30., [2], 0, 45., 'ADI',
+                                                                      maxnumbasis=3)
+
+        assert return_value
+        # two groups of frames, one EMPCA basis each
+        assert mock_weighted_empca.call_count == 2
+        used_refs = [call[0][0] for call in mock_weighted_empca.call_args_list]
+        assert all(refs.shape[0] == 3 for refs in used_refs)
+        np.testing.assert_array_equal(np.sort(used_refs[0], axis=0), np.sort(aligned_imgs[3:], axis=0))
+        np.testing.assert_array_equal(np.sort(used_refs[1], axis=0), np.sort(aligned_imgs[:3], axis=0))
+        # the model is fit to the data, so the residuals are much smaller than the images
+        assert np.all(np.abs(output_imgs) < 2.)
+        assert np.any(output_imgs != 0)
+
+    @mock.patch('pyklip.parallelized._arraytonumpy')
+    def test_movement_groups_frames(self, mock_arraytonumpy):
+        '''
+        Test that with a movement criterion, where no two frames have the same references, frames close in PA still
+        share an EMPCA basis, that no frame is modelled with itself, and that maxnumbasis caps the references
+        '''
+        nframes = 20
+        rng = np.random.RandomState(0)
+        aligned_imgs = 10. + rng.uniform(size=(nframes, 25))
+        rflat = np.linspace(20., 40., 25)
+        # 30 pixels from the center, 10 degrees of rotation is about 5 pixels of movement
+        pas = np.arange(nframes) * 10.
+        output_imgs = np.zeros((nframes, 25, 1))
+        mock_arraytonumpy.side_effect = [np.ones(nframes), pas, np.zeros(nframes), output_imgs]
+        pyklip.parallelized.img_wv = 'wvs'
+        pyklip.parallelized.img_pa = 'pas'
+        pyklip.parallelized.img_filenums = 'filenums'
+        pyklip.parallelized.output_shape = (nframes, 5, 5, 1)
+        pyklip.parallelized.output = 'output data'
+
+        with mock.patch('pyklip.empca.weighted_empca', wraps=pyklip.empca.weighted_empca) as mock_weighted_empca, \
+                mock.patch('pyklip.empca.weighted_projection',
+                           wraps=pyklip.empca.weighted_projection) as mock_weighted_projection:
+            return_value = pyklip.parallelized._empca_section_project(np.arange(nframes), (np.arange(25),), rflat,
+                                                                      aligned_imgs, 1., 0, 30., [2], 3, 0, 'ADI',
+                                                                      maxnumbasis=15)
+
+        assert return_value
+        # each frame only loses itself as a reference: groups of 2 frames keep 18 of their 19 references (ref_tol=0.1)
+        assert mock_weighted_empca.call_count == nframes // 2
+        for empca_call, projection_call in zip(mock_weighted_empca.call_args_list,
+                                               mock_weighted_projection.call_args_list):
+            refs = empca_call[0][0]
+            sci_imgs = projection_call[0][0]
+            assert refs.shape[0] == 15
+            # the science frames are not in their own references
+            assert not np.any(np.all(refs[:, None, :] == sci_imgs[None, :, :], axis=2))
+        assert np.all(output_imgs != 0)
+
 # @mock.patch.object(CHARIS.CHARISData, 'savedata')
 # @mock.patch('pyklip.parallelized.os')
 # def test_save_spectral_cubes(mock_os, mock_dataset_init, mock_savedata):
@@ -2,9 +2,11 @@ import os
 import glob
 from time import time
 import numpy as np
+import pytest
 import astropy.io.fits as fits
 
 import pyklip.instruments.Instrument as Instrument
+import pyklip.klip as klip
 import pyklip.parallelized as parallelized
 import pyklip.rdi as rdi
 
@@ -47,3 +49,278 @@ def test_RDI():
                             aligned_center=fakecenters[1], psf_library=psflib, movement=1)
 
 
+
+
+def _pairwise_correlation(frames, mask=None):
+    """
+    Pair-by-pair correlation of frames on the pixels they have in common (reference for the blocked computation)
+    """
+    nframes = frames.shape[0]
+    corr = np.identity(nframes)
+    for i in range(nframes):
+        for j in range(i + 1, nframes):
+            where_to_corr = (frames[i] == frames[i]) & (frames[j] == frames[j])
+            if mask is not None:
+                where_to_corr &= (mask == mask)
+            corr[i, j] = corr[j, i] = np.corrcoef(frames[j][where_to_corr], frames[i][where_to_corr])[0, 1]
+    return corr
+
+
+def test_blocked_correlation():
+    """
+    The blocked correlation matrix should match pairwise correlations with pairwise NaN masking
+    """
+    rng = np.random.RandomState(0)
+    nframes = 23
+    frames = rng.normal(size=(nframes, 12, 12)) + 50 * rng.uniform(size=(nframes, 1, 1)) \
+             + np.linspace(0, 5, 144).reshape(12, 12) * rng.normal(size=(nframes, 1, 1))
+    frames[rng.uniform(size=frames.shape) < 0.1] = np.nan
+    mask = np.zeros((12, 12))
+    mask[:3] = np.nan
+    filenames = np.array(["file{0}.fits".format(i) for i in range(nframes)])
+
+    psflib = rdi.PSFLibrary(frames, [6, 6], filenames, compute_correlation=True)
+    assert np.allclose(psflib.master_correlation, _pairwise_correlation(frames))
+
+    # small uneven blocks on several threads
+    psflib._compute_correlation(force=True, mask=mask, block_size=5, numthreads=3)
+    assert np.allclose(psflib.master_correlation, _pairwise_correlation(frames, mask))
+    assert np.allclose(psflib.master_correlation, psflib.master_correlation.T)
+
+
+def test_blocked_correlation_prepares_blocks_once(monkeypatch):
+    """
+    Each block of frames should only be mean subtracted and masked once when the prepared blocks fit in the memory
+    budget, and the correlations should be unchanged when the budget only fits a few blocks at a time
+    """
+    rng = np.random.RandomState(0)
+    frames1 = rng.normal(size=(11, 8, 8))
+    frames2 = rng.normal(size=(17, 8, 8))
+    frames2[rng.uniform(size=frames2.shape) < 0.1] = np.nan
+
+    prepared = []
+    prepare_correlation_block = rdi._prepare_correlation_block
+
+    def _counting_prepare(frames, mask=None):
+        prepared.append(frames.shape[0])
+        return prepare_correlation_block(frames, mask)
+    monkeypatch.setattr(rdi, "_prepare_correlation_block", _counting_prepare)
+
+    corr = rdi._blocked_correlation(frames1, frames2, block_size=4, numthreads=3)
+    # 3 blocks of frames1 and 5 blocks of frames2
+    assert len(prepared) == 8
+    assert sum(prepared) == 11 + 17
+    expected = _pairwise_correlation(np.append(frames1, frames2, axis=0))[:11, 11:]
+    assert np.allclose(corr, expected)
+
+    prepared.clear()
+    corr = rdi._blocked_correlation(frames2, block_size=4, numthreads=3)
+    assert len(prepared) == 5
+    expected2 = _pairwise_correlation(frames2)
+    assert np.allclose(corr, expected2)
+
+    # budget for 2 prepared blocks of 4 frames: one block of frames2 and one cached block of frames1
+    monkeypatch.setattr(rdi, "_corr_block_bytes", 2 * 8 * 3 * 64 * 4)
+    prepared.clear()
+    corr = rdi._blocked_correlation(frames1, frames2, block_size=4, numthreads=1)
+    assert len(prepared) > 8
+    assert np.allclose(corr, expected)
+    corr = rdi._blocked_correlation(frames2, numthreads=1)
+    assert np.allclose(corr, expected2)
+
+
+def test_append_to_library(tmpdir):
+    """
+    Appending datasets to an in-memory or on-disk library should give the same correlations as computing them from
+    scratch, and the on-disk library should reopen with all the files
+    """
+    rng = np.random.RandomState(1)
+
+    def _make_frames(nframes):
+        frames = rng.normal(size=(nframes, 10, 10)) \
+                 + np.linspace(0, 3, 100).reshape(10, 10) * rng.uniform(size=(nframes, 1, 1))
+        frames[rng.uniform(size=frames.shape) < 0.05] = np.nan
+        return frames
+
+    lib_frames = _make_frames(6)
+    lib_filenames = np.array(["lib{0}.fits".format(i) for i in range(6)])
+    datasets = []
+    for nframes in [3, 5, 9]:
+        filenames = np.array(["new{0}_{1}.fits".format(nframes, i) for i in range(nframes)])
+        datasets.append(Instrument.GenericData(_make_frames(nframes), np.zeros((nframes, 2)) + 5,
+                                               parangs=np.zeros(nframes), wvs=np.ones(nframes), filenames=filenames))
+    all_frames = np.concatenate([lib_frames] + [dataset.input for dataset in datasets])
+    expected_corr = _pairwise_correlation(all_frames)
+
+    for on_disk in [False, True]:
+        psflib = rdi.PSFLibrary(np.copy(lib_frames), [5, 5], lib_filenames, compute_correlation=True)
+        if on_disk:
+            psflib.save_library(str(tmpdir))
+        for dataset in datasets:
+            psflib.add_new_dataset_to_library(dataset)
+        # capacity doubles instead of growing by the size of each dataset
+        assert psflib._library_buffer.shape[0] == 24
+        assert psflib.nfiles == 23
+        assert np.allclose(psflib.master_correlation, expected_corr)
+        np.testing.assert_array_equal(psflib.master_library, all_frames)
+
+    psflib = rdi.PSFLibrary.load_library(str(tmpdir))
+    assert psflib.nfiles == 23
+    assert np.allclose(psflib.master_correlation, expected_corr)
+    np.testing.assert_array_equal(psflib.master_library, all_frames)
+    assert psflib.master_filenames[-1] == "new9_8.fits"
+
+
+def test_prepare_library(tmpdir):
+    """
+    prepare_library should pick out the dataset rows of the library in the order of the dataset, and exclude both the
+    dataset and the bad files from the reference PSFs, also after appending to and reopening the library
+    """
+    rng = np.random.RandomState(2)
+    lib_frames = rng.normal(size=(8, 10, 10))
+    lib_filenames = np.array([os.path.join("lib", "lib{0}.fits".format(i)) for i in range(8)])
+    psflib = rdi.PSFLibrary(lib_frames, [5, 5], lib_filenames, compute_correlation=True)
+    psflib.save_library(str(tmpdir))
+
+    # the dataset lives in a different directory and is out of order compared to the library
+    dataset_filenames = np.array([os.path.join("data", "lib{0}.fits".format(i)) for i in [5, 2]])
+    dataset = Instrument.GenericData(lib_frames[[5, 2]], np.zeros((2, 2)) + 5, parangs=np.zeros(2), wvs=np.ones(2),
+                                     filenames=dataset_filenames)
+    psflib.prepare_library(dataset, badfiles=["lib0.fits", os.path.join("elsewhere", "lib7.fits")])
+    np.testing.assert_array_equal(psflib.isgoodpsf, [1, 3, 4, 6])
+    np.testing.assert_array_equal(psflib.correlation, psflib.master_correlation[[5, 2]])
+
+    # files appended later are indexed and saved with the library too
+    new_filenames = np.array(["new{0}.fits".format(i) for i in range(3)])
+    new_dataset = Instrument.GenericData(rng.normal(size=(3, 10, 10)), np.zeros((3, 2)) + 5, parangs=np.zeros(3),
+                                         wvs=np.ones(3), filenames=new_filenames)
+    psflib.add_new_dataset_to_library(new_dataset)
+    psflib = rdi.PSFLibrary.load_library(str(tmpdir))
+    psflib.prepare_library(new_dataset)
+    np.testing.assert_array_equal(psflib.isgoodpsf, np.arange(8))
+    np.testing.assert_array_equal(psflib.correlation, psflib.master_correlation[8:])
+
+    # a dataset only partly in the library can't be matched up with the library
+    partial_dataset = Instrument.GenericData(rng.normal(size=(2, 10, 10)), np.zeros((2, 2)) + 5, parangs=np.zeros(2),
+                                             wvs=np.ones(2), filenames=np.array(["new0.fits", "missing.fits"]))
+    with pytest.raises(ValueError):
+        psflib.prepare_library(partial_dataset)
+
+
+def test_pixel_major_library(tmpdir):
+    """
+    Workers reading sector pixels from the memory-mapped pixel-major library should get the same pixels as from the
+    library cube
+    """
+    rng = np.random.RandomState(2)
+    frames = rng.normal(size=(8, 10, 10))
+    filenames = np.array(["lib{0}.fits".format(i) for i in range(8)])
+    psflib = rdi.PSFLibrary(frames, [5, 5], filenames, compute_correlation=True)
+    psflib.save_library(str(tmpdir))
+    pixel_major_file = psflib.save_pixel_major()
+    assert rdi.PSFLibrary.load_library(str(tmpdir)).pixel_major_file == pixel_major_file
+
+    parallelized._tpool_init(None, None, None, None, None, None, None, None, None, None, pixel_major_file, None)
+    section_ind = (np.array([3, 11, 12, 57, 99]),)
+    frame_indices = np.array([6, 0, 3])
+    sector = parallelized._psf_library_section(frame_indices, section_ind)
+    np.testing.assert_array_equal(sector, frames.reshape(8, 100)[frame_indices][:, section_ind[0]])
+
+    # adding files makes the pixel-major copy out of date
+    dataset = Instrument.GenericData(rng.normal(size=(2, 10, 10)), np.zeros((2, 2)) + 5, parangs=np.zeros(2),
+                                     wvs=np.ones(2), filenames=np.array(["new0.fits", "new1.fits"]))
+    psflib.add_new_dataset_to_library(dataset)
+    assert psflib.pixel_major_file is None
+
+
+def test_annulus_index():
+    """
+    The approximate RDI reference index should find most of the exactly most correlated frames, and all of them
+    when every cell is scanned
+    """
+    rng = np.random.RandomState(3)
+    y, x = np.indices((31, 31))
+    r = np.sqrt((x - 15.)**2 + (y - 15.)**2)
+    theta = np.arctan2(y - 15., x - 15.)
+    modes = np.array([np.exp(-r / 5.) * np.cos(m * theta + rng.uniform(0, 2 * np.pi)) * (1 + r / 5.)**(m / 2.)
+                      for m in range(6)])
+
+    def _make_frames(nframes):
+        coeffs = rng.normal(size=(nframes, 6)) * np.array([8., 5., 3., 2., 1., 0.5])
+        return np.einsum('nm,myx->nyx', coeffs, modes) + 0.05 * rng.normal(size=(nframes, 31, 31))
+
+    library = _make_frames(400)
+    sci_imgs = _make_frames(10)
+    rad_bounds = [(3, 8), (8, 14)]
+    index = rdi.AnnulusIndex(library, [15, 15], rad_bounds, ncomp=12)
+
+    assert index.annulus_at(9.) == 1
+    assert index.annulus_at(20.) is None
+    assert np.all(index.recall(library, sci_imgs, 20) > 0.7)
+    assert np.allclose(index.recall(library, sci_imgs, 20, nprobe=index.nlist), 1)
+
+    # only frames from the allowed subset, indexed into the subset
+    subset = np.arange(0, 400, 2)
+    best = index.query(sci_imgs[0], 0, 15, subset=subset)
+    assert best.size == 15
+    assert np.all((best >= 0) & (best < subset.size))
+
+
+def test_sector_grams(tmpdir):
+    """
+    Slices of the cached sector covariances should match np.cov of the selected library PSFs, also after reloading
+    the library from disk
+    """
+    rng = np.random.RandomState(4)
+    frames = rng.normal(size=(12, 21, 21)) + rng.uniform(size=(12, 1, 1))
+    frames[2, 3:6, 3:6] = np.nan
+    filenames = np.array(["lib{0}.fits".format(i) for i in range(12)])
+    psflib = rdi.PSFLibrary(frames, [10, 10], filenames, compute_correlation=True)
+    psflib.save_library(str(tmpdir))
+    psflib.build_sector_grams([(2, 6), (6, 10)], 2)
+    assert psflib.sector_grams.lookup(6, 10, 0, np.pi) == 3
+    assert psflib.sector_grams.lookup(6, 11, 0, np.pi) is None
+
+    x, y = np.meshgrid(np.arange(21 * 1.0), np.arange(21 * 1.0))
+    r, phi = klip.make_polar_coordinates(x.ravel(), y.ravel(), [10, 10])
+    section_ind = np.where((r >= 6) & (r < 10) & (phi >= -np.pi) & (phi < 0))
+    selected = np.array([7, 2, 0, 11])
+    psfs = frames.reshape(12, 21 * 21)[selected][:, section_ind[0]]
+    psfs = psfs - np.nanmean(psfs, axis=1)[:, None]
+    psfs[np.isnan(psfs)] = 0
+
+    for cache in [psflib.sector_grams, rdi.PSFLibrary.load_library(str(tmpdir)).sector_grams]:
+        sector = cache.lookup(6, 10, -np.pi, 0, npix=np.size(section_ind))
+        assert sector == 1
+        assert np.allclose(cache.covariance(sector, selected), np.cov(psfs))
+        assert np.allclose(cache.means(sector, selected),
+                           np.nanmean(frames.reshape(12, 21 * 21)[selected][:, section_ind[0]], axis=1))
+
+
+def test_sector_grams_pickle(tmpdir):
+    """
+    Pickled sector caches should never carry the covariance matrices. Copies of an on-disk cache read them from the
+    cache directory, copies of an in-memory cache don't find the sectors
+    """
+    import pickle
+
+    rng = np.random.RandomState(5)
+    frames = rng.normal(size=(8, 21, 21))
+    sectors = [(2, 6, -np.pi, np.pi), (6, 10, -np.pi, np.pi)]
+
+    in_memory = rdi.SectorGramCache(frames, [10, 10], sectors)
+    on_disk = rdi.SectorGramCache(frames, [10, 10], sectors, cache_dir=str(tmpdir.join("grams")))
+    assert in_memory.lookup(*sectors[1]) == 1
+    expected = in_memory.covariance(1, np.arange(8))
+
+    in_memory_copy = pickle.loads(pickle.dumps(in_memory))
+    assert all(covar is None for covar in in_memory_copy._covars)
+    assert in_memory_copy.lookup(*sectors[1]) is None
+    # the original keeps its matrices
+    assert in_memory.lookup(*sectors[1]) == 1
+
+    on_disk.covariance(1, np.arange(8))
+    on_disk_copy = pickle.loads(pickle.dumps(on_disk))
+    assert all(covar is None for covar in on_disk_copy._covars)
+    assert on_disk_copy.lookup(*sectors[1]) == 1
+    assert np.allclose(on_disk_copy.covariance(1, np.arange(8)), expected)